@@ -1,9 +1,12 @@
+from collections import Counter
 from enum import Enum
-from typing import Callable
+from typing import Callable, Optional
 from itertools import accumulate
+import asyncio
 import random
 import time
 import uuid
+import httpx
 import requests
 import typer
 
@@ -67,6 +70,24 @@ def _generate_name() -> str:
     return name + "-" + str(uuid.uuid4())[:8]
 
 
+RETRY_STATUSES = {429, 503}
+MAX_BACKOFF_S = 30.0
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str]) -> float:
+    """Seconds to wait before retrying a rejected request.
+
+    The delay doubles with each attempt from 100ms, up to MAX_BACKOFF_S, and
+    never undercuts the Retry-After of the collector. It is stretched by a
+    random factor so that rejected clients do not all come back at once."""
+    try:
+        floor = float(retry_after) if retry_after is not None else 0.0
+    except ValueError:
+        floor = 0.0
+    delay = max(floor, min(MAX_BACKOFF_S, 0.1 * 2**attempt))
+    return delay * random.uniform(1, 1.5)
+
+
 def generate_events(
     base_url: str, num_ongoing: int = 10, wait_interval_ms: int = 10
 ) -> None:
@@ -74,7 +95,9 @@ def generate_events(
 
     The simulation runs until interruption.
     An event is sent every wait_interval_ms milliseconds.
-    At any moment, num_ongoing delivery missions are currently ongoing."""
+    At any moment, num_ongoing delivery missions are currently ongoing.
+    An event rejected by an overloaded collector is sent again after a backoff,
+    with the same Idempotency-Key."""
     generate_next_state = _build_transition_function(TRANSITIONS)
     ongoing_deliveries: dict[str, State] = {}
     while True:
@@ -86,10 +109,18 @@ def generate_events(
             delivery_id = random.choice(list(ongoing_deliveries.keys()))
             current_state = ongoing_deliveries[delivery_id]
             new_state = generate_next_state(current_state)
-        r = requests.post(
-            f"{base_url}/deliveries/{delivery_id}/events",
-            json={"type": new_state.value},
-        )
+        headers = {"Idempotency-Key": uuid.uuid4().hex}
+        attempt = 0
+        while True:
+            r = requests.post(
+                f"{base_url}/deliveries/{delivery_id}/events",
+                json={"type": new_state.value},
+                headers=headers,
+            )
+            if r.status_code not in RETRY_STATUSES:
+                break
+            time.sleep(_retry_delay(attempt, r.headers.get("Retry-After")))
+            attempt += 1
         print(f"Delivery {delivery_id} transitioned to {new_state.value}")
         if new_state.is_terminal:
             del ongoing_deliveries[delivery_id]
@@ -97,5 +128,262 @@ def generate_events(
             ongoing_deliveries[delivery_id] = new_state
 
 
+class Fleet:
+    """A fleet of num_ongoing delivery missions, for the async mode.
+
+    A delivery is busy while one of its events is in flight, and is not
+    picked again until the collector answered, so its events stay in order.
+    When all the deliveries of a full fleet are busy, the next event waits
+    for one to be released."""
+
+    def __init__(self, num_ongoing: int, generate_next_state: Callable[[State], State]):
+        self.num_ongoing = num_ongoing
+        self.generate_next_state = generate_next_state
+        self.ongoing_deliveries: dict[str, State] = {}
+        self.busy: set[str] = set()
+        self.released = asyncio.Event()
+
+    async def next_event(self) -> tuple[str, State]:
+        while True:
+            idle = [name for name in self.ongoing_deliveries if name not in self.busy]
+            if len(self.ongoing_deliveries) < self.num_ongoing or idle:
+                break
+            self.released.clear()
+            await self.released.wait()
+        if len(self.ongoing_deliveries) < self.num_ongoing:
+            delivery_id = _generate_name()
+            new_state = State.PARCEL_COLLECTED
+        else:
+            delivery_id = random.choice(idle)
+            new_state = self.generate_next_state(self.ongoing_deliveries[delivery_id])
+        if new_state.is_terminal:
+            self.ongoing_deliveries.pop(delivery_id, None)
+        else:
+            self.ongoing_deliveries[delivery_id] = new_state
+        self.busy.add(delivery_id)
+        return delivery_id, new_state
+
+    def release(self, delivery_id: str) -> None:
+        self.busy.discard(delivery_id)
+        self.released.set()
+
+
+class Stats:
+    """Outcome of the requests sent in the async mode."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = 0
+        self.requests = 0
+        self.retries = 0
+        self.errors: Counter[str] = Counter()
+        self.latencies: list[float] = []
+
+    def record(self, num_events: int, latency: float, error: Optional[str]) -> None:
+        self.requests += 1
+        self.latencies.append(latency)
+        if error is None:
+            self.events += num_events
+        else:
+            self.errors[error] += 1
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        latencies = sorted(self.latencies)
+        lines = [
+            f"Sent {self.events} events in {self.requests} requests over {elapsed:.1f}s",
+            f"Achieved rate: {self.events / elapsed:.1f} events/s",
+            f"Retries: {self.retries}",
+            f"Errors: {sum(self.errors.values())}"
+            + "".join(f", {error}: {count}" for error, count in self.errors.most_common()),
+        ]
+        if latencies:
+            lines.append(
+                "Latency: "
+                + ", ".join(
+                    f"p{q} {_percentile(latencies, q) * 1000:.1f}ms"
+                    for q in (50, 95, 99)
+                )
+            )
+        return "\n".join(lines)
+
+
+class Throttle:
+    """Pause of the async mode, set by the Retry-After of a rejected request.
+
+    While it lasts, no new request is scheduled, and the schedule is shifted
+    by the pause rather than catching up with a burst afterwards."""
+
+    def __init__(self):
+        self.resume_at = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self.resume_at = max(self.resume_at, time.perf_counter() + seconds)
+
+    async def wait(self) -> float:
+        """Wait for the pause to end, and return how long it lasted."""
+        paused = max(0.0, self.resume_at - time.perf_counter())
+        if paused:
+            await asyncio.sleep(paused)
+        return paused
+
+
+def _percentile(sorted_values: list[float], q: int) -> float:
+    """Nearest-rank percentile of sorted values."""
+    rank = max(1, -(-q * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+async def _send(
+    client: httpx.AsyncClient,
+    fleet: Fleet,
+    events: list[tuple[str, State]],
+    scheduled: float,
+    stats: Stats,
+    throttle: Throttle,
+    max_retries: int,
+) -> None:
+    """Send events, one by one or as a batch, and record the outcome.
+    The latency is measured from the scheduled time, so that requests
+    waiting for a connection are not left out of the percentiles.
+    Requests rejected by an overloaded collector are retried up to
+    max_retries times after a backoff, which also pauses the schedule."""
+    error = None
+    keys = [uuid.uuid4().hex for _ in events]
+    try:
+        for attempt in range(max_retries + 1):
+            if len(events) == 1:
+                (delivery_id, state), = events
+                response = await client.post(
+                    f"/deliveries/{delivery_id}/events",
+                    json={"type": state.value},
+                    headers={"Idempotency-Key": keys[0]},
+                )
+            else:
+                response = await client.post(
+                    "/events/batch",
+                    json={
+                        "events": [
+                            {
+                                "delivery_name": delivery_id,
+                                "type": state.value,
+                                "idempotency_key": key,
+                            }
+                            for (delivery_id, state), key in zip(events, keys)
+                        ]
+                    },
+                )
+            if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                break
+            stats.retries += 1
+            delay = _retry_delay(attempt, response.headers.get("Retry-After"))
+            throttle.pause(delay)
+            await asyncio.sleep(delay)
+        if response.is_error:
+            error = f"HTTP {response.status_code}"
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    finally:
+        for delivery_id, _ in events:
+            fleet.release(delivery_id)
+    stats.record(len(events), time.perf_counter() - scheduled, error)
+
+
+async def generate_events_async(
+    base_url: str,
+    num_ongoing: int = 10,
+    fleets: int = 10,
+    rate: float = 1000,
+    batch_size: int = 1,
+    connections: int = 100,
+    duration: Optional[float] = None,
+    max_retries: int = 5,
+) -> Stats:
+    """Simulate fleets of delivery missions sending events to a provided URL,
+    at a target rate of events per second.
+
+    The load is open-loop: requests are sent on schedule whatever the latency
+    of the collector, over a pool of keep-alive connections. Each request goes
+    to the next fleet, round robin. With batch_size > 1, the events are sent
+    batch_size at a time to the batch API. When the collector sheds load,
+    the schedule pauses for its Retry-After, see _send, and it also waits
+    while all the deliveries of a fleet are in flight, see Fleet.
+    The simulation runs for duration seconds, or until interruption."""
+    if batch_size > num_ongoing:
+        raise ValueError("batch_size cannot exceed num_ongoing, the deliveries of a batch are distinct.")
+    generate_next_state = _build_transition_function(TRANSITIONS)
+    all_fleets = [Fleet(num_ongoing, generate_next_state) for _ in range(fleets)]
+    stats = Stats()
+    throttle = Throttle()
+    limits = httpx.Limits(
+        max_connections=connections, max_keepalive_connections=connections
+    )
+    pending: set[asyncio.Task] = set()
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30
+    ) as client:
+        try:
+            interval = batch_size / rate
+            start = time.perf_counter()
+            tick = 0
+            while duration is None or tick * interval < duration:
+                start += await throttle.wait()
+                scheduled = start + tick * interval
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+                fleet = all_fleets[tick % fleets]
+                events = [await fleet.next_event() for _ in range(batch_size)]
+                task = asyncio.create_task(
+                    _send(client, fleet, events, scheduled, stats, throttle, max_retries)
+                )
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                tick += 1
+            await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+            print(stats.summary())
+    return stats
+
+
+def main(
+    base_url: str,
+    num_ongoing: int = 10,
+    wait_interval_ms: int = 10,
+    concurrent: bool = typer.Option(
+        False, "--async", help="Send events concurrently at a target rate."
+    ),
+    fleets: int = 10,
+    rate: float = 1000,
+    batch_size: int = 1,
+    connections: int = 100,
+    duration: Optional[float] = None,
+    max_retries: int = 5,
+) -> None:
+    """Simulate delivery missions sending events to a provided URL.
+
+    By default, events are sent one at a time, see generate_events.
+    With --async, fleets of num_ongoing missions send rate events per second
+    concurrently, see generate_events_async."""
+    if not concurrent:
+        generate_events(base_url, num_ongoing, wait_interval_ms)
+        return
+    try:
+        asyncio.run(
+            generate_events_async(
+                base_url,
+                num_ongoing,
+                fleets,
+                rate,
+                batch_size,
+                connections,
+                duration,
+                max_retries,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == "__main__":
-    typer.run(generate_events)
+    typer.run(main)
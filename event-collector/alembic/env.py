@@ -13,6 +13,13 @@ fileConfig(config.config_file_name)
 
 target_metadata = Base.metadata
 
+def include_object(object, name, type_, reflected, compare_to):
+    """Leave out the partitions of events, which the app manages, see app/partitions.py."""
+    table = object if type_ == "table" else getattr(object, "table", None)
+    if reflected and compare_to is None and table is not None and table.name.startswith("events_"):
+        return False
+    return True
+
 def get_url():
     return os.getenv(
         "DATABASE_URL_SYNC",
@@ -23,7 +30,7 @@ def run_migrations_online():
     connectable = create_engine(get_url())  # Use synchronous engine
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object)
 
         with context.begin_transaction():
             context.run_migrations()
@@ -33,6 +40,7 @@ def run_migrations_offline():
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -44,7 +52,7 @@ def run_migrations_online():
     connectable = create_engine(get_url())
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object)
 
         with context.begin_transaction():
             context.run_migrations()
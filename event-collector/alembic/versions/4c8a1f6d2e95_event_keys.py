@@ -0,0 +1,34 @@
+"""event keys
+
+Revision ID: 4c8a1f6d2e95
+Revises: e7b2d4c81f36
+Create Date: 2026-10-18 18:21:37.104562
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4c8a1f6d2e95'
+down_revision: Union[str, Sequence[str], None] = 'e7b2d4c81f36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('event_keys',
+    sa.Column('key', sa.String(length=32), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index('ix_event_keys_created_at', 'event_keys', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_event_keys_created_at', table_name='event_keys')
+    op.drop_table('event_keys')
@@ -0,0 +1,28 @@
+"""unique delivery name
+
+Revision ID: 5b1d7e3a9f20
+Revises: c2f357384c9e
+Create Date: 2026-10-18 09:12:05.114203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1d7e3a9f20'
+down_revision: Union[str, Sequence[str], None] = 'c2f357384c9e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Batch ingestion upserts deliveries with ON CONFLICT (name), which needs this index.
+    op.create_index(op.f('ix_deliveries_name'), 'deliveries', ['name'], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_deliveries_name'), table_name='deliveries')
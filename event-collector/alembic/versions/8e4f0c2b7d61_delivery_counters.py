@@ -0,0 +1,40 @@
+"""delivery counters
+
+Revision ID: 8e4f0c2b7d61
+Revises: 5b1d7e3a9f20
+Create Date: 2026-10-18 10:02:41.630518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e4f0c2b7d61'
+down_revision: Union[str, Sequence[str], None] = '5b1d7e3a9f20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('delivery_counters',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name', 'shard')
+    )
+    # Seed the counters from the existing deliveries, like `python -m app.cli reconcile-counters`.
+    op.execute(
+        "INSERT INTO delivery_counters (name, shard, value) "
+        "SELECT 'total', 0, count(*) FROM deliveries "
+        "UNION ALL "
+        "SELECT 'ongoing', 0, count(*) FROM deliveries WHERE status IN ('TAKEN_OFF', 'PARCEL_COLLECTED', 'LANDED')"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('delivery_counters')
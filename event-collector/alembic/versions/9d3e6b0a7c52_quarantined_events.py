@@ -0,0 +1,43 @@
+"""quarantined events
+
+Revision ID: 9d3e6b0a7c52
+Revises: 4c8a1f6d2e95
+Create Date: 2026-10-18 19:47:12.913208
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d3e6b0a7c52'
+down_revision: Union[str, Sequence[str], None] = '4c8a1f6d2e95'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+deliverystate = postgresql.ENUM(
+    'PARCEL_COLLECTED', 'TAKEN_OFF', 'LANDED', 'CRASHED', 'PARCEL_DELIVERED', name='deliverystate', create_type=False,
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('quarantined_events',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('delivery_name', sa.String(), nullable=False),
+    sa.Column('type', deliverystate, nullable=False),
+    sa.Column('previous_status', deliverystate, nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('quarantined_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_quarantined_events_delivery_name', 'quarantined_events', ['delivery_name'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_quarantined_events_delivery_name', table_name='quarantined_events')
+    op.drop_table('quarantined_events')
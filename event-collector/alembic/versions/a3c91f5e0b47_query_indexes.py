@@ -0,0 +1,44 @@
+"""query indexes
+
+Revision ID: a3c91f5e0b47
+Revises: 8e4f0c2b7d61
+Create Date: 2026-10-18 11:47:26.305871
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3c91f5e0b47'
+down_revision: Union[str, Sequence[str], None] = '8e4f0c2b7d61'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ONGOING_STATES = "status IN ('TAKEN_OFF', 'PARCEL_COLLECTED', 'LANDED')"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The unique index on deliveries.name was added by 5b1d7e3a9f20.
+    # Primary keys are already indexed, these duplicates only slowed down writes.
+    op.drop_index(op.f('ix_deliveries_id'), table_name='deliveries')
+    op.drop_index(op.f('ix_events_id'), table_name='events')
+    op.create_index('ix_deliveries_created_at', 'deliveries', ['created_at'], unique=False)
+    op.create_index('ix_deliveries_ongoing', 'deliveries', ['id'], unique=False, postgresql_where=sa.text(ONGOING_STATES))
+    op.create_index('ix_events_delivery_id_created_at', 'events', ['delivery_id', 'created_at'], unique=False)
+    op.drop_constraint('events_delivery_id_fkey', 'events', type_='foreignkey')
+    op.create_foreign_key('events_delivery_id_fkey', 'events', 'deliveries', ['delivery_id'], ['id'], ondelete='CASCADE')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('events_delivery_id_fkey', 'events', type_='foreignkey')
+    op.create_foreign_key('events_delivery_id_fkey', 'events', 'deliveries', ['delivery_id'], ['id'])
+    op.drop_index('ix_events_delivery_id_created_at', table_name='events')
+    op.drop_index('ix_deliveries_ongoing', table_name='deliveries', postgresql_where=sa.text(ONGOING_STATES))
+    op.drop_index('ix_deliveries_created_at', table_name='deliveries')
+    op.create_index(op.f('ix_events_id'), 'events', ['id'], unique=False)
+    op.create_index(op.f('ix_deliveries_id'), 'deliveries', ['id'], unique=False)
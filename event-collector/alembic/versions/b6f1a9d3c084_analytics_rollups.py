@@ -0,0 +1,60 @@
+"""analytics rollups
+
+Revision ID: b6f1a9d3c084
+Revises: 9d3e6b0a7c52
+Create Date: 2026-10-18 21:14:06.275391
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6f1a9d3c084'
+down_revision: Union[str, Sequence[str], None] = '9d3e6b0a7c52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+deliverystate = postgresql.ENUM(
+    'PARCEL_COLLECTED', 'TAKEN_OFF', 'LANDED', 'CRASHED', 'PARCEL_DELIVERED', name='deliverystate', create_type=False,
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('deliveries', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    # The status of a delivery was set by its last event.
+    op.execute(
+        "UPDATE deliveries SET updated_at = last.created_at "
+        "FROM (SELECT delivery_id, max(created_at) AS created_at FROM events GROUP BY delivery_id) AS last "
+        "WHERE last.delivery_id = deliveries.id"
+    )
+    op.create_table('hourly_rollups',
+    sa.Column('hour', sa.DateTime(), nullable=False),
+    sa.Column('status', deliverystate, nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('events', sa.BigInteger(), nullable=False),
+    sa.Column('deliveries', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('hour', 'status', 'shard')
+    )
+    op.create_table('transition_rollups',
+    sa.Column('hour', sa.DateTime(), nullable=False),
+    sa.Column('previous_status', deliverystate, nullable=False),
+    sa.Column('status', deliverystate, nullable=False),
+    sa.Column('bucket', sa.SmallInteger(), nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('events', sa.BigInteger(), nullable=False),
+    sa.Column('seconds', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('hour', 'previous_status', 'status', 'bucket', 'shard')
+    )
+    # Fill them from the existing events with `python -m app.cli rebuild-rollups`.
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('transition_rollups')
+    op.drop_table('hourly_rollups')
+    op.drop_column('deliveries', 'updated_at')
@@ -0,0 +1,46 @@
+"""compacted histories
+
+Revision ID: d5e9b2c7a418
+Revises: f3a8c6e1d240
+Create Date: 2026-10-18 13:25:56.984389
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5e9b2c7a418'
+down_revision: Union[str, Sequence[str], None] = 'f3a8c6e1d240'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('compacted_histories',
+    sa.Column('delivery_id', sa.BigInteger(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=False),
+    sa.Column('ended_at', sa.DateTime(), nullable=False),
+    sa.Column('event_ids', postgresql.ARRAY(sa.BigInteger()), nullable=False),
+    sa.Column('types', postgresql.ARRAY(sa.SmallInteger()), nullable=False),
+    sa.Column('offsets', postgresql.ARRAY(sa.BigInteger()), nullable=False),
+    sa.ForeignKeyConstraint(['delivery_id'], ['deliveries.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('delivery_id')
+    )
+    op.create_index('ix_compacted_histories_started_at', 'compacted_histories', ['started_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # The compacted events go back to events.
+    op.execute(
+        "INSERT INTO events (id, delivery_id, created_at, type) "
+        "SELECT event.id, delivery_id, started_at + event.elapsed * INTERVAL '1 microsecond', event.type "
+        "FROM compacted_histories, unnest(event_ids, types, offsets) AS event(id, type, elapsed)"
+    )
+    op.drop_index('ix_compacted_histories_started_at', table_name='compacted_histories')
+    op.drop_table('compacted_histories')
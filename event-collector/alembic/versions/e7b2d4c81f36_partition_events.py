@@ -0,0 +1,63 @@
+"""partition events
+
+Revision ID: e7b2d4c81f36
+Revises: a3c91f5e0b47
+Create Date: 2026-10-18 16:02:11.482903
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7b2d4c81f36'
+down_revision: Union[str, Sequence[str], None] = 'a3c91f5e0b47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The existing events become the first partition, up to the end of today or of the
+    # last event, without being copied. The app creates the following partitions.
+    op.execute("UPDATE events SET created_at = now() WHERE created_at IS NULL")
+    op.execute("ALTER TABLE events RENAME TO events_legacy")
+    op.execute("ALTER TABLE events_legacy DROP CONSTRAINT events_delivery_id_fkey")
+    op.execute("ALTER TABLE events_legacy DROP CONSTRAINT events_pkey")
+    op.execute("ALTER TABLE events_legacy ALTER COLUMN created_at SET NOT NULL")
+    op.execute("ALTER TABLE events_legacy ADD CONSTRAINT events_legacy_pkey PRIMARY KEY (id, created_at)")
+    op.execute("ALTER INDEX ix_events_delivery_id_created_at RENAME TO events_legacy_delivery_id_created_at_idx")
+    op.execute("""
+        CREATE TABLE events (
+            id INTEGER NOT NULL DEFAULT nextval('events_id_seq'),
+            type deliverystate NOT NULL,
+            delivery_id INTEGER NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            CONSTRAINT events_pkey PRIMARY KEY (id, created_at),
+            CONSTRAINT events_delivery_id_fkey FOREIGN KEY (delivery_id) REFERENCES deliveries (id) ON DELETE CASCADE
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events.id")
+    op.execute("CREATE INDEX ix_events_delivery_id_created_at ON events (delivery_id, created_at)")
+    end = op.get_bind().exec_driver_sql(
+        "SELECT date_trunc('day', greatest(max(created_at), now()::timestamp)) + interval '1 day' FROM events_legacy"
+    ).scalar()
+    op.execute(f"ALTER TABLE events ATTACH PARTITION events_legacy FOR VALUES FROM (MINVALUE) TO ('{end.isoformat()}')")
+    op.execute("CREATE TABLE events_default PARTITION OF events DEFAULT")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("CREATE TABLE events_plain (LIKE events INCLUDING DEFAULTS)")
+    op.execute("INSERT INTO events_plain SELECT * FROM events")
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events_plain.id")
+    op.execute("DROP TABLE events")
+    op.execute("ALTER TABLE events_plain RENAME TO events")
+    op.execute("ALTER TABLE events ALTER COLUMN created_at DROP NOT NULL")
+    op.execute("ALTER TABLE events ADD CONSTRAINT events_pkey PRIMARY KEY (id)")
+    op.execute(
+        "ALTER TABLE events ADD CONSTRAINT events_delivery_id_fkey "
+        "FOREIGN KEY (delivery_id) REFERENCES deliveries (id) ON DELETE CASCADE"
+    )
+    op.execute("CREATE INDEX ix_events_delivery_id_created_at ON events (delivery_id, created_at)")
@@ -0,0 +1,118 @@
+"""compact storage
+
+Revision ID: f3a8c6e1d240
+Revises: b6f1a9d3c084
+Create Date: 2026-10-18 23:02:37.614820
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a8c6e1d240'
+down_revision: Union[str, Sequence[str], None] = 'b6f1a9d3c084'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# STATE_CODES of app/models/type.py when the states were encoded.
+STATE_CODES = {'PARCEL_COLLECTED': 1, 'TAKEN_OFF': 2, 'LANDED': 3, 'CRASHED': 4, 'PARCEL_DELIVERED': 5}
+ONGOING_CODES = "2, 1, 3"
+STATE_COLUMNS = [
+    ('quarantined_events', 'type'),
+    ('quarantined_events', 'previous_status'),
+    ('hourly_rollups', 'status'),
+    ('transition_rollups', 'previous_status'),
+    ('transition_rollups', 'status'),
+]
+
+
+def to_code(column: str) -> str:
+    return "CASE " + column + " " + " ".join(f"WHEN '{state}' THEN {code}" for state, code in STATE_CODES.items()) + " END"
+
+def to_state(column: str) -> str:
+    return "(CASE " + column + " " + " ".join(f"WHEN {code} THEN '{state}'" for state, code in STATE_CODES.items()) + " END)::deliverystate"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Deliveries and events are rebuilt with their columns ordered by alignment, so they are
+    # copied aside, then back into the new tables. The events keep their partitions.
+    partitions = op.get_bind().exec_driver_sql(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'events'::regclass"
+    ).all()
+    op.execute(
+        "CREATE TABLE deliveries_copy AS "
+        f"SELECT id, created_at, updated_at, {to_code('status')} AS status, name FROM deliveries"
+    )
+    op.execute(
+        "CREATE TABLE events_copy AS "
+        f"SELECT id, delivery_id, created_at, {to_code('type')} AS type FROM events"
+    )
+    op.execute("DROP TABLE events")
+    op.execute("DROP TABLE deliveries")
+
+    op.execute("""
+        CREATE TABLE deliveries (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+            created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now(),
+            updated_at TIMESTAMP WITHOUT TIME ZONE,
+            status SMALLINT NOT NULL,
+            name VARCHAR(32) NOT NULL,
+            CONSTRAINT deliveries_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute("INSERT INTO deliveries SELECT * FROM deliveries_copy ORDER BY id")
+    op.execute("SELECT setval(pg_get_serial_sequence('deliveries', 'id'), max(id)) FROM deliveries")
+    op.execute("CREATE UNIQUE INDEX ix_deliveries_name ON deliveries (name)")
+    op.execute("CREATE INDEX ix_deliveries_created_at ON deliveries (created_at)")
+    op.execute(f"CREATE INDEX ix_deliveries_ongoing ON deliveries (id) WHERE status IN ({ONGOING_CODES})")
+
+    op.execute("""
+        CREATE TABLE events (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+            delivery_id BIGINT NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            type SMALLINT NOT NULL,
+            CONSTRAINT events_pkey PRIMARY KEY (id, created_at),
+            CONSTRAINT events_delivery_id_fkey FOREIGN KEY (delivery_id) REFERENCES deliveries (id) ON DELETE CASCADE
+        ) PARTITION BY RANGE (created_at)
+    """)
+    for name, bound in partitions:
+        op.execute(f"CREATE TABLE {name} PARTITION OF events {bound}")
+    op.execute("INSERT INTO events SELECT * FROM events_copy ORDER BY created_at, id")
+    op.execute("SELECT setval(pg_get_serial_sequence('events', 'id'), max(id)) FROM events")
+    op.execute("CREATE INDEX ix_events_delivery_id_created_at ON events (delivery_id, created_at)")
+    op.execute("DROP TABLE events_copy")
+    op.execute("DROP TABLE deliveries_copy")
+
+    for table, column in STATE_COLUMNS:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE SMALLINT USING {to_code(column)}")
+    op.execute("DROP TYPE deliverystate")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("CREATE TYPE deliverystate AS ENUM (" + ", ".join(f"'{state}'" for state in STATE_CODES) + ")")
+    for table, column in STATE_COLUMNS:
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE deliverystate USING {to_state(column)}")
+    # The columns keep their order.
+    op.execute("DROP INDEX ix_deliveries_ongoing")
+    op.execute(f"ALTER TABLE deliveries ALTER COLUMN status TYPE deliverystate USING {to_state('status')}")
+    op.execute(
+        "CREATE INDEX ix_deliveries_ongoing ON deliveries (id) "
+        "WHERE status IN ('TAKEN_OFF', 'PARCEL_COLLECTED', 'LANDED')"
+    )
+    op.execute("ALTER TABLE deliveries ALTER COLUMN name TYPE VARCHAR")
+    op.execute(f"ALTER TABLE events ALTER COLUMN type TYPE deliverystate USING {to_state('type')}")
+    for table in ('deliveries', 'events'):
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id DROP IDENTITY")
+        op.execute(f"CREATE SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        op.execute(f"SELECT setval('{table}_id_seq', max(id)) FROM {table}")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{table}_id_seq')")
+    op.execute("ALTER TABLE events ALTER COLUMN delivery_id TYPE INTEGER")
+    op.execute("ALTER TABLE events ALTER COLUMN id TYPE INTEGER")
+    op.execute("ALTER TABLE deliveries ALTER COLUMN id TYPE INTEGER")
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+from redis.asyncio import Redis
+
+from .core import settings
+from .db import engine, redis_client
+from .event_queue import get_queue_stats
+from .metrics import (
+    INGEST_ADMISSION_LIMIT, INGEST_IN_FLIGHT, INGEST_REJECTION_RATE, record_rejected_ingest_request,
+)
+from .schemas import AdmissionStatsSchema
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    Bounds the ingest requests served at once, and sheds the others with a 429.
+
+    Every admission_interval seconds, the ingest queue depth and the wait of the oldest
+    checkout of the primary pool are measured. Past ingest_max_queue_depth or
+    ingest_max_pool_wait, the collector is overloaded: every ingest request is rejected,
+    and the limit is halved, down to ingest_min_concurrency. Otherwise the limit grows by a
+    tenth of ingest_max_concurrency per interval, so a recovering database is not hit by
+    the whole backlog of the clients at once.
+    """
+
+    def __init__(self, redis: Redis = redis_client):
+        self.redis = redis
+        self.limit = settings.ingest_max_concurrency
+        self.in_flight = 0
+        self.overloaded: Optional[str] = None
+        self.queue_depth = 0
+        self.pool_wait_seconds = 0.0
+        self.rejection_rate = 0.0
+        self.measured_at: Optional[float] = None
+        self._admitted = 0
+        self._rejected = 0
+        self._lock = asyncio.Lock()
+        INGEST_ADMISSION_LIMIT.set_function(lambda: self.limit)
+        INGEST_IN_FLIGHT.set_function(lambda: self.in_flight)
+        INGEST_REJECTION_RATE.set_function(lambda: self.rejection_rate)
+
+    async def measure(self) -> None:
+        """Measure the load and adjust the limit, at most every admission_interval seconds."""
+        if self.measured_at is not None and time.monotonic() - self.measured_at < settings.admission_interval:
+            return
+        async with self._lock:
+            if self.measured_at is not None and time.monotonic() - self.measured_at < settings.admission_interval:
+                return
+            try:
+                self.queue_depth = (await get_queue_stats(self.redis)).depth
+            except Exception:
+                logger.exception("Failed to measure the ingest queue depth.")
+            self.pool_wait_seconds = engine.sync_engine.pool.wait_seconds()
+            if settings.ingest_max_queue_depth is not None and self.queue_depth > settings.ingest_max_queue_depth:
+                self.overloaded = "queue_depth"
+            elif settings.ingest_max_pool_wait is not None and self.pool_wait_seconds > settings.ingest_max_pool_wait:
+                self.overloaded = "pool_wait"
+            else:
+                self.overloaded = None
+            if self.overloaded is not None:
+                self.limit = max(settings.ingest_min_concurrency, self.limit // 2)
+            else:
+                self.limit = min(settings.ingest_max_concurrency, self.limit + max(1, settings.ingest_max_concurrency // 10))
+            requests = self._admitted + self._rejected
+            self.rejection_rate = self._rejected / requests if requests else 0.0
+            self._admitted = self._rejected = 0
+            self.measured_at = time.monotonic()
+
+    async def admit(self) -> None:
+        """Admit an ingest request, or raise a 429 with a Retry-After header."""
+        await self.measure()
+        reason = self.overloaded or ("concurrency" if self.in_flight >= self.limit else None)
+        if reason is not None:
+            self._rejected += 1
+            record_rejected_ingest_request(reason)
+            raise HTTPException(
+                status_code=429,
+                detail=f"Ingestion is overloaded ({reason}), retry later.",
+                headers={"Retry-After": str(settings.ingest_retry_after)},
+            )
+        self._admitted += 1
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def stats(self) -> AdmissionStatsSchema:
+        return AdmissionStatsSchema(
+            limit=self.limit,
+            in_flight=self.in_flight,
+            overloaded=self.overloaded,
+            queue_depth=self.queue_depth,
+            pool_wait_seconds=self.pool_wait_seconds,
+            rejection_rate=self.rejection_rate,
+        )
+
+    def reset(self) -> None:
+        self.limit = settings.ingest_max_concurrency
+        self.overloaded = None
+        self.rejection_rate = 0.0
+        self.measured_at = None
+        self._admitted = self._rejected = 0
+
+
+admission = AdmissionController()
+
+async def admit_ingest() -> None:
+    """Dependency of the ingest routes, see AdmissionController. Does nothing with INGEST_ADMISSION=false."""
+    if not settings.ingest_admission:
+        yield
+        return
+    await admission.admit()
+    try:
+        yield
+    finally:
+        admission.release()
@@ -1,10 +1,21 @@
-from typing import List
+import random
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from sqlalchemy.future import select
-from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by, insert as pg_insert
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Float, FromClause, Insert, MetaData, Row, Select, String, Subquery, Table,
+    any_, bindparam, cast, column, delete, exists, extract, func, insert, literal, literal_column, or_, text, true, tuple_,
+    type_coerce, union_all, update, values,
+)
 
-from ..models import Delivery, Event, DeliveryState
+from ..models import (
+    CompactedHistory, Delivery, DeliveryCounter, Event, EventKey, QuarantinedEvent, HourlyRollup, TransitionRollup, DeliveryState,
+    DeliveryStateCode, DURATION_BUCKETS, PREVIOUS_STATES, STATE_CODES,
+)
 from ..core import settings
 
 
@@ -29,6 +40,16 @@ async def get_deliveries_by_state(db: AsyncSession, states: List[DeliveryState])
     deliveries = result.scalars().all()
     return deliveries
 
+async def read_ongoing_deliveries(db: AsyncSession) -> List[Row]:
+    """Read the id, name and status of the ongoing deliveries as rows, without loading ORM entities, ordered by id."""
+    query = (
+        select(Delivery.id, Delivery.name, Delivery.status)
+        .where(Delivery.status.in_(DeliveryState.ongoing_states()))
+        .order_by(Delivery.id)
+    )
+    result = await db.execute(query)
+    return result.all()
+
 async def read_delivery_by_name(db: AsyncSession, delivery_name: str) -> Delivery:
     """Retrieve a delivery by its name."""
     query = select(Delivery).where(Delivery.name == delivery_name)
@@ -36,6 +57,73 @@ async def read_delivery_by_name(db: AsyncSession, delivery_name: str) -> Deliver
     delivery = result.scalars().first()
     return delivery
 
+def compacted_events_query(histories: FromClause = CompactedHistory.__table__) -> Select:
+    """
+    Query the events folded into compacted histories, one row each with the id, type, delivery_id
+    and created_at columns of events. histories can be any selectable with the columns of compacted_histories.
+    """
+    event = func.unnest(histories.c.event_ids, histories.c.types, histories.c.offsets).table_valued(
+        column("id", BigInteger), column("type", DeliveryStateCode), column("elapsed", BigInteger), name="event",
+    ).render_derived().lateral()
+    created_at = histories.c.started_at + event.c.elapsed * literal_column("INTERVAL '1 microsecond'")
+    return (
+        select(event.c.id, event.c.type, histories.c.delivery_id, type_coerce(created_at, DateTime).label("created_at"))
+        .select_from(histories)
+        .join(event, true())
+    )
+
+def history_events(delivery_id=None, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Subquery:
+    """
+    Subquery of the events, rows of events and events of compacted histories alike, with id, type,
+    delivery_id and created_at, only those of delivery_id and created from start to end if given.
+    Postgres cannot push a join condition down to the compacted histories through the union, so
+    the conditions are applied to both sides: the events partitions are skipped by created_at, and
+    the histories looked up by delivery_id or skipped by their first and last events.
+    """
+    events = select(Event.id, Event.type, Event.delivery_id, Event.created_at)
+    histories = compacted_events_query()
+    if delivery_id is not None:
+        events = events.where(Event.delivery_id == delivery_id)
+        histories = histories.where(CompactedHistory.delivery_id == delivery_id)
+    if start is not None:
+        events = events.where(Event.created_at >= start)
+        histories = histories.where(CompactedHistory.ended_at >= start)
+    if end is not None:
+        events = events.where(Event.created_at < end)
+        histories = histories.where(CompactedHistory.started_at < end)
+    return union_all(events, histories).subquery("history")
+
+def export_events_query(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Select:
+    """
+    Query the events created from start to end, with the name of their delivery, ordered by (created_at, id).
+    The bounds on created_at let Postgres skip the partitions out of the range.
+    """
+    history = history_events(start=start, end=end)
+    query = (
+        select(history.c.id, history.c.delivery_id, Delivery.name, history.c.type, history.c.created_at)
+        .join(Delivery, Delivery.id == history.c.delivery_id)
+        .order_by(history.c.created_at, history.c.id)
+    )
+    if start is not None:
+        query = query.where(history.c.created_at >= start)
+    if end is not None:
+        query = query.where(history.c.created_at < end)
+    return query
+
+async def copy_query_csv(db: AsyncSession, query: Select, output: Callable[[bytes], Awaitable]) -> None:
+    """Run a query with COPY ... TO STDOUT, and pass its rows to output as CSV, chunk by chunk."""
+    connection = await db.connection()
+    compiled = query.compile(dialect=connection.dialect)
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_from_query(
+        str(compiled), *(compiled.params[name] for name in compiled.positiontup), output=output, format="csv",
+    )
+
+async def delivery_exists(db: AsyncSession, delivery_name: str) -> bool:
+    """Check whether a delivery exists."""
+    result = await db.execute(select(exists().where(Delivery.name == delivery_name)))
+    return result.scalar_one()
+
 async def update_delivery(db: AsyncSession, delivery_name: str, event_type: DeliveryState = DeliveryState.PARCEL_COLLECTED) -> Delivery:
     """Update the status of an existing delivery."""
     query = select(Delivery).where(Delivery.name == delivery_name)
@@ -70,31 +158,817 @@ async def count_total_deliveries(db: AsyncSession) -> int:
     count = result.scalar_one() 
     return count
 
-async def handle_new_delivery(db: AsyncSession, delivery_name: str, event_type: DeliveryState) -> Delivery:
-    """Handle a new delivery by creating it and ensuring the delivery history limit is respected."""
-    total_deliveries = await count_total_deliveries(db)
-    if total_deliveries >= settings.delivery_history_limit:
-        print(f"Delivery history limit reached: {settings.delivery_history_limit}. Deleting oldest delivery.")
-        oldest_delivery_query = select(Delivery).order_by(Delivery.created_at)
-        result = await db.execute(oldest_delivery_query)
-        oldest_delivery = result.scalars().first()
-        if oldest_delivery:
-            await db.delete(oldest_delivery)
-    delivery = Delivery(name=delivery_name, status=event_type)
-    db.add(delivery)
-    return delivery # Note: The delivery is not committed here, it is done in the endpoint handler.
-
-async def create_event(db: AsyncSession, delivery_name: str, event_type: DeliveryState) -> Event:
-    """Create a new event for a delivery."""
+async def create_event(db: AsyncSession, delivery_name: str, event_type: DeliveryState, created_at: Optional[datetime] = None) -> Event:
+    """Create a new event for a delivery. The database sets created_at if it is not provided."""
     delivery = await read_delivery_by_name(db, delivery_name)
     if not delivery:
         raise ValueError(f"Delivery with name {delivery_name} does not exist.")
     event = Event(delivery_id=delivery.id, type=event_type)
+    if created_at is not None:
+        event.created_at = created_at
     db.add(event)
     await db.flush()  # Persist the event to the database
     await db.refresh(event)  # Refresh the event to populate fields like id and created_at
     return event
 
+def build_delivery_events_query(after: bool) -> Select:
+    history = history_events(select(Delivery.id).where(Delivery.name == bindparam("delivery_name")).scalar_subquery())
+    query = select(history).order_by(history.c.created_at, history.c.id)
+    if after:
+        query = query.where(
+            tuple_(history.c.created_at, history.c.id) > tuple_(bindparam("after_created_at"), bindparam("after_id"))
+        )
+    return query
+
+# With the union of history_events, building the query and its cache key takes longer than running
+# it, so it is built once, with and without after, and given the parameters of each call.
+DELIVERY_EVENTS_QUERIES = {after: build_delivery_events_query(after) for after in (False, True)}
+
+def delivery_events_query(delivery_name: str, after: Optional[Tuple[datetime, int]] = None) -> Select:
+    """
+    Query the events of a delivery, ordered by (created_at, id), whether they are rows of events
+    or were folded into its compacted history.
+    If after is given, only the events after that (created_at, id) key are selected.
+    """
+    params = {"delivery_name": delivery_name}
+    if after is not None:
+        params["after_created_at"], params["after_id"] = after
+    return DELIVERY_EVENTS_QUERIES[after is not None].params(params)
+
+async def ingest_delivery_event(
+    db: AsyncSession,
+    delivery_name: str,
+    event_type: DeliveryState,
+    created_at: Optional[datetime] = None,
+    shard: Optional[int] = None,
+) -> Optional[Row]:
+    """
+    Create or update a delivery and create its event in a single statement,
+    which also updates the given shard of the delivery counters and the rollups, by default a random one.
+    The delivery is locked first, so the event is checked against its latest status.
+    An event that is not a valid transition from the current status of its delivery,
+    see TRANSITIONS, leaves the delivery unchanged and is quarantined instead.
+    Returns the created event along with the delivery name, whether the delivery
+    was inserted and its status before the event, or None if the event was quarantined.
+    """
+    ongoing_states = DeliveryState.ongoing_states()
+    state_type = Event.type.type
+    created_at = func.coalesce(literal(created_at, DateTime), func.now())
+    locked = (
+        select(Delivery.id, Delivery.status, Delivery.updated_at)
+        .where(Delivery.name == delivery_name)
+        .with_for_update()
+        .cte("locked")
+    )
+    inserted = (
+        pg_insert(Delivery)
+        .from_select(
+            ["name", "status", "updated_at"],
+            select(literal(delivery_name), literal(event_type, state_type), created_at).where(~select(locked.c.id).exists()),
+        )
+        .on_conflict_do_nothing(index_elements=[Delivery.name])
+        .returning(Delivery.id, Delivery.name)
+        .cte("inserted")
+    )
+    updated = (
+        update(Delivery)
+        .where(Delivery.id == locked.c.id, locked.c.status.in_(PREVIOUS_STATES[event_type]))
+        .values(status=event_type, updated_at=created_at)
+        .returning(Delivery.id, Delivery.name)
+        .cte("updated")
+    )
+    delivery = union_all(
+        select(inserted.c.id, inserted.c.name, true().label("inserted")),
+        select(updated.c.id, updated.c.name, literal(False).label("inserted")),
+    ).cte("delivery")
+    shard = shard if shard is not None else random_shard()
+    counters = increment_delivery_counters(
+        shard,
+        total=select(func.count()).select_from(inserted).scalar_subquery(),
+        ongoing=(
+            literal(int(event_type in ongoing_states)) * select(func.count()).select_from(delivery).scalar_subquery()
+            - select(func.count())
+            .select_from(locked)
+            .where(locked.c.status.in_(ongoing_states), select(updated.c.id).exists())
+            .scalar_subquery()
+        ),
+    ).cte("counters")
+    new_event = insert(Event).from_select(
+        ["type", "delivery_id", "created_at"],
+        select(literal(event_type, state_type), delivery.c.id, created_at),
+    ).returning(Event.id, Event.type, Event.delivery_id, Event.created_at).cte("new_event")
+    quarantined = insert(QuarantinedEvent).from_select(
+        ["delivery_name", "type", "previous_status", "created_at"],
+        select(literal(delivery_name), literal(event_type, state_type), locked.c.status, created_at)
+        .where(~select(updated.c.id).exists()),
+    ).cte("quarantined")
+    transition = select(
+        created_at.label("created_at"),
+        select(locked.c.status).scalar_subquery().label("previous_status"),
+        literal(event_type, state_type).label("status"),
+        select(locked.c.updated_at).scalar_subquery().label("previous_at"),
+    ).where(select(delivery.c.id).exists()).cte("transition")
+    hourly_rollups, transition_rollups = increment_rollups(shard, transition)
+    # A single row, with no event when the delivery was inserted by a concurrent transaction after
+    # the statement started, so that it could neither lock it nor insert it.
+    query = (
+        select(
+            new_event.c.id,
+            new_event.c.type,
+            new_event.c.delivery_id,
+            new_event.c.created_at,
+            delivery.c.name,
+            delivery.c.inserted,
+            locked.c.status.label("previous_status"),
+            (~select(locked.c.id).exists() & ~select(inserted.c.id).exists()).label("conflict"),
+        )
+        .select_from(
+            select(literal(1).label("one")).subquery("one")
+            .outerjoin(new_event, true())
+            .outerjoin(delivery, delivery.c.id == new_event.c.delivery_id)
+            .outerjoin(locked, true())
+        )
+        .add_cte(counters, quarantined, hourly_rollups.cte("hourly_rollups"), transition_rollups.cte("transition_rollups"))
+    )
+    result = (await db.execute(query)).one()
+    while result.conflict:
+        # The delivery is visible to the next statement, which locks it.
+        result = (await db.execute(query)).one()
+    return result if result.id is not None else None
+
+async def append_delivery_event(
+    db: AsyncSession,
+    delivery_id: int,
+    expected: DeliveryState,
+    event_type: DeliveryState,
+    previous_status: DeliveryState,
+    previous_at: Optional[datetime],
+    created_at: Optional[datetime] = None,
+    shard: Optional[int] = None,
+) -> Optional[Row]:
+    """
+    Create the event of a delivery whose current status, previous_status since previous_at,
+    is buffered, in a single statement that also updates the given shard of the rollups,
+    by default a random one, without writing the deliveries row: the new status stays buffered until the next flush.
+    The event is only created if the delivery still has the expected status in Postgres,
+    otherwise it changed behind the buffer, and None is returned, for ingest_event to use ingest_delivery_event instead.
+    Returns the created event along with the delivery name.
+    """
+    state_type = Event.type.type
+    created_at = func.coalesce(literal(created_at, DateTime), func.now())
+    delivery = (
+        select(Delivery.id, Delivery.name)
+        .where(Delivery.id == delivery_id, Delivery.status == expected)
+        .cte("delivery")
+    )
+    new_event = insert(Event).from_select(
+        ["type", "delivery_id", "created_at"],
+        select(literal(event_type, state_type), delivery.c.id, created_at),
+    ).returning(Event.id, Event.type, Event.delivery_id, Event.created_at).cte("new_event")
+    transition = select(
+        created_at.label("created_at"),
+        literal(previous_status, state_type).label("previous_status"),
+        literal(event_type, state_type).label("status"),
+        literal(previous_at, DateTime).label("previous_at"),
+    ).where(select(delivery.c.id).exists()).cte("transition")
+    hourly_rollups, transition_rollups = increment_rollups(shard if shard is not None else random_shard(), transition)
+    query = (
+        select(new_event.c.id, new_event.c.type, new_event.c.delivery_id, new_event.c.created_at, delivery.c.name)
+        .select_from(new_event.join(delivery, delivery.c.id == new_event.c.delivery_id))
+        .add_cte(hourly_rollups.cte("hourly_rollups"), transition_rollups.cte("transition_rollups"))
+    )
+    result = await db.execute(query)
+    return result.one_or_none()
+
+async def flush_delivery_statuses(db: AsyncSession, statuses: List[dict], shard: Optional[int] = None) -> Set[int]:
+    """
+    Set the status of many deliveries, given as delivery_id, status, updated_at and expected,
+    with a single UPDATE ... FROM (VALUES ...), which also updates the given shard of the
+    ongoing delivery counter, by default a random one.
+    A delivery whose status is no longer expected is left as is, see update_delivery_statuses.
+    Returns the ids of the updated deliveries.
+    """
+    state_type = Event.type.type
+    ongoing_states = DeliveryState.ongoing_states()
+    rows = values(
+        column("id", BigInteger), column("status", state_type), column("updated_at", DateTime), column("expected", state_type),
+        name="buffered",
+    ).data([
+        (row["delivery_id"], row["status"], row["updated_at"], row["expected"])
+        for row in sorted(statuses, key=lambda row: row["delivery_id"])
+    ])
+    updated = (
+        update(Delivery)
+        .where(Delivery.id == rows.c.id, Delivery.status == cast(rows.c.expected, state_type))
+        .values(status=cast(rows.c.status, state_type), updated_at=cast(rows.c.updated_at, DateTime))
+        .returning(Delivery.id, Delivery.status, cast(rows.c.expected, state_type).label("expected"))
+        .cte("updated")
+    )
+    counters = increment_delivery_counters(
+        shard if shard is not None else random_shard(),
+        ongoing=(
+            select(func.count()).select_from(updated).where(updated.c.status.in_(ongoing_states)).scalar_subquery()
+            - select(func.count()).select_from(updated).where(updated.c.expected.in_(ongoing_states)).scalar_subquery()
+        ),
+    ).cte("counters")
+    result = await db.execute(select(updated.c.id).add_cte(counters))
+    return set(result.scalars())
+
+async def insert_deliveries(
+    db: AsyncSession,
+    deliveries: Dict[str, Tuple[DeliveryState, Optional[datetime]]],
+    shard: Optional[int] = None,
+) -> Set[str]:
+    """
+    Insert the deliveries that do not exist yet, given as their status and updated_at by name,
+    with a single INSERT ... ON CONFLICT DO NOTHING statement, which also updates the given shard
+    of the delivery counters, by default a random one. Returns the names of the inserted deliveries.
+    """
+    # A stable row order keeps concurrent inserts from deadlocking on each other.
+    rows = [{"name": name, "status": deliveries[name][0], "updated_at": deliveries[name][1]} for name in sorted(deliveries)]
+    inserted = (
+        pg_insert(Delivery).values(rows)
+        .on_conflict_do_nothing(index_elements=[Delivery.name])
+        .returning(Delivery.name, Delivery.status)
+        .cte("inserted")
+    )
+    counters = increment_delivery_counters(
+        shard if shard is not None else random_shard(),
+        total=select(func.count()).select_from(inserted).scalar_subquery(),
+        ongoing=(
+            select(func.count()).select_from(inserted)
+            .where(inserted.c.status.in_(DeliveryState.ongoing_states()))
+            .scalar_subquery()
+        ),
+    ).cte("counters")
+    result = await db.execute(select(inserted.c.name).add_cte(counters))
+    return set(result.scalars())
+
+async def create_events(db: AsyncSession, events: List[dict]) -> List[Row]:
+    """Create many events with a multi-row INSERT. Returns the created rows in the given order."""
+    query = insert(Event).returning(
+        Event.id, Event.type, Event.delivery_id, Event.created_at,
+        sort_by_parameter_order=True,
+    )
+    result = await db.execute(query, events)
+    return result.all()
+
+async def add_to_rollups(db: AsyncSession, transitions: List[dict], shard: Optional[int] = None) -> None:
+    """
+    Add transitions, with created_at, previous_status, status and previous_at, see increment_rollups,
+    to the given shard of the rollups, by default a random one, in a single statement.
+    """
+    state_type = Event.type.type
+    rows = values(
+        column("created_at", DateTime), column("previous_status", state_type),
+        column("status", state_type), column("previous_at", DateTime),
+        name="rows",
+    ).data([
+        (transition["created_at"], transition["previous_status"], transition["status"], transition["previous_at"])
+        for transition in transitions
+    ])
+    transition = select(
+        cast(rows.c.created_at, DateTime).label("created_at"),
+        cast(rows.c.previous_status, state_type).label("previous_status"),
+        cast(rows.c.status, state_type).label("status"),
+        cast(rows.c.previous_at, DateTime).label("previous_at"),
+    ).cte("transition")
+    hourly_rollups, transition_rollups = increment_rollups(shard if shard is not None else random_shard(), transition)
+    await db.execute(hourly_rollups.add_cte(transition_rollups.cte("transition_rollups")))
+
+async def quarantine_events(db: AsyncSession, events: List[dict]) -> None:
+    """Insert events rejected as invalid transitions, with delivery_name, type, previous_status and created_at."""
+    await db.execute(insert(QuarantinedEvent), events)
+
+async def lock_deliveries(db: AsyncSession, delivery_names: List[str]) -> Dict[str, Row]:
+    """
+    Read the id, status and updated_at of the existing deliveries among delivery_names, locking them
+    in a stable order until the end of the transaction. Returns them by delivery name.
+    """
+    query = (
+        select(Delivery.id, Delivery.name, Delivery.status, Delivery.updated_at)
+        .where(Delivery.name == any_(literal(sorted(delivery_names), ARRAY(String))))
+        .order_by(Delivery.name)
+        .with_for_update()
+    )
+    result = await db.execute(query)
+    return {row.name: row for row in result}
+
+async def lock_delivery_statuses(db: AsyncSession, delivery_names: List[str]) -> Dict[str, DeliveryState]:
+    """Read the status of the existing deliveries among delivery_names, locked as by lock_deliveries."""
+    return {name: delivery.status for name, delivery in (await lock_deliveries(db, delivery_names)).items()}
+
+def delivery_histories_query() -> Select:
+    """
+    Query the events of all the deliveries, compacted histories included, with the delivery name and status,
+    ordered by delivery then (created_at, id).
+    """
+    history = history_events()
+    return (
+        select(history, Delivery.name, Delivery.status)
+        .join(Delivery, Delivery.id == history.c.delivery_id)
+        .order_by(history.c.delivery_id, history.c.created_at, history.c.id)
+    )
+
+async def move_events_to_quarantine(db: AsyncSession, events: List[dict]) -> None:
+    """
+    Move events, with id, delivery_name, type, previous_status and created_at, from events to quarantined_events.
+    The compacted histories of their deliveries are expanded first, see expand_compacted_histories.
+    """
+    await expand_compacted_histories(db, list({event["delivery_name"] for event in events}))
+    await quarantine_events(db, [{key: value for key, value in event.items() if key != "id"} for event in events])
+    await db.execute(delete(Event).where(Event.id.in_([event["id"] for event in events])))
+
+async def repair_delivery_statuses(db: AsyncSession) -> int:
+    """
+    Set each ongoing delivery to the status of its last event created after its updated_at,
+    e.g. a status buffered by the write-behind mode and lost with its process, in a single statement.
+    The delivery counters are left as is. Returns the number of repaired deliveries.
+    """
+    delivery = aliased(Delivery)
+    last = (
+        select(Event.type, Event.created_at)
+        .where(
+            Event.delivery_id == delivery.id,
+            or_(delivery.updated_at.is_(None), Event.created_at > delivery.updated_at),
+        )
+        .order_by(Event.created_at.desc(), Event.id.desc())
+        .limit(1)
+        .lateral("last")
+    )
+    repaired = (
+        select(delivery.id, last.c.type, last.c.created_at)
+        .join(last, true())
+        .where(delivery.status.in_(DeliveryState.ongoing_states()))
+        .subquery("repaired")
+    )
+    result = await db.execute(
+        update(Delivery)
+        .where(Delivery.id == repaired.c.id)
+        .values(status=repaired.c.type, updated_at=repaired.c.created_at)
+    )
+    return result.rowcount
+
+async def update_delivery_statuses(db: AsyncSession, statuses: List[dict]) -> None:
+    """
+    Set the status of deliveries, given as delivery_id, status, updated_at and expected, with a single executemany.
+    A delivery whose status is no longer expected, as it changed since it was read, is left as is.
+    """
+    deliveries = Delivery.__table__
+    query = (
+        update(deliveries)
+        .where(deliveries.c.id == bindparam("delivery_id"), deliveries.c.status == bindparam("expected"))
+        .values(status=bindparam("new_status"), updated_at=bindparam("new_updated_at"))
+    )
+    await db.execute(query, [
+        {
+            "delivery_id": row["delivery_id"], "expected": row["expected"],
+            "new_status": row["status"], "new_updated_at": row["updated_at"],
+        }
+        for row in statuses
+    ])
+
+async def claim_event_keys(db: AsyncSession, keys: List[str]) -> Set[str]:
+    """
+    Insert the dedupe keys of events about to be ingested, in a stable order so that concurrent
+    claims do not deadlock. Returns the keys that were inserted. The others belong to events
+    already ingested, or ingested by a concurrent transaction that this one waited for.
+    """
+    query = pg_insert(EventKey).values([{"key": key} for key in sorted(keys)])
+    result = await db.execute(query.on_conflict_do_nothing().returning(EventKey.key))
+    return set(result.scalars())
+
+async def delete_expired_event_keys(db: AsyncSession, created_before: datetime) -> int:
+    """Delete the event keys created before created_before. Returns their number."""
+    result = await db.execute(delete(EventKey).where(EventKey.created_at < created_before))
+    return result.rowcount
+
+# Staging table of the imported events, dropped at the end of the import transaction.
+event_import = Table(
+    "event_import",
+    MetaData(),
+    Column("seq", BigInteger, nullable=False),
+    Column("delivery_name", String, nullable=False),
+    Column("type", DeliveryStateCode, nullable=False),
+    Column("created_at", DateTime),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+async def copy_imported_events(db: AsyncSession, records: List[Tuple[int, str, str, Optional[datetime]]]) -> None:
+    """
+    Create the staging table of the transaction and load the (seq, delivery_name, type, created_at)
+    records in it with COPY, which is much faster than INSERT for large numbers of rows.
+    COPY bypasses the column types, so the types are written as their STATE_CODES.
+    """
+    connection = await db.connection()
+    await connection.run_sync(event_import.create)
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        event_import.name,
+        records=[(seq, name, STATE_CODES[DeliveryState(type)], created_at) for seq, name, type, created_at in records],
+        columns=[column.name for column in event_import.columns],
+    )
+
+async def merge_imported_events(db: AsyncSession) -> Row:
+    """
+    Merge the staged events into the deliveries and events in a single statement,
+    which also updates the delivery counters and the rollups.
+    Events are inserted in seq order, and each delivery gets the status of its last event.
+    Events without created_at are stamped with the transaction time.
+    Returns the number of upserted deliveries and of inserted events.
+    """
+    ongoing_states = DeliveryState.ongoing_states()
+    created_at = func.coalesce(event_import.c.created_at, func.now())
+    ranked = select(
+        event_import.c.delivery_name,
+        event_import.c.type,
+        created_at.label("created_at"),
+        func.row_number().over(partition_by=event_import.c.delivery_name, order_by=event_import.c.seq.desc()).label("rank"),
+    ).subquery("ranked")
+    last = (
+        select(ranked.c.delivery_name, ranked.c.type, ranked.c.created_at)
+        .where(ranked.c.rank == 1)
+        .cte("last")
+    )
+    previous = (
+        select(Delivery.name, Delivery.status, Delivery.updated_at)
+        .where(Delivery.name.in_(select(last.c.delivery_name)))
+        .cte("previous")
+    )
+    # A stable row order keeps concurrent upserts from deadlocking on each other.
+    upsert = pg_insert(Delivery).from_select(
+        ["name", "status", "updated_at"],
+        select(last.c.delivery_name, last.c.type, last.c.created_at).order_by(last.c.delivery_name),
+    )
+    deliveries = upsert.on_conflict_do_update(
+        index_elements=[Delivery.name],
+        set_={"status": upsert.excluded.status, "updated_at": upsert.excluded.updated_at},
+    ).returning(Delivery.id, Delivery.name, literal_column("xmax = 0").label("inserted")).cte("upserted")
+    shard = random_shard()
+    counters = increment_delivery_counters(
+        shard,
+        total=select(func.count()).select_from(deliveries).where(deliveries.c.inserted).scalar_subquery(),
+        ongoing=(
+            select(func.count()).select_from(last).where(last.c.type.in_(ongoing_states)).scalar_subquery()
+            - select(func.count()).select_from(previous).where(previous.c.status.in_(ongoing_states)).scalar_subquery()
+        ),
+    ).cte("counters")
+    new_events = insert(Event).from_select(
+        ["type", "delivery_id", "created_at"],
+        select(event_import.c.type, deliveries.c.id, func.coalesce(event_import.c.created_at, func.now()))
+        .join(deliveries, deliveries.c.name == event_import.c.delivery_name)
+        .order_by(event_import.c.seq),
+    ).returning(Event.id).cte("new_events")
+    window = {"partition_by": event_import.c.delivery_name, "order_by": event_import.c.seq}
+    transitions = (
+        select(
+            created_at.label("created_at"),
+            func.coalesce(func.lag(event_import.c.type).over(**window), previous.c.status).label("previous_status"),
+            event_import.c.type.label("status"),
+            func.coalesce(func.lag(created_at).over(**window), previous.c.updated_at).label("previous_at"),
+        )
+        .select_from(event_import.outerjoin(previous, previous.c.name == event_import.c.delivery_name))
+        .cte("transitions")
+    )
+    hourly_rollups, transition_rollups = increment_rollups(shard, transitions)
+    query = select(
+        select(func.count()).select_from(deliveries).scalar_subquery().label("deliveries"),
+        select(func.count()).select_from(new_events).scalar_subquery().label("events"),
+    ).add_cte(counters, hourly_rollups.cte("hourly_rollups"), transition_rollups.cte("transition_rollups"))
+    result = await db.execute(query)
+    return result.one()
+
+async def delete_oldest_deliveries(db: AsyncSession, count: int, created_before: Optional[datetime] = None) -> Row:
+    """
+    Delete up to count of the oldest deliveries and their events in a single statement,
+    which also updates the delivery counters.
+    If created_before is given, only deliveries created before it are deleted.
+    Returns the names of the deleted deliveries, None if there are none, and the number of deleted events.
+    """
+    query = select(Delivery.id)
+    if created_before is not None:
+        query = query.where(Delivery.created_at < created_before)
+    oldest = query.order_by(Delivery.created_at, Delivery.id).limit(count).cte("oldest")
+    deleted_events = (
+        delete(Event)
+        .where(Event.delivery_id.in_(select(oldest.c.id)))
+        .returning(Event.id)
+        .cte("deleted_events")
+    )
+    deleted = (
+        delete(Delivery)
+        .where(Delivery.id.in_(select(oldest.c.id)))
+        .returning(Delivery.name, Delivery.status)
+        .cte("deleted")
+    )
+    counters = increment_delivery_counters(
+        random_shard(),
+        total=-select(func.count()).select_from(deleted).scalar_subquery(),
+        ongoing=-(
+            select(func.count())
+            .select_from(deleted)
+            .where(deleted.c.status.in_(DeliveryState.ongoing_states()))
+            .scalar_subquery()
+        ),
+    ).cte("counters")
+    deleted_histories = (
+        delete(CompactedHistory)
+        .where(CompactedHistory.delivery_id.in_(select(oldest.c.id)))
+        .returning(func.cardinality(CompactedHistory.event_ids).label("events"))
+        .cte("deleted_histories")
+    )
+    query = select(
+        select(func.array_agg(deleted.c.name)).scalar_subquery().label("names"),
+        (
+            select(func.count()).select_from(deleted_events).scalar_subquery()
+            + select(func.coalesce(func.sum(deleted_histories.c.events), 0)).scalar_subquery()
+        ).label("events"),
+    ).add_cte(counters)
+    result = await db.execute(query)
+    return result.one()
+
+async def compact_histories(db: AsyncSession, count: int, finished_before: datetime) -> Row:
+    """
+    Fold the events of up to count finished deliveries, whose status was set before finished_before,
+    into one compacted history each, in a single statement that deletes their rows from events.
+    The deliveries are locked, skipping those locked by ingestion or another compactor. A delivery
+    already compacted is left out: the events added to it since, e.g. by an import, stay rows.
+    Returns the number of compacted deliveries and events.
+    """
+    finished = (
+        select(Delivery.id)
+        .where(
+            Delivery.status.in_([state for state in DeliveryState if state.is_terminal]),
+            Delivery.updated_at < finished_before,
+            exists().where(Event.delivery_id == Delivery.id),
+            ~exists().where(CompactedHistory.delivery_id == Delivery.id),
+        )
+        .order_by(Delivery.id)
+        .limit(count)
+        .with_for_update(skip_locked=True)
+        .cte("finished")
+    )
+    moved = (
+        delete(Event)
+        .where(Event.delivery_id.in_(select(finished.c.id)))
+        .returning(Event.id, Event.type, Event.delivery_id, Event.created_at)
+        .cte("moved")
+    )
+    timeline = select(
+        moved, func.min(moved.c.created_at).over(partition_by=moved.c.delivery_id).label("started_at"),
+    ).subquery("timeline")
+    order = (timeline.c.created_at, timeline.c.id)
+    elapsed = cast(extract("epoch", timeline.c.created_at - timeline.c.started_at) * 1000000, BigInteger)
+    histories = (
+        insert(CompactedHistory)
+        .from_select(
+            ["delivery_id", "started_at", "ended_at", "event_ids", "types", "offsets"],
+            select(
+                timeline.c.delivery_id, func.min(timeline.c.started_at), func.max(timeline.c.created_at),
+                func.array_agg(aggregate_order_by(timeline.c.id, *order)),
+                func.array_agg(aggregate_order_by(timeline.c.type, *order)),
+                func.array_agg(aggregate_order_by(elapsed, *order)),
+            ).group_by(timeline.c.delivery_id),
+        )
+        .returning(func.cardinality(CompactedHistory.event_ids).label("events"))
+        .cte("histories")
+    )
+    query = select(
+        func.count().label("deliveries"), cast(func.coalesce(func.sum(histories.c.events), 0), BigInteger).label("events"),
+    ).select_from(histories)
+    result = await db.execute(query)
+    return result.one()
+
+async def expand_compacted_histories(db: AsyncSession, delivery_names: List[str]) -> int:
+    """Move the compacted histories of deliveries back into rows of events, e.g. to remove some of their events. Returns the number of events."""
+    expanded = (
+        delete(CompactedHistory)
+        .where(CompactedHistory.delivery_id.in_(select(Delivery.id).where(Delivery.name.in_(delivery_names))))
+        .returning(*CompactedHistory.__table__.c)
+        .cte("expanded")
+    )
+    result = await db.execute(
+        insert(Event).from_select(["id", "type", "delivery_id", "created_at"], compacted_events_query(expanded))
+    )
+    return result.rowcount
+
+async def read_event_partitions(db: AsyncSession) -> List[Row]:
+    """Read the name and the bound expression of each partition of the events table."""
+    query = text(
+        "SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound "
+        "FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = CAST(:table AS regclass)"
+    )
+    result = await db.execute(query, {"table": Event.__tablename__})
+    return result.all()
+
+async def create_event_partition(db: AsyncSession, name: str, start: datetime, end: datetime) -> int:
+    """
+    Create the partition of the events created from start to end.
+    The partition is filled with the matching events of the default partition, then attached,
+    which only locks out the ingestion of events briefly, unlike creating it as a partition.
+    Returns the number of events moved from the default partition.
+    """
+    table = Event.__tablename__
+    await db.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)"))
+    moved = await db.execute(
+        text(
+            f"WITH moved AS (DELETE FROM {table}_default WHERE created_at >= :start AND created_at < :end RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ),
+        {"start": start, "end": end},
+    )
+    await db.execute(text(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    ))
+    return moved.rowcount
+
+async def drop_event_partition(db: AsyncSession, name: str, detach: bool = False) -> None:
+    """
+    Detach a partition of the events table, then drop it unless detach is set.
+    Gives up after lock_timeout rather than queueing the ingestion behind the lock.
+    """
+    await db.execute(text("SET LOCAL lock_timeout = '1s'"))
+    await db.execute(text(f"ALTER TABLE {Event.__tablename__} DETACH PARTITION {name}"))
+    if not detach:
+        await db.execute(text(f"DROP TABLE {name}"))
+
+async def delete_default_partition_events(db: AsyncSession, created_before: datetime) -> int:
+    """Delete the events of the default partition created before created_before. Returns their number."""
+    result = await db.execute(
+        text(f"DELETE FROM {Event.__tablename__}_default WHERE created_at < :created_before"),
+        {"created_before": created_before},
+    )
+    return result.rowcount
+
+def partition_shard(partition: int) -> int:
+    """
+    Shard of the delivery counters and rollups updated by the consumer of a queue partition.
+    Consumers of different partitions do not share a shard while there are more shards than
+    partitions, so they never wait on each other's counters.
+    """
+    return partition % settings.delivery_counter_shards
+
+def random_shard() -> int:
+    """
+    Shard of the delivery counters and rollups for the transactions other than the queue consumers,
+    out of the shards of the consumers when there are enough shards.
+    """
+    reserved = settings.ingest_queue_partitions if settings.delivery_counter_shards > settings.ingest_queue_partitions else 0
+    return random.randrange(reserved, settings.delivery_counter_shards)
+
+def increment_delivery_counters(shard: int, **deltas) -> Insert:
+    """
+    Statement adding deltas to the given shard of the delivery counters.
+    Deltas can be SQL expressions, so the statement can be used as a CTE of an ingest statement.
+    """
+    rows = union_all(*(select(literal(name), literal(shard), delta) for name, delta in deltas.items()))
+    query = pg_insert(DeliveryCounter).from_select(["name", "shard", "value"], rows)
+    return query.on_conflict_do_update(
+        index_elements=[DeliveryCounter.name, DeliveryCounter.shard],
+        set_={"value": DeliveryCounter.value + query.excluded.value},
+    )
+
+async def read_delivery_counters(db: AsyncSession) -> Dict[str, int]:
+    """Read the ongoing and total delivery counters, summing their shards."""
+    query = select(DeliveryCounter.name, func.sum(DeliveryCounter.value)).group_by(DeliveryCounter.name)
+    result = await db.execute(query)
+    return {"ongoing": 0, "total": 0, **{name: value for name, value in result}}
+
+async def rebuild_delivery_counters(db: AsyncSession) -> Dict[str, int]:
+    """
+    Rebuild the delivery counters from the deliveries table.
+    The counters table is locked so that no ingest updates the counters while they are rebuilt.
+    """
+    await db.execute(text(f"LOCK TABLE {DeliveryCounter.__tablename__} IN EXCLUSIVE MODE"))
+    await db.execute(delete(DeliveryCounter))
+    ongoing = await count_deliveries_by_state(db, DeliveryState.ongoing_states())
+    total = await count_total_deliveries(db)
+    await db.execute(increment_delivery_counters(0, total=literal(total), ongoing=literal(ongoing)))
+    return {"ongoing": ongoing, "total": total}
+
+def increment_rollups(shard: int, transitions) -> Tuple[Insert, Insert]:
+    """
+    Statements adding the rows of transitions, a CTE with the created_at, previous_status and status
+    of events and previous_at, when the previous status was set, to the given shard of the hourly
+    and transition rollups. previous_status is None for the event that created its delivery.
+    Rows are grouped, and sorted so that the rollups are updated in a stable order.
+    Like increment_delivery_counters, they can be used as CTEs of an ingest statement.
+    """
+    hour = func.date_trunc("hour", transitions.c.created_at)
+    hourly = (
+        select(
+            hour, transitions.c.status, literal(shard),
+            func.count(), func.count().filter(transitions.c.previous_status.is_(None)),
+        )
+        .group_by(hour, transitions.c.status)
+        .order_by(hour, transitions.c.status)
+    )
+    hourly_query = pg_insert(HourlyRollup).from_select(["hour", "status", "shard", "events", "deliveries"], hourly)
+    hourly_query = hourly_query.on_conflict_do_update(
+        index_elements=[HourlyRollup.hour, HourlyRollup.status, HourlyRollup.shard],
+        set_={
+            "events": HourlyRollup.events + hourly_query.excluded.events,
+            "deliveries": HourlyRollup.deliveries + hourly_query.excluded.deliveries,
+        },
+    )
+    # Events received out of order spent no time in the previous state.
+    seconds = func.greatest(cast(extract("epoch", transitions.c.created_at - transitions.c.previous_at), Float), 0.0)
+    bucket = func.width_bucket(seconds, literal(DURATION_BUCKETS, ARRAY(Float)))
+    pairs = (
+        select(hour, transitions.c.previous_status, transitions.c.status, bucket, literal(shard), func.count(), func.sum(seconds))
+        .where(transitions.c.previous_status.is_not(None), transitions.c.previous_at.is_not(None))
+        .group_by(hour, transitions.c.previous_status, transitions.c.status, bucket)
+        .order_by(hour, transitions.c.previous_status, transitions.c.status, bucket)
+    )
+    pairs_query = pg_insert(TransitionRollup).from_select(
+        ["hour", "previous_status", "status", "bucket", "shard", "events", "seconds"], pairs,
+    )
+    pairs_query = pairs_query.on_conflict_do_update(
+        index_elements=[
+            TransitionRollup.hour, TransitionRollup.previous_status, TransitionRollup.status,
+            TransitionRollup.bucket, TransitionRollup.shard,
+        ],
+        set_={
+            "events": TransitionRollup.events + pairs_query.excluded.events,
+            "seconds": TransitionRollup.seconds + pairs_query.excluded.seconds,
+        },
+    )
+    return hourly_query, pairs_query
+
+async def rebuild_rollups(db: AsyncSession, start: Optional[datetime] = None) -> int:
+    """
+    Rebuild the rollups from the events, only those of the hours from start if given,
+    which keeps the rollups of the events since pruned. The rollups are locked so that
+    no ingest updates them while they are rebuilt. Returns the number of events rolled up.
+    """
+    for table in (HourlyRollup.__tablename__, TransitionRollup.__tablename__):
+        await db.execute(text(f"LOCK TABLE {table} IN EXCLUSIVE MODE"))
+    hour = start.replace(minute=0, second=0, microsecond=0) if start is not None else None
+    for model in (HourlyRollup, TransitionRollup):
+        query = delete(model)
+        if hour is not None:
+            query = query.where(model.hour >= hour)
+        await db.execute(query)
+    events = history_events()
+    window = {"partition_by": events.c.delivery_id, "order_by": (events.c.created_at, events.c.id)}
+    history = select(
+        events.c.created_at,
+        func.lag(events.c.type).over(**window).label("previous_status"),
+        events.c.type.label("status"),
+        func.lag(events.c.created_at).over(**window).label("previous_at"),
+    )
+    transitions = history.cte("transitions")
+    if hour is not None:
+        # The window runs over whole histories, so the first event from start still has its previous one.
+        history = history.subquery("history")
+        transitions = select(history).where(history.c.created_at >= hour).cte("transitions")
+    hourly_rollups, transition_rollups = increment_rollups(0, transitions)
+    query = (
+        select(func.count())
+        .select_from(transitions)
+        .add_cte(hourly_rollups.cte("hourly_rollups"), transition_rollups.cte("transition_rollups"))
+    )
+    result = await db.execute(query)
+    return result.scalar_one()
+
+async def read_hourly_rollups(db: AsyncSession, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Row]:
+    """Read the number of events and created deliveries of each state in the hours from start to end, summing the hours and shards."""
+    query = select(
+        HourlyRollup.status,
+        cast(func.sum(HourlyRollup.events), BigInteger).label("events"),
+        cast(func.sum(HourlyRollup.deliveries), BigInteger).label("deliveries"),
+    ).group_by(HourlyRollup.status)
+    if start is not None:
+        query = query.where(HourlyRollup.hour >= start)
+    if end is not None:
+        query = query.where(HourlyRollup.hour < end)
+    result = await db.execute(query)
+    return result.all()
+
+async def read_transition_rollups(db: AsyncSession, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Row]:
+    """
+    Read the number of transitions and the seconds spent in the previous state, by state pair and
+    duration bucket, in the hours from start to end, summing the hours and shards.
+    """
+    columns = (TransitionRollup.previous_status, TransitionRollup.status, TransitionRollup.bucket)
+    query = (
+        select(
+            *columns,
+            cast(func.sum(TransitionRollup.events), BigInteger).label("events"),
+            func.sum(TransitionRollup.seconds).label("seconds"),
+        )
+        .group_by(*columns)
+        .order_by(*columns)
+    )
+    if start is not None:
+        query = query.where(TransitionRollup.hour >= start)
+    if end is not None:
+        query = query.where(TransitionRollup.hour < end)
+    result = await db.execute(query)
+    return result.all()
+
 async def read_event(db: AsyncSession, event_id: int) -> Event:
     """Retrieve an event by its ID."""
     event = await db.query(Event).filter(Event.id == event_id).first()
@@ -1,48 +1,221 @@
-from typing import List
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, List, Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Path, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..schemas import EventSchema, DeliverySchema, EventOutputSchema
-from ..services import count_deliveries, get_delivery_events, get_ongoing_deliveries
-from ..db.database import get_db
-from ..event_queue import process_event
+from ..schemas import (
+    EventSchema, DeliverySchema, DeliveryCountSchema, EventOutputSchema, EventAcceptedSchema, QueueStatsSchema,
+    EventBatchSchema, EventBatchResultSchema, RetentionReportSchema, AnalyticsSchema, EventType, AdmissionStatsSchema,
+)
+from ..services import (
+    count_deliveries,
+    get_delivery_events,
+    stream_delivery_events,
+    encode_cursor,
+    decode_cursor,
+    get_ongoing_deliveries_snapshot,
+    ingest_events,
+    ingest_transaction,
+    delivery_feed,
+    export_events,
+    EXPORT_FORMATS,
+    get_analytics,
+)
+from ..core import settings
+from ..models import DELIVERY_NAME_MAX_LENGTH
+from ..db.database import get_db, get_read_db
+from ..event_queue import process_event, get_queue_stats
+from ..admission import admission, admit_ingest
+from .. import retention
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-@router.get("/deliveries")
-async def ongoing_deliveries(db: AsyncSession = Depends(get_db)) -> List[DeliverySchema]:
-    """Get all ongoing deliveries."""
+@router.get("/deliveries", response_model=List[DeliverySchema])
+async def ongoing_deliveries(request: Request, db: AsyncSession = Depends(get_db)) -> Response:
+    """Get all ongoing deliveries.
+    They are served from the delivery cache, with an ETag for conditional requests.
+    A cold cache is warmed from the primary, as a replica could be behind the changes applied to it."""
     try:
-        deliveries = await get_ongoing_deliveries(db)
-        return deliveries
+        snapshot = await get_ongoing_deliveries_snapshot(db)
+        if request.headers.get("if-none-match") == snapshot.etag:
+            return Response(status_code=304, headers={"ETag": snapshot.etag})
+        return Response(content=snapshot.body, media_type="application/json", headers={"ETag": snapshot.etag})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching ongoing deliveries: {str(e)}")
 
-@router.post("/deliveries/{id}/events")
-async def create_event(id: str, event: EventSchema, db: AsyncSession = Depends(get_db)) -> EventOutputSchema:
-    """Ingest an event for a delivery. If the delivery does not exist, create it.
-    If the delivery exists, update its status and create a new event."""
+@router.get("/deliveries/feed")
+async def deliveries_feed(
+    name: Optional[str] = Query(None, description="Only send the transitions of this delivery"),
+    state: Optional[EventType] = Query(None, description="Only send the transitions to this state"),
+) -> StreamingResponse:
+    """Stream the delivery transitions as they are committed, as server-sent events.
+    A client that does not keep up gets a dropped event and the stream ends.
+    While Redis cannot be subscribed to, the request is rejected with a 503."""
+    try:
+        subscription = await delivery_feed.subscribe(name, state.value if state else None)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="The delivery feed is unavailable.")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error subscribing to the delivery feed: {str(e)}")
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), settings.feed_heartbeat_interval)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    yield "event: dropped\ndata: {}\n\n"
+                    return
+                yield f"event: transition\ndata: {message}\n\n"
+        finally:
+            delivery_feed.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.post("/deliveries/{id}/events", status_code=202, dependencies=[Depends(admit_ingest)])
+async def create_event(
+    event: EventSchema,
+    id: str = Path(..., max_length=DELIVERY_NAME_MAX_LENGTH),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", min_length=1, max_length=200),
+) -> EventAcceptedSchema:
+    """Accept an event for a delivery and queue it for ingestion.
+    Queued events are ingested in order per delivery by the background consumers.
+    Copies of an event, with the same Idempotency-Key or otherwise the same type and
+    created_at, are acknowledged as duplicates and ingested once.
+    When ingestion is overloaded, the event is rejected with a 429 and a Retry-After header."""
+    if idempotency_key is not None:
+        event = event.model_copy(update={"idempotency_key": idempotency_key})
     try:
-        async with db.begin():
-            ingested_event = await process_event(id, event, db)
-            return ingested_event
+        accepted_event = await process_event(id, event)
+        return accepted_event
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing event: {str(e)}")
 
-@router.get("/deliveries/{id}/events")
-async def get_events(id: str, db: AsyncSession = Depends(get_db)) -> List[EventOutputSchema]:
-    """Get all events for a specific delivery by its ID."""
-    delivery_events = await get_delivery_events(db, id)
-    if not delivery_events:
+@router.post("/events/batch", dependencies=[Depends(admit_ingest)])
+async def create_events_batch(batch: EventBatchSchema, db: AsyncSession = Depends(get_db)) -> EventBatchResultSchema:
+    """Ingest many events of many deliveries at once, in order.
+    Deliveries that do not exist are created, the others get the status of their last event.
+    Copies of already ingested events are reported as duplicates and left out.
+    When ingestion is overloaded, the batch is rejected with a 429 and a Retry-After header."""
+    try:
+        async with ingest_transaction(db):
+            results = await ingest_events(db, batch.events)
+        return EventBatchResultSchema(items=results)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing events: {str(e)}")
+
+@router.get("/deliveries/{id}/events", response_model=List[EventOutputSchema])
+async def get_events(
+    id: str,
+    request: Request,
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of events to return"),
+    after: Optional[str] = Query(None, description="Cursor returned in X-Next-Cursor by the previous page"),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Get the events for a specific delivery by its ID, ordered by creation, one page at a time.
+    When there may be more events, X-Next-Cursor holds the cursor of the next page.
+    With Accept: application/x-ndjson, all the events after the cursor are streamed instead."""
+    try:
+        cursor = decode_cursor(after) if after else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        lines = await stream_delivery_events(db, id, cursor)
+        if lines is None:
+            raise HTTPException(status_code=404, detail="No events found for this delivery.")
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+    page = await get_delivery_events(db, id, limit, cursor)
+    if page is None:
         raise HTTPException(status_code=404, detail="No events found for this delivery.")
-    return delivery_events
+    headers = {"X-Next-Cursor": encode_cursor(page.last)} if page.count == limit else {}
+    return Response(content=page.body, media_type="application/json", headers=headers)
+
+@router.get("/events/export")
+async def export_events_file(
+    start: Optional[datetime] = Query(None, description="Only export the events created from this time"),
+    end: Optional[datetime] = Query(None, description="Only export the events created before this time"),
+    format: Literal["parquet", "arrow"] = Query("parquet", description="Parquet or Arrow IPC file"),
+    db: AsyncSession = Depends(get_read_db),
+) -> StreamingResponse:
+    """Stream the events of a time range, with the name of their delivery, as a columnar file.
+    Delivery states are dictionary encoded, and events are written chunk by chunk.
+    The first chunk is read before responding, so that a failing export gets a 500."""
+    chunks = export_events(db, start, end, format)
+    try:
+        first = await anext(chunks)
+    except Exception as e:
+        await chunks.aclose()
+        raise HTTPException(status_code=500, detail=f"Error exporting events: {str(e)}")
+
+    async def stream() -> AsyncIterator[bytes]:
+        yield first
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception:
+            # Too late for an error status: the connection is aborted, so the client sees a truncated file.
+            logger.exception("Error exporting events, aborting the response.")
+            raise
+
+    return StreamingResponse(
+        stream(),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="events.{format}"'},
+    )
 
 @router.get("/deliveries/counts")
-async def count_ongoing_deliveries(db: AsyncSession = Depends(get_db)) -> DeliverySchema:
+async def count_ongoing_deliveries(db: AsyncSession = Depends(get_read_db)) -> DeliveryCountSchema:
     """Get the total number of ongoing deliveries and total deliveries since the beginning."""
     try:
         ongoing_delivery_count = await count_deliveries(db)
         return ongoing_delivery_count
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error counting deliveries: {str(e)}")
+
+@router.get("/analytics")
+async def analytics(
+    start: Optional[datetime] = Query(None, description="Only count the hours from this time"),
+    end: Optional[datetime] = Query(None, description="Only count the hours before this time"),
+    db: AsyncSession = Depends(get_read_db),
+) -> AnalyticsSchema:
+    """Get the crash and success rates, flight legs and time-in-state distributions of the fleet.
+    They are read from the hourly rollups that ingestion keeps up to date, never from the events."""
+    try:
+        return await get_analytics(db, start, end)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error computing analytics: {str(e)}")
+
+@router.get("/queue/stats")
+async def queue_stats() -> QueueStatsSchema:
+    """Get the depth and lag of the ingest queue."""
+    try:
+        return await get_queue_stats()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading queue stats: {str(e)}")
+
+@router.get("/ingest/admission")
+async def admission_stats() -> AdmissionStatsSchema:
+    """Get the current limit, load and rejection rate of the ingest admission control."""
+    return admission.stats()
+
+@router.get("/retention/stats")
+async def retention_stats() -> RetentionReportSchema:
+    """Get the outcome of the last retention run."""
+    if retention.last_report is None:
+        raise HTTPException(status_code=404, detail="Retention has not run yet.")
+    return retention.last_report
+
+@router.get("/metrics")
+async def metrics() -> Response:
+    """Expose the request, SQL, connection pool and ingestion metrics in the Prometheus format."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,141 @@
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+import typer
+
+from .api.crud import rebuild_delivery_counters, rebuild_rollups as _rebuild_rollup_tables
+from .compaction import compact
+from .db import AsyncSessionLocal, engine
+from .importer import FORMATS, guess_format, import_events as _import_events, open_events
+from .revalidation import revalidate_events as _revalidate_events
+from .services import EXPORT_FORMATS, export_events as _export_events
+
+cli = typer.Typer()
+
+
+@cli.callback()
+def main():
+    """Maintenance commands of the event collector."""
+
+
+def run(coroutine):
+    """Run a coroutine and release the database connections afterwards."""
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await engine.dispose()
+    return asyncio.run(main())
+
+
+async def _reconcile_counters() -> dict:
+    async with AsyncSessionLocal() as db:
+        async with db.begin():
+            return await rebuild_delivery_counters(db)
+
+
+@cli.command()
+def reconcile_counters():
+    """Rebuild the ongoing and total delivery counters from the deliveries table,
+    e.g. after a crash or if the counters drifted."""
+    counters = run(_reconcile_counters())
+    typer.echo(f"Delivery counters rebuilt: {counters['ongoing']} ongoing, {counters['total']} total.")
+
+
+async def _rebuild_rollups(start: Optional[datetime]) -> int:
+    async with AsyncSessionLocal() as db:
+        async with db.begin():
+            return await _rebuild_rollup_tables(db, start)
+
+
+@cli.command()
+def rebuild_rollups(
+    start: Optional[datetime] = typer.Option(None, help="Only rebuild the hours from this time, UTC"),
+):
+    """Rebuild the hourly and transition rollups served by /analytics from the events,
+    e.g. to fill them for the events ingested before they existed. The rollups of the
+    hours before start are kept, including those of events since pruned."""
+    events = run(_rebuild_rollups(start))
+    typer.echo(f"Rollups rebuilt from {events} events.")
+
+
+
+@cli.command()
+def import_events(
+    path: str = typer.Argument(..., help="Event log to import, - for the standard input"),
+    format: Optional[str] = typer.Option(None, help="ndjson or csv, guessed from the file extension by default"),
+    chunk_size: int = typer.Option(50000, help="Events copied and merged per transaction"),
+):
+    """Replay an NDJSON or CSV event log, e.g. the events buffered during an outage,
+    with COPY into a staging table and set-based merges into the deliveries and events.
+    With the memory delivery cache, restart the collector afterwards to refresh it."""
+    format = format or guess_format(path)
+    if format not in FORMATS:
+        raise typer.BadParameter(f"Unknown format: {format}")
+    with open_events(path) as file:
+        report = run(_import_events(file, format, chunk_size))
+    rate = report.events / report.seconds if report.seconds else 0
+    typer.echo(
+        f"Imported {report.events} events in {report.seconds:.1f}s ({rate:.0f} rows/s), "
+        f"{report.rejected} rejected, {report.quarantined} quarantined as invalid transitions, "
+        f"{report.duplicates} skipped as copies of ingested events."
+    )
+
+
+
+@cli.command()
+def compact_histories(
+    delay: Optional[float] = typer.Option(None, help="Only compact the deliveries finished this many seconds ago, COMPACTION_DELAY by default"),
+):
+    """Fold the events of the finished deliveries into one compacted history each, as the
+    collector does every COMPACTION_INTERVAL seconds. Their events are still served as before."""
+    report = run(compact(delay=delay))
+    typer.echo(f"Compacted the histories of {report.deliveries} deliveries, {report.events} events, in {report.seconds:.1f}s.")
+
+
+
+@cli.command()
+def revalidate_events(
+    dry_run: bool = typer.Option(False, help="Only count the invalid events"),
+    chunk_size: int = typer.Option(10000, help="Invalid events moved per transaction"),
+):
+    """Check the history of every delivery against the allowed transitions, e.g. for the events
+    ingested before they were validated. Invalid events are moved to quarantined_events, the
+    deliveries get the state of their last valid event, and the delivery counters and rollups are rebuilt.
+    With the memory delivery cache, restart the collector afterwards to refresh it."""
+    report = run(_revalidate_events(dry_run=dry_run, chunk_size=chunk_size))
+    action = "would be" if dry_run else "were"
+    typer.echo(
+        f"Checked {report.events} events in {report.seconds:.1f}s: {report.quarantined} invalid events "
+        f"{action} quarantined and {report.deliveries} delivery statuses {action} fixed."
+    )
+
+
+
+async def _export(output: str, start: Optional[datetime], end: Optional[datetime], format: str) -> int:
+    written = 0
+    async with AsyncSessionLocal() as db:
+        with open(output, "wb") as file:
+            async for chunk in _export_events(db, start, end, format):
+                written += file.write(chunk)
+    return written
+
+
+@cli.command()
+def export_events(
+    output: str = typer.Argument(..., help="File to write, .parquet or .arrow"),
+    start: Optional[datetime] = typer.Option(None, help="Only export the events created from this time, UTC"),
+    end: Optional[datetime] = typer.Option(None, help="Only export the events created before this time, UTC"),
+    format: Optional[str] = typer.Option(None, help="parquet or arrow, guessed from the file extension by default"),
+):
+    """Export the events of a time range, with the name of their delivery, as a Parquet or Arrow IPC file."""
+    format = format or ("arrow" if output.endswith((".arrow", ".feather")) else "parquet")
+    if format not in EXPORT_FORMATS:
+        raise typer.BadParameter(f"Unknown format: {format}")
+    written = run(_export(output, start, end, format))
+    typer.echo(f"Exported the events to {output} ({written} bytes).")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from .api.crud import compact_histories
+from .core import settings
+from .db import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class CompactionReport(NamedTuple):
+    """Outcome of a compaction."""
+    deliveries: int
+    events: int
+    seconds: float
+
+
+async def compact(session_factory: sessionmaker = AsyncSessionLocal, delay: Optional[float] = None) -> CompactionReport:
+    """
+    Fold the events of the deliveries that finished more than delay seconds ago, by default
+    compaction_delay, into compacted histories, see compact_histories. As their status cannot
+    change anymore, neither can their events. Deliveries are compacted in batches of
+    compaction_batch_size, each in its own short transaction.
+    """
+    started = time.perf_counter()
+    delay = settings.compaction_delay if delay is None else delay
+    finished_before = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=delay)
+    deliveries = events = 0
+    while True:
+        async with session_factory() as db:
+            async with db.begin():
+                batch = await compact_histories(db, settings.compaction_batch_size, finished_before)
+        deliveries += batch.deliveries
+        events += batch.events
+        if batch.deliveries < settings.compaction_batch_size:
+            break
+    report = CompactionReport(deliveries, events, time.perf_counter() - started)
+    if deliveries:
+        logger.info("Compacted the histories of %d deliveries, %d events, in %.3fs.", deliveries, events, report.seconds)
+    return report
+
+async def run_compactor() -> None:
+    """Compact the histories of the finished deliveries every compaction_interval seconds until cancelled."""
+    while True:
+        await asyncio.sleep(settings.compaction_interval)
+        try:
+            await compact()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Compaction run failed.")
+
+def start_compactor() -> Optional[asyncio.Task]:
+    """Start the compactor, unless HISTORY_COMPACTION=false."""
+    if not settings.history_compaction:
+        return None
+    return asyncio.create_task(run_compactor())
+
+async def stop_compactor(compactor: Optional[asyncio.Task]) -> None:
+    if compactor is None:
+        return
+    compactor.cancel()
+    await asyncio.gather(compactor, return_exceptions=True)
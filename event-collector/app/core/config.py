@@ -1,12 +1,57 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 from pydantic import Field
 
 
 class Settings(BaseSettings):
     database_url: str = Field(..., env='DATABASE_URL')
+    database_pool_size: int = Field(5, env='DATABASE_POOL_SIZE')
+    database_max_overflow: int = Field(10, env='DATABASE_MAX_OVERFLOW')
+    read_database_url: Optional[str] = Field(None, env='READ_DATABASE_URL')
+    read_pool_size: int = Field(5, env='READ_POOL_SIZE')
+    read_max_overflow: int = Field(10, env='READ_MAX_OVERFLOW')
+    read_max_staleness: Optional[float] = Field(None, env='READ_MAX_STALENESS')
+    read_lag_interval: float = Field(1.0, env='READ_LAG_INTERVAL')
+    read_lag_timeout: float = Field(1.0, env='READ_LAG_TIMEOUT')
     debug: bool = Field(False, env='DEBUG')
     redis_host: str = Field(..., env='REDIS_HOST')
     redis_port: int = Field(..., env='REDIS_PORT')
     delivery_history_limit: int = Field(..., env='DELIVERY_HISTORY_LIMIT')
+    ingest_queue_partitions: int = Field(8, env='INGEST_QUEUE_PARTITIONS')
+    ingest_batch_size: int = Field(100, env='INGEST_BATCH_SIZE')
+    ingest_poll_timeout: float = Field(1.0, env='INGEST_POLL_TIMEOUT')
+    ingest_mode: str = Field('single', env='INGEST_MODE')
+    ingest_lease_ttl: float = Field(10.0, env='INGEST_LEASE_TTL')
+    delivery_counter_shards: int = Field(16, env='DELIVERY_COUNTER_SHARDS')
+    delivery_cache_backend: str = Field('memory', env='DELIVERY_CACHE_BACKEND')
+    delivery_retention_days: Optional[float] = Field(None, env='DELIVERY_RETENTION_DAYS')
+    retention_interval: float = Field(10.0, env='RETENTION_INTERVAL')
+    retention_batch_size: int = Field(500, env='RETENTION_BATCH_SIZE')
+    feed_buffer_size: int = Field(100, env='FEED_BUFFER_SIZE')
+    feed_heartbeat_interval: float = Field(15.0, env='FEED_HEARTBEAT_INTERVAL')
+    feed_subscribe_timeout: float = Field(5.0, env='FEED_SUBSCRIBE_TIMEOUT')
+    event_partition_days: int = Field(1, env='EVENT_PARTITION_DAYS')
+    event_partitions_ahead: int = Field(3, env='EVENT_PARTITIONS_AHEAD')
+    detach_expired_partitions: bool = Field(False, env='DETACH_EXPIRED_PARTITIONS')
+    slow_query_seconds: Optional[float] = Field(None, env='SLOW_QUERY_SECONDS')
+    dedupe_cache_backend: str = Field('memory', env='DEDUPE_CACHE_BACKEND')
+    dedupe_cache_size: int = Field(100000, env='DEDUPE_CACHE_SIZE')
+    idempotency_window: float = Field(86400.0, env='IDEMPOTENCY_WINDOW')
+    dedupe_pending_ttl: float = Field(60.0, env='DEDUPE_PENDING_TTL')
+    status_write_behind: bool = Field(False, env='STATUS_WRITE_BEHIND')
+    status_flush_interval: float = Field(0.05, env='STATUS_FLUSH_INTERVAL')
+    status_buffer_size: int = Field(100000, env='STATUS_BUFFER_SIZE')
+    history_compaction: bool = Field(True, env='HISTORY_COMPACTION')
+    compaction_interval: float = Field(60.0, env='COMPACTION_INTERVAL')
+    compaction_delay: float = Field(3600.0, env='COMPACTION_DELAY')
+    compaction_batch_size: int = Field(500, env='COMPACTION_BATCH_SIZE')
+    ingest_admission: bool = Field(True, env='INGEST_ADMISSION')
+    ingest_max_concurrency: int = Field(256, env='INGEST_MAX_CONCURRENCY')
+    ingest_min_concurrency: int = Field(8, env='INGEST_MIN_CONCURRENCY')
+    ingest_max_queue_depth: Optional[int] = Field(100000, env='INGEST_MAX_QUEUE_DEPTH')
+    ingest_max_pool_wait: Optional[float] = Field(1.0, env='INGEST_MAX_POOL_WAIT')
+    admission_interval: float = Field(0.5, env='ADMISSION_INTERVAL')
+    ingest_retry_after: int = Field(1, env='INGEST_RETRY_AFTER')
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
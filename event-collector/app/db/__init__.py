@@ -1 +1,4 @@
-from .database import Base, AsyncSessionLocal, engine, get_db
+from .database import (
+    Base, AsyncSessionLocal, ReadSessionLocal, engine, read_engine, get_db, get_read_db, read_session_factory, replication_lag,
+)
+from .redis import redis_client, get_redis
@@ -1,14 +1,43 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import sessionmaker
 
 from ..core import settings
+from ..metrics import InstrumentedPool, instrument_engine
+
+logger = logging.getLogger(__name__)
+
+engine = create_async_engine(
+    settings.database_url, echo=settings.debug, poolclass=InstrumentedPool,
+    pool_size=settings.database_pool_size, max_overflow=settings.database_max_overflow,
+)
+instrument_engine(engine)
 
-engine = create_async_engine(settings.database_url, echo=settings.debug)
+# Engine of the read-only routes, on a replica with READ_DATABASE_URL, otherwise on the primary.
+# Either way it has its own pool, so reads do not wait for the connections taken by ingestion.
+read_engine = create_async_engine(
+    settings.read_database_url or settings.database_url, echo=settings.debug, poolclass=InstrumentedPool,
+    pool_size=settings.read_pool_size, max_overflow=settings.read_max_overflow,
+)
+instrument_engine(read_engine, "read")
 
 AsyncSessionLocal = sessionmaker(
-    bind=engine, 
+    bind=engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+    autocommit=False,
+    autoflush=False,
+)
+
+ReadSessionLocal = sessionmaker(
+    bind=read_engine,
     class_=AsyncSession,
     expire_on_commit=False,
     autocommit=False,
@@ -19,6 +48,69 @@ class Base(DeclarativeBase):
     """Base class for SQLAlchemy models."""
     pass
 
+
+# Seconds since the last transaction replayed by a standby, 0 when it replayed all it received or is a primary.
+# A standby that is not streaming from its primary has received nothing to compare with, so its lag is unknown:
+# Infinity. The status of pg_stat_wal_receiver is only visible to members of pg_read_all_stats.
+REPLICATION_LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 'Infinity' "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 'Infinity') END"
+)
+
+class ReplicationLag:
+    """
+    Replication lag of the read database, in seconds, measured on demand at most every
+    read_lag_interval seconds. None if the read database could not be reached within read_lag_timeout seconds.
+    """
+
+    def __init__(self):
+        self.seconds: Optional[float] = 0.0
+        self.measured_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> Optional[float]:
+        if self.measured_at is not None and time.monotonic() - self.measured_at < settings.read_lag_interval:
+            return self.seconds
+        async with self._lock:
+            if self.measured_at is None or time.monotonic() - self.measured_at >= settings.read_lag_interval:
+                try:
+                    self.seconds = await asyncio.wait_for(self._measure(), settings.read_lag_timeout)
+                except Exception:
+                    logger.exception("Failed to measure the replication lag of the read database.")
+                    self.seconds = None
+                self.measured_at = time.monotonic()
+        return self.seconds
+
+    def reset(self) -> None:
+        self.seconds = 0.0
+        self.measured_at = None
+
+    async def _measure(self) -> float:
+        async with read_engine.connect() as conn:
+            return float(await conn.scalar(REPLICATION_LAG_QUERY))
+
+
+replication_lag = ReplicationLag()
+
+async def read_session_factory() -> sessionmaker:
+    """
+    Session factory of the read-only routes: the read engine's, unless read_max_staleness is set
+    and the read database lags more than that behind the primary, or cannot be reached.
+    """
+    if settings.read_max_staleness is None:
+        return ReadSessionLocal
+    lag = await replication_lag.get()
+    if lag is None or lag > settings.read_max_staleness:
+        return AsyncSessionLocal
+    return ReadSessionLocal
+
 async def get_db() -> AsyncSession:
     async with AsyncSessionLocal() as session:
        yield session
+
+async def get_read_db() -> AsyncSession:
+    """Session of the read-only routes, see read_session_factory."""
+    async with (await read_session_factory())() as session:
+        yield session
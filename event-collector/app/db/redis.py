@@ -0,0 +1,8 @@
+from redis.asyncio import Redis
+
+from ..core import settings
+
+redis_client = Redis(host=settings.redis_host, port=settings.redis_port, decode_responses=True)
+
+async def get_redis() -> Redis:
+    return redis_client
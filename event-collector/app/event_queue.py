@@ -0,0 +1,470 @@
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from .api.crud import flush_delivery_statuses, partition_shard, rebuild_delivery_counters, repair_delivery_statuses
+from .core import settings
+from .db import AsyncSessionLocal, redis_client
+from .schemas import EventSchema, EventAcceptedSchema, QueueStatsSchema
+from .metrics import record_duplicate_events
+from .services import dedupe_cache, dedupe_key, ingest_event, ingest_transaction, record_dedupe_keys, status_buffer
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY_PREFIX = "events:queue"
+PROCESSING_KEY_PREFIX = "events:processing"
+DEAD_LETTER_KEY = "events:dead"
+LEASE_KEY_PREFIX = "events:lease"
+WORKERS_KEY = "events:workers"
+INGEST_MODES = ("single", "partitioned")
+
+# Extend or release a lease only if it is still held by the given worker.
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end
+return 0
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+return 0
+"""
+# Move up to ARGV[1] messages from the head of a queue to the tail of its processing list.
+# With an owner, ARGV[3], only while it holds the lease of the partition, KEYS[3]: otherwise
+# the message ARGV[2] it just took is put back at the head of the queue, unless the new owner
+# of the partition already did, and nothing is returned.
+TAKE_BATCH_SCRIPT = """
+if ARGV[3] ~= '' and redis.call('get', KEYS[3]) ~= ARGV[3] then
+    if redis.call('lrem', KEYS[2], -1, ARGV[2]) == 1 then redis.call('lpush', KEYS[1], ARGV[2]) end
+    return false
+end
+local messages = {}
+for i = 1, tonumber(ARGV[1]) do
+    local message = redis.call('lmove', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+    if not message then break end
+    messages[i] = message
+end
+return messages
+"""
+
+
+class LeaseLost(Exception):
+    """The lease of a partition was lost, or could not be checked, before a batch was committed."""
+
+
+class Consumers(NamedTuple):
+    """The consumer tasks started by start_consumers, and the event that stops them."""
+    tasks: List[asyncio.Task]
+    stopping: asyncio.Event
+
+
+def partition_for(delivery_name: str) -> int:
+    """Events of a delivery always go to the same partition, which keeps them in order."""
+    return zlib.crc32(delivery_name.encode()) % settings.ingest_queue_partitions
+
+def queue_key(partition: int) -> str:
+    return f"{QUEUE_KEY_PREFIX}:{partition}"
+
+def processing_key(partition: int) -> str:
+    """List of the events of a partition taken by its consumer, until their batch is ingested."""
+    return f"{PROCESSING_KEY_PREFIX}:{partition}"
+
+def lease_key(partition: int) -> str:
+    return f"{LEASE_KEY_PREFIX}:{partition}"
+
+def cancelled() -> bool:
+    """
+    Whether the current task was cancelled. redis-py may swallow the cancellation of a task
+    waiting on a command, so the consumer loops also check it between two commands.
+    """
+    return asyncio.current_task().cancelling() > 0
+
+async def process_event(delivery_name: str, event: EventSchema, redis: Redis = redis_client) -> EventAcceptedSchema:
+    """
+    Queue an event for ingestion and return as soon as it is accepted.
+    The event is stamped with the acceptance time if it has no created_at,
+    so the ingestion lag does not shift the event timestamps.
+    A copy of an event accepted within the idempotency window, by dedupe key, is
+    acknowledged with the id of the original when the dedupe cache has it, and is
+    not queued. Copies that the cache missed are rejected on ingestion by event_keys.
+    Until the event is ingested, its key is only cached for dedupe_pending_ttl seconds,
+    so that the copies of an event that is never ingested are not acknowledged for long.
+    """
+    accepted = EventAcceptedSchema(
+        event_id=uuid.uuid4().hex,
+        delivery_name=delivery_name,
+        type=event.type,
+        created_at=event.created_at or datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+    key = dedupe_key(delivery_name, event)
+    if key is not None:
+        cached = await dedupe_cache.get([key])
+        if key in cached:
+            record_duplicate_events("cache")
+            return accepted.model_copy(update={"event_id": cached[key], "duplicate": True})
+    message = accepted.model_dump(mode="json")
+    message["enqueued_at"] = time.time()
+    message["dedupe_key"] = key
+    if key is not None:
+        await dedupe_cache.add({key: accepted.event_id}, settings.dedupe_pending_ttl)
+    try:
+        await redis.rpush(queue_key(partition_for(delivery_name)), json.dumps(message))
+    except Exception:
+        if key is not None:
+            await dedupe_cache.discard([key])
+        raise
+    return accepted
+
+async def ingest_queued_event(db: AsyncSession, event: dict) -> None:
+    """Ingest a queued event, and record its dedupe key with the id it was acknowledged with."""
+    key = event.get("dedupe_key")
+    if await ingest_event(db, event["delivery_name"], EventSchema(**event), key) is not None and key is not None:
+        record_dedupe_keys(db, {key: event["event_id"]})
+
+async def check_fence(fence: Optional[Callable[[], Awaitable[bool]]]) -> None:
+    """Raise LeaseLost unless fence, if any, confirms that the lease is still held."""
+    if fence is None:
+        return
+    try:
+        held = await fence()
+    except Exception as e:
+        raise LeaseLost() from e
+    if not held:
+        raise LeaseLost()
+
+async def ingest_batch(
+    messages: List[str],
+    session_factory: sessionmaker = AsyncSessionLocal,
+    redis: Redis = redis_client,
+    shard: Optional[int] = None,
+    fence: Optional[Callable[[], Awaitable[bool]]] = None,
+) -> None:
+    """
+    Ingest a batch of queued events in a single transaction, updating the given shard of the counters.
+    The events are ingested by delivery name, each delivery's events in queue order.
+    If the batch fails, its events are retried one by one so that a single bad event
+    does not drop the others. Events that still fail are moved to the dead letter list.
+    fence is awaited before each commit: unless it returns True, the transaction is rolled
+    back and LeaseLost is raised, leaving the events to the new owner of the partition.
+    The dedupe keys of the ingested events are cached once committed, and those of the
+    dead-lettered events are dropped from the dedupe cache, so that their copies are queued.
+    """
+    events = [json.loads(message) for message in messages]
+    try:
+        async with session_factory() as db:
+            async with ingest_transaction(db, shard):
+                # The batch API upserts deliveries by name too: locking the delivery rows
+                # in the same order keeps the two from deadlocking on each other.
+                for event in sorted(events, key=lambda event: event["delivery_name"]):
+                    await ingest_queued_event(db, event)
+                await check_fence(fence)
+        return
+    except LeaseLost:
+        raise
+    except Exception:
+        logger.exception("Failed to ingest a batch of %d events, retrying one by one.", len(events))
+    for message, event in zip(messages, events):
+        try:
+            async with session_factory() as db:
+                async with ingest_transaction(db, shard):
+                    await ingest_queued_event(db, event)
+                    await check_fence(fence)
+        except LeaseLost:
+            raise
+        except Exception:
+            logger.exception("Failed to ingest event %s, moving it to %s.", event["event_id"], DEAD_LETTER_KEY)
+            await redis.rpush(DEAD_LETTER_KEY, message)
+            if event.get("dedupe_key") is not None:
+                await dedupe_cache.discard([event["dedupe_key"]])
+
+async def drain(
+    partition: int,
+    session_factory: sessionmaker = AsyncSessionLocal,
+    redis: Redis = redis_client,
+    timeout: float = None,
+    owner: Optional[str] = None,
+) -> int:
+    """
+    Wait for events on a partition and ingest up to ingest_batch_size of them,
+    updating the counter shard of the partition. Returns the number of ingested events, 0 if the wait timed out.
+    The events stay in the processing list of the partition until their batch is committed or
+    dead-lettered, so those of a consumer that stops or dies mid-batch are queued again by
+    requeue_processing: events are ingested at least once.
+    With an owner, the events are only taken, and their batch only committed, while owner holds
+    the lease of the partition, otherwise LeaseLost is raised.
+    """
+    key, processing = queue_key(partition), processing_key(partition)
+    first = await redis.blmove(key, processing, timeout if timeout is not None else settings.ingest_poll_timeout, "LEFT", "RIGHT")
+    if first is None:
+        return 0
+    rest = await redis.eval(
+        TAKE_BATCH_SCRIPT, 3, key, processing, lease_key(partition), settings.ingest_batch_size - 1, first, owner or "",
+    )
+    if rest is None:
+        raise LeaseLost()
+    messages = [first, *rest]
+    fence = (lambda: renew_lease(partition, owner, redis)) if owner is not None else None
+    await ingest_batch(messages, session_factory, redis, partition_shard(partition), fence)
+    # By value: the new owner of a lost lease may have taken events in the list meanwhile.
+    async with redis.pipeline(transaction=False) as pipe:
+        for message in messages:
+            pipe.lrem(processing, 1, message)
+        await pipe.execute()
+    return len(messages)
+
+async def requeue_processing(partition: int, redis: Redis = redis_client) -> int:
+    """
+    Move the events left in the processing list of a partition back to the head of its queue,
+    in order, before its consumer starts. Returns their number.
+    """
+    requeued = 0
+    while await redis.lmove(processing_key(partition), queue_key(partition), "RIGHT", "LEFT") is not None:
+        requeued += 1
+    if requeued:
+        logger.warning("Requeued %d events of partition %d left by a stopped consumer.", requeued, partition)
+    return requeued
+
+async def acquire_lease(partition: int, owner: str, redis: Redis = redis_client) -> bool:
+    """Take the lease of a partition for ingest_lease_ttl seconds, unless another worker holds it."""
+    return bool(await redis.set(lease_key(partition), owner, nx=True, px=int(settings.ingest_lease_ttl * 1000)))
+
+async def renew_lease(partition: int, owner: str, redis: Redis = redis_client) -> bool:
+    """Extend the lease of a partition held by owner. Returns False if it expired and another worker may hold it."""
+    renewed = await redis.eval(RENEW_LEASE_SCRIPT, 1, lease_key(partition), owner, int(settings.ingest_lease_ttl * 1000))
+    return bool(renewed)
+
+async def release_lease(partition: int, owner: str, redis: Redis = redis_client) -> None:
+    """Release the lease of a partition, if owner still holds it."""
+    await redis.eval(RELEASE_LEASE_SCRIPT, 1, lease_key(partition), owner)
+
+async def keep_lease(partition: int, owner: str, lost: asyncio.Event, redis: Redis = redis_client) -> None:
+    """Renew the lease of a partition every ingest_lease_ttl / 3 seconds until cancelled, or set lost once it is lost."""
+    while True:
+        await asyncio.sleep(settings.ingest_lease_ttl / 3)
+        try:
+            renewed = await renew_lease(partition, owner, redis)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to renew the lease of partition %d, retrying.", partition)
+            continue
+        if not renewed:
+            lost.set()
+            return
+
+async def consume(
+    partition: int,
+    owner: Optional[str] = None,
+    stopping: Optional[asyncio.Event] = None,
+    session_factory: sessionmaker = AsyncSessionLocal,
+    redis: Redis = redis_client,
+) -> None:
+    """
+    Drain a partition until cancelled. Each partition has exactly one consumer: with an owner,
+    the lease of the partition is renewed by a heartbeat, also while a batch is ingested, and
+    checked before each commit. The consumer returns once the lease is lost, or stopping is set,
+    between two batches.
+    The events left in process by the previous consumer of the partition are ingested first,
+    and so are those of a failed batch, before the next one.
+    """
+    lost = asyncio.Event()
+    heartbeat = asyncio.create_task(keep_lease(partition, owner, lost, redis)) if owner is not None else None
+    requeue = True
+    try:
+        while not cancelled() and not lost.is_set() and (stopping is None or not stopping.is_set()):
+            try:
+                if requeue:
+                    await requeue_processing(partition, redis)
+                    requeue = False
+                await drain(partition, session_factory, redis, owner=owner)
+            except asyncio.CancelledError:
+                raise
+            except LeaseLost:
+                lost.set()
+            except Exception:
+                logger.exception("Consumer of partition %d failed, retrying.", partition)
+                requeue = True
+                await asyncio.sleep(settings.ingest_poll_timeout)
+        if lost.is_set():
+            logger.warning("Lost the lease of partition %d.", partition)
+    finally:
+        if heartbeat is not None:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+async def balance_partitions(
+    owner: Optional[str] = None,
+    session_factory: sessionmaker = AsyncSessionLocal,
+    redis: Redis = redis_client,
+    stopping: Optional[asyncio.Event] = None,
+) -> None:
+    """
+    Consume the partitions leased by this worker until cancelled or stopping is set, for several workers or replicas.
+    Every ingest_lease_ttl / 3 seconds, the worker registers in WORKERS_KEY and balances its
+    leases to its share of the partitions among the live workers: it gives up its extra partitions
+    once their current batch is ingested, and takes free ones. The partition of a worker that died
+    is taken over once its lease expires, so a partition is never drained by two workers and the
+    events of a delivery stay in order. The buffered statuses are flushed before a lease is released.
+    """
+    owner = owner or uuid.uuid4().hex
+    stopping = stopping or asyncio.Event()
+    consumers: Dict[int, Tuple[asyncio.Task, asyncio.Event]] = {}
+    try:
+        while not cancelled() and not stopping.is_set():
+            now = time.time()
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(WORKERS_KEY, {owner: now})
+                pipe.zremrangebyscore(WORKERS_KEY, "-inf", now - settings.ingest_lease_ttl)
+                pipe.zcard(WORKERS_KEY)
+                workers = (await pipe.execute())[-1]
+            share = math.ceil(settings.ingest_queue_partitions / max(workers, 1))
+            for partition, (task, _) in list(consumers.items()):
+                if task.done():
+                    del consumers[partition]
+            for partition in list(consumers)[share:]:
+                task, consumer_stopping = consumers.pop(partition)
+                consumer_stopping.set()
+                await task
+                await flush_statuses(session_factory)
+                await release_lease(partition, owner, redis)
+            free = [partition for partition in range(settings.ingest_queue_partitions) if partition not in consumers]
+            random.shuffle(free)
+            for partition in free:
+                if len(consumers) >= share:
+                    break
+                if await acquire_lease(partition, owner, redis):
+                    consumer_stopping = asyncio.Event()
+                    task = asyncio.create_task(consume(partition, owner, consumer_stopping, session_factory, redis))
+                    consumers[partition] = (task, consumer_stopping)
+            try:
+                await asyncio.wait_for(stopping.wait(), settings.ingest_lease_ttl / 3)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # The consumers finish their current batch, so the lease is only released once it is ingested.
+        for _, consumer_stopping in consumers.values():
+            consumer_stopping.set()
+        await asyncio.gather(*(task for task, _ in consumers.values()), return_exceptions=True)
+        await flush_statuses(session_factory)
+        for partition in consumers:
+            await release_lease(partition, owner, redis)
+        await redis.zrem(WORKERS_KEY, owner)
+
+def start_consumers() -> Consumers:
+    """
+    Start one consumer task per queue partition. With INGEST_MODE=partitioned, for several
+    uvicorn workers or replicas, start the balancer of the partitions leased by this worker instead.
+    """
+    if settings.ingest_mode not in INGEST_MODES:
+        raise ValueError(f"Unknown ingest mode: {settings.ingest_mode}")
+    if settings.ingest_mode == "partitioned" and settings.delivery_cache_backend == "memory":
+        # Each worker would only see the deliveries changed by the partitions it consumes.
+        raise ValueError("INGEST_MODE=partitioned requires DELIVERY_CACHE_BACKEND=redis")
+    stopping = asyncio.Event()
+    if settings.ingest_mode == "partitioned":
+        return Consumers([asyncio.create_task(balance_partitions(stopping=stopping))], stopping)
+    return Consumers(
+        [asyncio.create_task(consume(partition, stopping=stopping)) for partition in range(settings.ingest_queue_partitions)],
+        stopping,
+    )
+
+async def stop_consumers(consumers: Consumers) -> None:
+    """Stop the consumers once their current batch is ingested, rather than cancelling them mid-batch."""
+    consumers.stopping.set()
+    await asyncio.gather(*consumers.tasks, return_exceptions=True)
+
+async def flush_statuses(session_factory: sessionmaker = AsyncSessionLocal) -> int:
+    """
+    Write the status changes collected by the status buffer to Postgres, in one statement.
+    Returns the number of deliveries written.
+    """
+    pending = status_buffer.pending()
+    if not pending:
+        return 0
+    async with session_factory() as db:
+        async with db.begin():
+            written = await flush_delivery_statuses(db, [
+                {"delivery_id": entry.id, "status": entry.status, "updated_at": entry.updated_at, "expected": entry.flushed}
+                for entry in pending.values()
+            ])
+    status_buffer.mark_flushed(pending, written)
+    if len(written) < len(pending):
+        logger.warning("Dropped %d buffered statuses of deliveries changed behind the buffer.", len(pending) - len(written))
+    return len(written)
+
+async def repair_statuses(session_factory: sessionmaker = AsyncSessionLocal) -> int:
+    """
+    Repair the statuses buffered by the write-behind mode and lost when a process died, from
+    the events already committed, and rebuild the delivery counters, which they were missing
+    from. Run before the consumers start. Returns the number of repaired deliveries.
+    """
+    async with session_factory() as db:
+        async with db.begin():
+            repaired = await repair_delivery_statuses(db)
+            if repaired:
+                await rebuild_delivery_counters(db)
+    if repaired:
+        logger.warning("Repaired the statuses of %d deliveries lost by the status buffer.", repaired)
+    return repaired
+
+async def run_flusher(session_factory: sessionmaker = AsyncSessionLocal) -> None:
+    """Flush the buffered statuses every status_flush_interval seconds until cancelled, then one last time."""
+    try:
+        while True:
+            await asyncio.sleep(settings.status_flush_interval)
+            try:
+                await flush_statuses(session_factory)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to flush the buffered statuses, retrying.")
+    finally:
+        await flush_statuses(session_factory)
+
+def start_flusher() -> Optional[asyncio.Task]:
+    """Start the flusher of the status buffer with STATUS_WRITE_BEHIND=true. Stop it after the consumers."""
+    if not settings.status_write_behind:
+        return None
+    return asyncio.create_task(run_flusher())
+
+async def stop_flusher(flusher: Optional[asyncio.Task]) -> None:
+    if flusher is None:
+        return
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+
+async def get_queue_stats(redis: Redis = redis_client) -> QueueStatsSchema:
+    """
+    Return the number of waiting events and the age of the oldest one.
+    The events of a batch being ingested are still waiting, until the batch is committed.
+    """
+    keys = [
+        key
+        for partition in range(settings.ingest_queue_partitions)
+        for key in (processing_key(partition), queue_key(partition))
+    ]
+    async with redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.llen(key)
+            pipe.lindex(key, 0)
+        pipe.llen(DEAD_LETTER_KEY)
+        results = await pipe.execute()
+    lengths = results[0:-1:2]
+    depths = [processing + queued for processing, queued in zip(lengths[0::2], lengths[1::2])]
+    heads = [head for head in results[1:-1:2] if head is not None]
+    oldest = min((json.loads(head)["enqueued_at"] for head in heads), default=None)
+    return QueueStatsSchema(
+        depth=sum(depths),
+        partitions=depths,
+        lag_seconds=max(time.time() - oldest, 0.0) if oldest is not None else 0.0,
+        dead_letters=results[-1],
+    )
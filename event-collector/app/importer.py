@@ -0,0 +1,159 @@
+import csv
+import json
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.orm import sessionmaker
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .api.crud import (
+    claim_event_keys, copy_imported_events, lock_delivery_statuses, merge_imported_events, quarantine_events,
+)
+from .db import AsyncSessionLocal
+from .metrics import record_duplicate_events
+from .models import DeliveryState, is_valid_transition
+from .schemas import EventBatchItemSchema
+from .services.dedupe_cache import dedupe_key
+from .services.delivery_cache import invalidate_delivery_cache
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("ndjson", "csv")
+# Keys claimed per statement, asyncpg sends at most 32767 parameters.
+CLAIM_BATCH_SIZE = 10000
+
+
+class ImportReport(NamedTuple):
+    """Outcome of an import."""
+    events: int
+    rejected: int
+    quarantined: int
+    duplicates: int
+    seconds: float
+
+
+def read_ndjson(file: TextIO) -> Iterator[Tuple[int, dict]]:
+    """Yield the line number and the object of each non-empty line."""
+    for line_number, line in enumerate(file, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError:
+                yield line_number, {}
+
+def read_csv(file: TextIO) -> Iterator[Tuple[int, dict]]:
+    """Yield the line number and the row of each line after the header. Empty values are left out."""
+    reader = csv.DictReader(file)
+    for row in reader:
+        yield reader.line_num, {key: value for key, value in row.items() if value}
+
+def guess_format(path: str) -> str:
+    return "csv" if path.endswith(".csv") else "ndjson"
+
+def parse_events(rows: Iterator[Tuple[int, dict]], counts: dict) -> Iterator[Tuple[int, str, str, Optional[datetime], Optional[str]]]:
+    """
+    Validate the rows as the events of POST /events/batch, and yield them as staging records,
+    numbered in file order, with their dedupe key. Invalid rows are logged and counted as rejected.
+    """
+    for seq, (line_number, row) in enumerate(rows):
+        try:
+            event = EventBatchItemSchema(**row)
+        except (ValidationError, TypeError):
+            logger.warning("Rejected the event of line %s: %s", line_number, row)
+            counts["rejected"] += 1
+            continue
+        yield seq, event.delivery_name, event.type.value, event.created_at, dedupe_key(event.delivery_name, event)
+
+async def drop_duplicates(db: AsyncSession, records: List[tuple]) -> Tuple[List[tuple], int]:
+    """
+    Claim the dedupe keys of staging records in the event_keys table, like the ingest API,
+    and drop the copies of events already ingested or repeated in records.
+    Records without a dedupe key are kept. Returns the kept records and the number of
+    copies of events already ingested.
+    """
+    keys = sorted({record[4] for record in records if record[4] is not None})
+    claimed = set()
+    for start in range(0, len(keys), CLAIM_BATCH_SIZE):
+        claimed |= await claim_event_keys(db, keys[start:start + CLAIM_BATCH_SIZE])
+    kept, first = [], set(claimed)
+    for record in records:
+        key = record[4]
+        if key is None or key in first:
+            first.discard(key)
+            kept.append(record)
+    return kept, len(keys) - len(claimed)
+
+def split_transitions(records: List[tuple], statuses: Dict[str, DeliveryState]) -> Tuple[List[tuple], List[dict]]:
+    """
+    Split staging records into the valid transitions of their delivery, starting from its
+    current status, and the invalid ones, returned as events to quarantine.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    statuses = dict(statuses)
+    valid, invalid = [], []
+    for record in records:
+        _, delivery_name, event_type, created_at, _ = record
+        state = DeliveryState(event_type)
+        previous_status = statuses.get(delivery_name)
+        if is_valid_transition(previous_status, state):
+            statuses[delivery_name] = state
+            valid.append(record)
+        else:
+            invalid.append({
+                "delivery_name": delivery_name,
+                "type": state,
+                "previous_status": previous_status,
+                "created_at": created_at or now,
+            })
+    return valid, invalid
+
+async def import_events(
+    file: TextIO,
+    format: str = "ndjson",
+    chunk_size: int = 50000,
+    session_factory: sessionmaker = AsyncSessionLocal,
+) -> ImportReport:
+    """
+    Import the events of an NDJSON or CSV stream, with delivery_name, type and optional created_at fields.
+    Events are read chunk_size at a time, so memory stays bounded whatever the size of the stream.
+    Each chunk is copied to a staging table, then merged into the deliveries and events
+    with a single statement, in its own transaction. Chunks are merged in file order,
+    so the events of each delivery keep their order and the last one sets its status.
+    Events that are not valid transitions of their delivery are quarantined instead,
+    checked against the status of the deliveries, locked for the transaction.
+    Copies of events already ingested, by dedupe key, are skipped, see drop_duplicates,
+    so an event log can be imported again, or overlap with the events sent to the API.
+    """
+    started = time.perf_counter()
+    rows = read_csv(file) if format == "csv" else read_ndjson(file)
+    counts = {"events": 0, "rejected": 0, "quarantined": 0, "duplicates": 0}
+    records = parse_events(rows, counts)
+    while chunk := list(islice(records, chunk_size)):
+        async with session_factory() as db:
+            async with db.begin():
+                kept, ingested = await drop_duplicates(db, chunk)
+                statuses = await lock_delivery_statuses(db, list({record[1] for record in kept}))
+                valid, invalid = split_transitions(kept, statuses)
+                if invalid:
+                    await quarantine_events(db, invalid)
+                await copy_imported_events(db, [record[:4] for record in valid])
+                merged = await merge_imported_events(db)
+        record_duplicate_events("table", ingested)
+        record_duplicate_events("batch", len(chunk) - len(kept) - ingested)
+        counts["events"] += merged.events
+        counts["quarantined"] += len(invalid)
+        counts["duplicates"] += len(chunk) - len(kept)
+        logger.info("Imported %d events, %.0f events/s.", counts["events"], counts["events"] / (time.perf_counter() - started))
+    # Any delivery may have changed: the caches of the collectors are warmed again from Postgres on their next read.
+    await invalidate_delivery_cache()
+    return ImportReport(counts["events"], counts["rejected"], counts["quarantined"], counts["duplicates"], time.perf_counter() - started)
+
+def open_events(path: str) -> TextIO:
+    """Open an event log, - for the standard input."""
+    return sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
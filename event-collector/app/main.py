@@ -1,7 +1,40 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
 from .api import router
+from .compaction import start_compactor, stop_compactor
+from .db import AsyncSessionLocal
+from .core import settings
+from .event_queue import repair_statuses, start_consumers, start_flusher, stop_consumers, stop_flusher
+from .metrics import MetricsMiddleware
+from .partitions import ensure_event_partitions
+from .retention import start_pruner, stop_pruner
+from .services import delivery_feed, warm_delivery_cache
+from .services.delivery_cache import start_invalidation_listener, stop_invalidation_listener
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.status_write_behind:
+        await repair_statuses()
+    invalidation_listener = start_invalidation_listener()
+    async with AsyncSessionLocal() as db:
+        await warm_delivery_cache(db)
+    await ensure_event_partitions()
+    consumers = start_consumers()
+    flusher = start_flusher()
+    pruner = start_pruner()
+    compactor = start_compactor()
+    yield
+    await stop_compactor(compactor)
+    await stop_pruner(pruner)
+    await stop_consumers(consumers)
+    await stop_flusher(flusher)
+    await delivery_feed.stop()
+    await stop_invalidation_listener(invalidation_listener)
 
-app = FastAPI(title="Event Collector API")
+app = FastAPI(title="Event Collector API", lifespan=lifespan)
 
+app.add_middleware(MetricsMiddleware)
 app.include_router(router)
@@ -0,0 +1,170 @@
+import logging
+import time
+from contextvars import ContextVar
+from typing import Iterable, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .core import settings
+
+logger = logging.getLogger(__name__)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Latency of the HTTP requests, by route.",
+    ["method", "route", "status"],
+)
+REQUEST_SQL_STATEMENTS = Histogram(
+    "http_request_sql_statements", "SQL statements run by an HTTP request, by route.",
+    ["method", "route"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+REQUEST_SQL_SECONDS = Histogram(
+    "http_request_sql_duration_seconds", "Time spent in SQL statements by an HTTP request, by route.",
+    ["method", "route"],
+)
+SQL_STATEMENTS = Counter(
+    "sql_statements_total", "SQL statements run, by route, background for the background tasks.", ["route"],
+)
+SQL_SECONDS = Counter(
+    "sql_statement_duration_seconds_total", "Time spent in SQL statements, by route.", ["route"],
+)
+POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_duration_seconds", "Time waited to check a connection out of the pool.",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+POOL_CONNECTIONS = Gauge("db_pool_connections", "Connections of the pools, by pool and state.", ["pool", "state"])
+INGESTED_EVENTS = Counter("ingested_events_total", "Events committed, by delivery state.", ["state"])
+QUARANTINED_EVENTS = Counter("quarantined_events_total", "Events quarantined as invalid transitions.")
+DUPLICATE_EVENTS = Counter(
+    "duplicate_events_total", "Copies of events acknowledged without being ingested, by what caught them.", ["source"],
+)
+INGEST_ADMISSION_LIMIT = Gauge("ingest_admission_limit", "Ingest requests admitted at once.")
+INGEST_IN_FLIGHT = Gauge("ingest_in_flight_requests", "Ingest requests being served.")
+INGEST_REJECTION_RATE = Gauge(
+    "ingest_rejection_rate", "Share of the ingest requests rejected over the last admission interval.",
+)
+REJECTED_INGEST_REQUESTS = Counter(
+    "rejected_ingest_requests_total", "Ingest requests shed with a 429, by reason.", ["reason"],
+)
+
+BACKGROUND = "background"
+
+
+class RequestStats:
+    """SQL statements of the request being served."""
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+    @property
+    def route(self) -> str:
+        """Template of the matched route, which keeps the number of label values bounded."""
+        route = self.scope.get("route")
+        return route.path if route is not None else "unmatched"
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+class MetricsMiddleware:
+    """Measures the latency and the SQL statements of each request, labelled by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_request.reset(token)
+            method, route = scope["method"], stats.route
+            REQUEST_SECONDS.labels(method, route, status).observe(time.perf_counter() - started)
+            REQUEST_SQL_STATEMENTS.labels(method, route).observe(stats.statements)
+            REQUEST_SQL_SECONDS.labels(method, route).observe(stats.sql_seconds)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Connection pool measuring how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Start times of the checkouts in progress.
+        self.waiting_since: List[float] = []
+
+    def _do_get(self):
+        started = time.perf_counter()
+        self.waiting_since.append(started)
+        try:
+            return super()._do_get()
+        finally:
+            self.waiting_since.remove(started)
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+    def wait_seconds(self) -> float:
+        """How long the oldest checkout in progress has been waiting for a connection, 0 if none is."""
+        return time.perf_counter() - min(self.waiting_since) if self.waiting_since else 0.0
+
+
+def instrument_engine(engine: AsyncEngine, pool: str = "primary") -> None:
+    """Count and time the statements of the engine, and export the state of its pool under the given name."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["statement_started"].pop()
+        stats = current_request.get()
+        route = stats.route if stats is not None else BACKGROUND
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_seconds += elapsed
+        SQL_STATEMENTS.labels(route).inc()
+        SQL_SECONDS.labels(route).inc(elapsed)
+        if settings.slow_query_seconds is not None and elapsed >= settings.slow_query_seconds:
+            logger.warning("Slow query (%.3fs) in %s: %s", elapsed, route, statement)
+
+    # The pool is looked up on each scrape, as disposing the engine replaces it.
+    POOL_CONNECTIONS.labels(pool, "checked_out").set_function(lambda: sync_engine.pool.checkedout())
+    POOL_CONNECTIONS.labels(pool, "checked_in").set_function(lambda: sync_engine.pool.checkedin())
+    POOL_CONNECTIONS.labels(pool, "overflow").set_function(lambda: max(sync_engine.pool.overflow(), 0))
+    POOL_CONNECTIONS.labels(pool, "size").set_function(lambda: sync_engine.pool.size())
+
+
+def record_ingested_events(states: Iterable[str]) -> None:
+    """Count committed events by delivery state."""
+    for state in states:
+        INGESTED_EVENTS.labels(state).inc()
+
+def record_quarantined_events(count: int = 1) -> None:
+    QUARANTINED_EVENTS.inc(count)
+
+def record_duplicate_events(source: str, count: int = 1) -> None:
+    """
+    Count the copies of events caught by the dedupe cache, "cache", by the event_keys table, "table",
+    or repeated within a batch, "batch".
+    """
+    DUPLICATE_EVENTS.labels(source).inc(count)
+
+def record_rejected_ingest_request(reason: str) -> None:
+    """Count an ingest request shed because of "concurrency", "queue_depth" or "pool_wait"."""
+    REJECTED_INGEST_REQUESTS.labels(reason).inc()
@@ -1,3 +1,11 @@
-from .delivery import Delivery
+from .compacted_history import CompactedHistory
+from .delivery import Delivery, DELIVERY_NAME_MAX_LENGTH
+from .delivery_counter import DeliveryCounter
 from .event import Event
-from .type import DeliveryState
+from .event_key import EventKey
+from .quarantined_event import QuarantinedEvent
+from .rollup import HourlyRollup, TransitionRollup, DURATION_BUCKETS
+from .type import (
+    DeliveryState, DeliveryStateCode, STATE_CODES, CODE_STATES, TRANSITIONS, VALID_TRANSITIONS, PREVIOUS_STATES,
+    is_valid_transition, walk_transitions,
+)
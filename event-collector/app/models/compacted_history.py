@@ -0,0 +1,27 @@
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Index, SmallInteger
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from ..db.database import Base
+
+class CompactedHistory(Base):
+    """
+    Events of a finished delivery folded into one row by app/compaction.py, in (created_at, id)
+    order: their ids, their states as codes of STATE_CODES, and their created_at as microseconds
+    since started_at. Reads of the events see them as rows, see compacted_events_query.
+    """
+    __tablename__ = 'compacted_histories'
+
+    delivery_id = Column(BigInteger, ForeignKey('deliveries.id', ondelete='CASCADE'), primary_key=True)
+    # created_at of the first and last events.
+    started_at = Column(DateTime, nullable=False)
+    ended_at = Column(DateTime, nullable=False)
+    event_ids = Column(ARRAY(BigInteger), nullable=False)
+    types = Column(ARRAY(SmallInteger), nullable=False)
+    offsets = Column(ARRAY(BigInteger), nullable=False)
+
+    __table_args__ = (
+        Index('ix_compacted_histories_started_at', started_at),
+    )
+
+    def __repr__(self):
+        return f"<CompactedHistory(delivery_id={self.delivery_id}, events={len(self.event_ids)})>"
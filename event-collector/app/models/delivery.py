@@ -1,23 +1,35 @@
 
-from sqlalchemy import Column, Integer, String, Enum, DateTime, func, Index
+from sqlalchemy import BigInteger, Column, Identity, String, DateTime, func, Index
 from sqlalchemy.orm import relationship
 
-from .type import DeliveryState
+from .type import DeliveryState, DeliveryStateCode
 from ..db.database import Base
 
+# Generated names are 15 characters long, see _generate_name in deliveries/generate_events.py.
+DELIVERY_NAME_MAX_LENGTH = 32
+
+
 class Delivery(Base):
     __tablename__ = 'deliveries'
 
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False, index=True, unique=True)
-    status = Column(Enum(DeliveryState), nullable=False, default=DeliveryState.PARCEL_COLLECTED)
+    # Columns are ordered by alignment, the 8-byte ones first, so that rows have no padding.
+    id = Column(BigInteger, Identity(), primary_key=True)
     created_at = Column(DateTime, server_default=func.now())
+    # created_at of the event that set the status, to measure the time spent in it.
+    updated_at = Column(DateTime)
+    status = Column(DeliveryStateCode, nullable=False, default=DeliveryState.PARCEL_COLLECTED)
+    name = Column(String(DELIVERY_NAME_MAX_LENGTH), nullable=False, index=True, unique=True)
+
+    events = relationship("Event", back_populates="delivery", cascade="all, delete-orphan", passive_deletes=True)
 
-    events = relationship("Event", back_populates="delivery", cascade="all, delete-orphan")
+    __table_args__ = (
+        Index('ix_deliveries_created_at', created_at),
+        Index('ix_deliveries_ongoing', id, postgresql_where=status.in_(DeliveryState.ongoing_states())),
+    )
         
     @property
     def is_ongoing(self):
         return self.status in DeliveryState.ongoing_states()
 
     def __repr__(self):
-        return f"<Delivery(id={self.id}, name={self.name}, status={self.status}, created_at={self.created_at})>"
\ No newline at end of file
+        return f"<Delivery(id={self.id}, name={self.name}, status={self.status}, created_at={self.created_at})>"
@@ -0,0 +1,18 @@
+from sqlalchemy import BigInteger, Column, Integer, String
+
+from ..db.database import Base
+
+class DeliveryCounter(Base):
+    """
+    Running count of deliveries, kept up to date by the ingest statements.
+    Each counter is split into shards so that concurrent ingests do not wait
+    on the same row; the value of a counter is the sum of its shards.
+    """
+    __tablename__ = 'delivery_counters'
+
+    name = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<DeliveryCounter(name={self.name}, shard={self.shard}, value={self.value})>"
@@ -1,21 +1,35 @@
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, ForeignKey, Enum, DateTime, func
+from sqlalchemy import BigInteger, Column, ForeignKey, DateTime, Identity, func, Index, DDL, event
 from sqlalchemy.orm import relationship
 
 from ..db.database import Base
-from .type import DeliveryState
+from .type import DeliveryState, DeliveryStateCode
 
 class Event(Base):
     __tablename__ = 'events'
 
-    id: int = Column(Integer, primary_key=True, index=True)
-    type: DeliveryState = Column(Enum(DeliveryState), nullable=False)
-    delivery_id: int = Column(Integer, ForeignKey('deliveries.id'), nullable=False) # ondelete cascade ?
-    created_at: datetime = Column(DateTime, server_default=func.now(), nullable=False)
+    # Columns are ordered by alignment, the 8-byte ones first, so that rows have no padding.
+    id: int = Column(BigInteger, Identity(), primary_key=True, autoincrement=True)
+    delivery_id: int = Column(BigInteger, ForeignKey('deliveries.id', ondelete='CASCADE'), nullable=False)
+    # Part of the primary key, as the table is partitioned by created_at.
+    created_at: datetime = Column(DateTime, server_default=func.now(), primary_key=True)
+    type: DeliveryState = Column(DeliveryStateCode, nullable=False)
     
     delivery = relationship("Delivery", back_populates="events")
 
+    __table_args__ = (
+        Index('ix_events_delivery_id_created_at', delivery_id, created_at),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+
     def __repr__(self):
         return f"<Event(id={self.id}, type={self.type}, delivery_id={self.delivery_id}, created_at={self.created_at})>"
-    
\ No newline at end of file
+
+
+# Events outside of the dated partitions, see app/partitions.py, go to the default partition.
+event.listen(
+    Event.__table__,
+    "after_create",
+    DDL(f"CREATE TABLE {Event.__tablename__}_default PARTITION OF {Event.__tablename__} DEFAULT"),
+)
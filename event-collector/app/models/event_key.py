@@ -0,0 +1,21 @@
+from sqlalchemy import Column, DateTime, Index, String, func
+
+from ..db.database import Base
+
+class EventKey(Base):
+    """
+    Dedupe key of each ingested event, see app/services/dedupe_cache.py.
+    The primary key rejects the copies of an event that the dedupe cache missed,
+    until the keys older than the idempotency window are pruned.
+    """
+    __tablename__ = 'event_keys'
+
+    key = Column(String(32), primary_key=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_event_keys_created_at', created_at),
+    )
+
+    def __repr__(self):
+        return f"<EventKey(key={self.key}, created_at={self.created_at})>"
@@ -0,0 +1,27 @@
+from sqlalchemy import BigInteger, Column, DateTime, Index, String, func
+
+from ..db.database import Base
+from .type import DeliveryStateCode
+
+class QuarantinedEvent(Base):
+    """
+    Events rejected as invalid transitions of their delivery, see TRANSITIONS in app/models/type.py,
+    by ingestion or by `python -m app.cli revalidate-events`. They are kept out of events
+    and of the delivery status, for inspection.
+    """
+    __tablename__ = 'quarantined_events'
+
+    id = Column(BigInteger, primary_key=True)
+    delivery_name = Column(String, nullable=False)
+    type = Column(DeliveryStateCode, nullable=False)
+    # Status of the delivery when the event was rejected.
+    previous_status = Column(DeliveryStateCode)
+    created_at = Column(DateTime, nullable=False)
+    quarantined_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_quarantined_events_delivery_name', delivery_name),
+    )
+
+    def __repr__(self):
+        return f"<QuarantinedEvent(id={self.id}, delivery_name={self.delivery_name}, type={self.type}, previous_status={self.previous_status})>"
@@ -0,0 +1,51 @@
+from sqlalchemy import BigInteger, Column, DateTime, Float, Integer, SmallInteger
+
+from ..db.database import Base
+from .type import DeliveryStateCode
+
+# Upper bounds, in seconds, of the buckets of the time-in-state distributions:
+# bucket 0 is under a second, bucket n from 2^(n-1) to 2^n seconds, and the last one
+# everything from 2^23 seconds, about 97 days.
+DURATION_BUCKETS = [float(2 ** power) for power in range(24)]
+
+
+class HourlyRollup(Base):
+    """
+    Number of events of each state per hour, kept up to date by the ingest statements
+    so that analytics do not scan the events. Sharded like DeliveryCounter; the value
+    of a rollup is the sum of its shards.
+    """
+    __tablename__ = 'hourly_rollups'
+
+    hour = Column(DateTime, primary_key=True)
+    status = Column(DeliveryStateCode, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    events = Column(BigInteger, nullable=False, default=0)
+    # Events that created their delivery.
+    deliveries = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<HourlyRollup(hour={self.hour}, status={self.status}, shard={self.shard}, events={self.events})>"
+
+
+class TransitionRollup(Base):
+    """
+    Number of transitions of each state pair per hour, with the distribution and the total
+    of the time spent in the previous state, see DURATION_BUCKETS. Kept up to date by the
+    ingest statements and sharded like HourlyRollup.
+    """
+    __tablename__ = 'transition_rollups'
+
+    hour = Column(DateTime, primary_key=True)
+    previous_status = Column(DeliveryStateCode, primary_key=True)
+    status = Column(DeliveryStateCode, primary_key=True)
+    bucket = Column(SmallInteger, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    events = Column(BigInteger, nullable=False, default=0)
+    seconds = Column(Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return (
+            f"<TransitionRollup(hour={self.hour}, previous_status={self.previous_status}, status={self.status}, "
+            f"bucket={self.bucket}, shard={self.shard}, events={self.events})>"
+        )
@@ -1,4 +1,8 @@
 import enum
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from sqlalchemy import SmallInteger
+from sqlalchemy.types import TypeDecorator
 
 class DeliveryState(enum.Enum):
     PARCEL_COLLECTED = "PARCEL_COLLECTED"
@@ -7,5 +11,76 @@ class DeliveryState(enum.Enum):
     CRASHED = "CRASHED"
     PARCEL_DELIVERED = "PARCEL_DELIVERED"
 
-    def ongoing_states(self):
-        return (self.TAKEN_OFF, self.PARCEL_COLLECTED, self.LANDED)
+    @classmethod
+    def ongoing_states(cls):
+        return (cls.TAKEN_OFF, cls.PARCEL_COLLECTED, cls.LANDED)
+
+    @property
+    def is_terminal(self) -> bool:
+        return not TRANSITIONS[self]
+
+
+# States a delivery can move to from each state, as TRANSITIONS in deliveries/generate_events.py.
+# Terminal states move nowhere. The first event of a delivery can be of any state,
+# so that a delivery whose first events were lost is still tracked.
+TRANSITIONS: Dict[DeliveryState, Tuple[DeliveryState, ...]] = {
+    DeliveryState.PARCEL_COLLECTED: (DeliveryState.TAKEN_OFF, DeliveryState.CRASHED, DeliveryState.PARCEL_DELIVERED),
+    DeliveryState.TAKEN_OFF: (DeliveryState.LANDED, DeliveryState.CRASHED),
+    DeliveryState.LANDED: (DeliveryState.PARCEL_DELIVERED, DeliveryState.TAKEN_OFF, DeliveryState.CRASHED),
+    DeliveryState.CRASHED: (),
+    DeliveryState.PARCEL_DELIVERED: (),
+}
+
+# Compiled once: the allowed (previous, next) pairs, and the states each state can be reached from.
+VALID_TRANSITIONS: FrozenSet[Tuple[DeliveryState, DeliveryState]] = frozenset(
+    (previous, state) for previous, states in TRANSITIONS.items() for state in states
+)
+PREVIOUS_STATES: Dict[DeliveryState, Tuple[DeliveryState, ...]] = {
+    state: tuple(previous for previous in DeliveryState if (previous, state) in VALID_TRANSITIONS)
+    for state in DeliveryState
+}
+
+
+def is_valid_transition(previous: Optional[DeliveryState], state: DeliveryState) -> bool:
+    """Whether a delivery in the previous state, None if it is new, can move to state."""
+    return previous is None or (previous, state) in VALID_TRANSITIONS
+
+def walk_transitions(previous: Optional[DeliveryState], states: Iterable[DeliveryState]) -> Tuple[Optional[DeliveryState], List[bool]]:
+    """
+    Move a delivery in the previous state through states, in order, skipping the invalid transitions.
+    Returns the state it ends up in and whether each of states was a valid transition.
+    """
+    valid = []
+    for state in states:
+        valid.append(is_valid_transition(previous, state))
+        if valid[-1]:
+            previous = state
+    return previous, valid
+
+
+# Code of each state in the database. Codes are stored, so they must never change:
+# give a new state the next free code.
+STATE_CODES: Dict[DeliveryState, int] = {
+    DeliveryState.PARCEL_COLLECTED: 1,
+    DeliveryState.TAKEN_OFF: 2,
+    DeliveryState.LANDED: 3,
+    DeliveryState.CRASHED: 4,
+    DeliveryState.PARCEL_DELIVERED: 5,
+}
+CODE_STATES: Dict[int, DeliveryState] = {code: state for state, code in STATE_CODES.items()}
+
+
+class DeliveryStateCode(TypeDecorator):
+    """
+    A DeliveryState stored as its code, see STATE_CODES, in a smallint: half the size of an enum,
+    and without padding when it follows the 8-byte columns of a row.
+    Accepts states or their values.
+    """
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect) -> Optional[int]:
+        return STATE_CODES[DeliveryState(value)] if value is not None else None
+
+    def process_result_value(self, value, dialect) -> Optional[DeliveryState]:
+        return CODE_STATES[value] if value is not None else None
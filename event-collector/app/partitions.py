@@ -0,0 +1,93 @@
+import logging
+import re
+from datetime import datetime, time, timedelta, timezone
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+
+from .api.crud import create_event_partition, drop_event_partition, read_event_partitions
+from .core import settings
+from .db import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+BOUND = re.compile(r"FOR VALUES FROM \((.+)\) TO \((.+)\)")
+
+
+class EventPartition(NamedTuple):
+    """A dated partition of the events table. A None bound is unbounded."""
+    name: str
+    start: Optional[datetime]
+    end: Optional[datetime]
+
+
+def parse_bound(value: str) -> Optional[datetime]:
+    return None if value in ("MINVALUE", "MAXVALUE") else datetime.fromisoformat(value.strip("'"))
+
+def partition_name(start: datetime) -> str:
+    return f"events_{start:%Y%m%d}"
+
+async def read_partitions(db) -> List[EventPartition]:
+    """Read the dated partitions of the events table, sorted by start. The default partition is left out."""
+    partitions = []
+    for name, bound in await read_event_partitions(db):
+        match = BOUND.fullmatch(bound)
+        if match:
+            partitions.append(EventPartition(name, parse_bound(match[1]), parse_bound(match[2])))
+    return sorted(partitions, key=lambda partition: partition.start or datetime.min)
+
+async def ensure_event_partitions(session_factory: sessionmaker = AsyncSessionLocal, now: Optional[datetime] = None) -> List[str]:
+    """
+    Create the partitions of events, event_partition_days long, following the last
+    existing one, or starting today, until event_partitions_ahead partitions are ahead of now.
+    Returns the names of the created partitions.
+    """
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    period = timedelta(days=settings.event_partition_days)
+    horizon = now + period * settings.event_partitions_ahead
+    created = []
+    async with session_factory() as db:
+        async with db.begin():
+            # Workers creating the same partitions concurrently would conflict.
+            await db.execute(text("SELECT pg_advisory_xact_lock(hashtext('events_partitions'))"))
+            partitions = await read_partitions(db)
+            if any(partition.end is None for partition in partitions):
+                return created
+            start = max((partition.end for partition in partitions), default=datetime.combine(now.date(), time.min))
+            while start < horizon:
+                name = partition_name(start)
+                moved = await create_event_partition(db, name, start, start + period)
+                if moved:
+                    logger.info("Moved %d events from the default partition to %s.", moved, name)
+                created.append(name)
+                start += period
+    if created:
+        logger.info("Created the event partitions %s.", ", ".join(created))
+    return created
+
+async def drop_expired_event_partitions(session_factory: sessionmaker, created_before: datetime) -> int:
+    """
+    Drop, or detach if detach_expired_partitions is set, the partitions of events
+    that only hold events created before created_before. Each is dropped in its own
+    short transaction, and a partition that stays locked is left for the next run.
+    Returns the number of dropped partitions.
+    """
+    async with session_factory() as db:
+        partitions = await read_partitions(db)
+        await db.rollback()
+    dropped = 0
+    for partition in partitions:
+        if partition.end is None or partition.end > created_before:
+            break
+        try:
+            async with session_factory() as db:
+                async with db.begin():
+                    await drop_event_partition(db, partition.name, settings.detach_expired_partitions)
+        except DBAPIError:
+            logger.exception("Failed to drop the event partition %s, retrying on the next run.", partition.name)
+            break
+        dropped += 1
+        logger.info("%s the event partition %s.", "Detached" if settings.detach_expired_partitions else "Dropped", partition.name)
+    return dropped
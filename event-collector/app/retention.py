@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+from .api.crud import (
+    delete_default_partition_events, delete_expired_event_keys, delete_oldest_deliveries, read_delivery_counters,
+)
+from .core import settings
+from .db import AsyncSessionLocal
+from .partitions import drop_expired_event_partitions, ensure_event_partitions
+from .schemas import RetentionReportSchema
+from .services import ingest_transaction, record_delivery_removal
+
+logger = logging.getLogger(__name__)
+
+last_report: Optional[RetentionReportSchema] = None
+
+
+async def prune_batch(session_factory: sessionmaker, created_before: Optional[datetime] = None) -> Tuple[int, int]:
+    """
+    Delete up to retention_batch_size of the oldest deliveries and their events in one transaction.
+    Without created_before, only the deliveries above the delivery history limit are deleted.
+    Returns the number of deleted deliveries and events.
+    """
+    async with session_factory() as db:
+        async with ingest_transaction(db):
+            count = settings.retention_batch_size
+            if created_before is None:
+                overflow = (await read_delivery_counters(db))["total"] - settings.delivery_history_limit
+                count = min(count, overflow)
+            if count <= 0:
+                return 0, 0
+            pruned = await delete_oldest_deliveries(db, count, created_before)
+            for name in pruned.names or []:
+                record_delivery_removal(db, name)
+    return len(pruned.names or []), pruned.events
+
+async def prune(session_factory: sessionmaker = AsyncSessionLocal) -> RetentionReportSchema:
+    """
+    If delivery_retention_days is set, drop the event partitions older than that,
+    then delete the older deliveries. Then delete the oldest deliveries above the
+    delivery history limit. Deliveries are deleted along with their events,
+    in batches of retention_batch_size deliveries, each in its own short
+    transaction, so that ingestion never waits long on the pruned rows.
+    The event keys older than the idempotency window are deleted too.
+    """
+    global last_report
+    started = time.perf_counter()
+    cutoffs = [None]
+    deliveries = events = partitions = 0
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    async with session_factory() as db:
+        async with db.begin():
+            event_keys = await delete_expired_event_keys(db, now - timedelta(seconds=settings.idempotency_window))
+    if settings.delivery_retention_days is not None:
+        cutoff = now - timedelta(days=settings.delivery_retention_days)
+        cutoffs.insert(0, cutoff)
+        partitions = await drop_expired_event_partitions(session_factory, cutoff)
+        async with session_factory() as db:
+            async with db.begin():
+                events += await delete_default_partition_events(db, cutoff)
+    for created_before in cutoffs:
+        while True:
+            pruned_deliveries, pruned_events = await prune_batch(session_factory, created_before)
+            deliveries += pruned_deliveries
+            events += pruned_events
+            if pruned_deliveries < settings.retention_batch_size:
+                break
+    last_report = RetentionReportSchema(
+        deliveries=deliveries, events=events, partitions=partitions, event_keys=event_keys,
+        seconds=time.perf_counter() - started,
+    )
+    if deliveries or events or partitions or event_keys:
+        logger.info(
+            "Pruned %d deliveries, %d events, %d event partitions and %d event keys in %.3fs.",
+            last_report.deliveries, last_report.events, last_report.partitions, last_report.event_keys, last_report.seconds,
+        )
+    return last_report
+
+async def run_pruner() -> None:
+    """Create the upcoming event partitions and prune every retention_interval seconds until cancelled."""
+    while True:
+        await asyncio.sleep(settings.retention_interval)
+        try:
+            await ensure_event_partitions()
+            await prune()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Retention run failed.")
+
+def start_pruner() -> asyncio.Task:
+    return asyncio.create_task(run_pruner())
+
+async def stop_pruner(pruner: asyncio.Task) -> None:
+    pruner.cancel()
+    await asyncio.gather(pruner, return_exceptions=True)
@@ -0,0 +1,95 @@
+import logging
+import time
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from .api.crud import (
+    delivery_histories_query, move_events_to_quarantine, rebuild_delivery_counters, rebuild_rollups, update_delivery_statuses,
+)
+from .db import AsyncSessionLocal
+from .models import DeliveryState, is_valid_transition
+from .services.delivery_cache import invalidate_delivery_cache
+
+logger = logging.getLogger(__name__)
+
+
+class RevalidationReport(NamedTuple):
+    """Outcome of a revalidation."""
+    events: int
+    quarantined: int
+    deliveries: int
+    seconds: float
+
+
+async def apply_revalidation(session_factory: sessionmaker, invalid: List[dict], statuses: List[dict]) -> None:
+    """Quarantine the invalid events and fix the statuses of their deliveries, in one transaction."""
+    async with session_factory() as db:
+        async with db.begin():
+            if invalid:
+                await move_events_to_quarantine(db, invalid)
+            if statuses:
+                await update_delivery_statuses(db, statuses)
+
+async def revalidate_events(
+    session_factory: sessionmaker = AsyncSessionLocal,
+    dry_run: bool = False,
+    chunk_size: int = 10000,
+) -> RevalidationReport:
+    """
+    Check the history of every delivery, in (created_at, id) order, against TRANSITIONS,
+    e.g. for the events ingested before transitions were validated.
+    Invalid events are moved to quarantined_events, the deliveries get the state of their
+    last valid event, and the delivery counters and the rollups are rebuilt. With dry_run, nothing is changed.
+    Histories are read from a server-side cursor, and fixed chunk_size invalid events at
+    a time, each chunk in its own transaction, so memory stays bounded.
+    """
+    started = time.perf_counter()
+    events = quarantined = deliveries = 0
+    invalid: List[dict] = []
+    statuses: List[dict] = []
+    delivery: Optional[dict] = None
+
+    def close_delivery() -> None:
+        nonlocal deliveries
+        if delivery is not None and delivery["status"] != delivery["expected"]:
+            deliveries += 1
+            statuses.append(delivery)
+
+    async with session_factory() as reader:
+        result = await reader.stream(delivery_histories_query().execution_options(yield_per=chunk_size))
+        async for rows in result.partitions():
+            for event in rows:
+                events += 1
+                if delivery is None or delivery["delivery_id"] != event.delivery_id:
+                    close_delivery()
+                    delivery = {"delivery_id": event.delivery_id, "expected": event.status, "status": None, "updated_at": None}
+                state = DeliveryState(event.type)
+                if is_valid_transition(delivery["status"], state):
+                    delivery["status"] = state
+                    delivery["updated_at"] = event.created_at
+                    continue
+                quarantined += 1
+                invalid.append({
+                    "id": event.id,
+                    "delivery_name": event.name,
+                    "type": state,
+                    "previous_status": delivery["status"],
+                    "created_at": event.created_at,
+                })
+            if len(invalid) + len(statuses) >= chunk_size:
+                if not dry_run:
+                    await apply_revalidation(session_factory, invalid, statuses)
+                invalid, statuses = [], []
+        close_delivery()
+    if not dry_run and (invalid or statuses):
+        await apply_revalidation(session_factory, invalid, statuses)
+    if not dry_run and (quarantined or deliveries):
+        async with session_factory() as db:
+            async with db.begin():
+                await rebuild_delivery_counters(db)
+                await rebuild_rollups(db)
+        await invalidate_delivery_cache()
+    report = RevalidationReport(events, quarantined, deliveries, time.perf_counter() - started)
+    logger.info("Revalidated %d events: %d invalid, %d delivery statuses fixed.", events, quarantined, deliveries)
+    return report
@@ -1,2 +1,7 @@
-from .event_schemas import EventSchema, EventOutputSchema, EventType
-from .delivery_schemas import DeliverySchema, DeliveryCountSchema
+from .event_schemas import (
+    EventSchema, EventOutputSchema, EventType, EventAcceptedSchema, QueueStatsSchema,
+    EventBatchItemSchema, EventBatchSchema, EventBatchItemResultSchema, EventBatchResultSchema,
+    DeliveryTransitionSchema, AdmissionStatsSchema,
+)
+from .delivery_schemas import DeliverySchema, DeliveryCountSchema, RetentionReportSchema
+from .analytics_schemas import AnalyticsSchema, TimeInStateSchema, DurationBucketSchema
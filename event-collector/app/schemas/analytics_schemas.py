@@ -0,0 +1,34 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+from ..models import DeliveryState
+
+
+class DurationBucketSchema(BaseModel):
+    """Schema for a bucket of a time-in-state distribution."""
+    min_seconds: float = Field(..., ge=0, description="Lower bound of the time spent in the state")
+    max_seconds: Optional[float] = Field(None, description="Upper bound of the time spent in the state, none for the last bucket")
+    events: int = Field(..., ge=0, description="Number of transitions after a time in this bucket")
+
+
+class TimeInStateSchema(BaseModel):
+    """Schema for the time deliveries spent in a state before moving to the next one."""
+    previous_status: DeliveryState = Field(..., description="State the deliveries were in")
+    status: DeliveryState = Field(..., description="State the deliveries moved to")
+    events: int = Field(..., ge=0, description="Number of transitions")
+    mean_seconds: float = Field(..., ge=0, description="Mean time spent in the previous state")
+    buckets: List[DurationBucketSchema] = Field(..., description="Distribution of the time spent in the previous state")
+
+
+class AnalyticsSchema(BaseModel):
+    """Schema for the fleet analytics of a time range, read from the rollups."""
+    start: Optional[datetime] = Field(None, description="Start of the range, rounded down to the hour")
+    end: Optional[datetime] = Field(None, description="End of the range, rounded down to the hour")
+    deliveries: int = Field(..., ge=0, description="Number of deliveries started")
+    events: Dict[DeliveryState, int] = Field(..., description="Number of events of each state")
+    crash_rate: Optional[float] = Field(None, description="Share of the finished deliveries that crashed")
+    success_rate: Optional[float] = Field(None, description="Share of the finished deliveries that were delivered")
+    mean_flight_legs: Optional[float] = Field(None, description="Take-offs per started delivery")
+    time_in_state: List[TimeInStateSchema] = Field(..., description="Time spent in each state, by state pair")
@@ -1,16 +1,25 @@
 from pydantic import BaseModel, Field, ConfigDict
 
-from ..models import DeliveryState
+from ..models import DeliveryState, DELIVERY_NAME_MAX_LENGTH
 
 class DeliverySchema(BaseModel):
     """Schema for Delivery model."""
     model_config = ConfigDict(from_attributes=True)
     id: int = Field(None, description="Unique identifier for the delivery")
-    name: str = Field(..., description="Name of the delivery") # should have a unique constraint and a fixed length
+    name: str = Field(..., max_length=DELIVERY_NAME_MAX_LENGTH, description="Name of the delivery")
     status: DeliveryState = Field(..., description="Current status of the delivery")
 
 
 class DeliveryCountSchema(BaseModel):
     """Schema for counting deliveries."""
     ongoing_deliveries: int = Field(..., ge=0, description="Count of ongoing deliveries")
-    total_deliveries: int = Field(..., ge=0, description="Total count of deliveries") 
+    total_deliveries: int = Field(..., ge=0, description="Total count of deliveries")
+
+
+class RetentionReportSchema(BaseModel):
+    """Schema for the outcome of a retention run."""
+    deliveries: int = Field(..., ge=0, description="Number of pruned deliveries")
+    events: int = Field(..., ge=0, description="Number of pruned events, not counting those of dropped partitions")
+    partitions: int = Field(0, ge=0, description="Number of dropped or detached event partitions")
+    event_keys: int = Field(0, ge=0, description="Number of event keys pruned after the idempotency window")
+    seconds: float = Field(..., ge=0, description="Time spent pruning")
@@ -1,7 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
+from typing import List, Optional
 
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+from ..models import DELIVERY_NAME_MAX_LENGTH
 
 
 class EventType(str, Enum):
@@ -14,6 +17,17 @@ class EventType(str, Enum):
 class EventSchema(BaseModel):
     type: EventType = Field(..., description="Type of the event")
     created_at: datetime = Field(None, description="Timestamp of when the event was created")
+    idempotency_key: Optional[str] = Field(
+        None, min_length=1, max_length=200, description="Key shared by the retries of the event, to ingest it once",
+    )
+
+    @field_validator("created_at")
+    @classmethod
+    def to_naive_utc(cls, value: datetime) -> datetime:
+        """Timestamps are stored without time zone, as UTC."""
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
 
 class EventOutputSchema(BaseModel):
     """Schema for outputting event details."""
@@ -23,3 +37,57 @@ class EventOutputSchema(BaseModel):
     delivery_id: int = Field(..., description="ID of the delivery associated with the event")
     created_at: datetime = Field(..., description="Timestamp of when the event was created")
 
+class EventAcceptedSchema(BaseModel):
+    """Schema returned when an event has been queued for ingestion."""
+    event_id: str = Field(..., description="Server-assigned identifier of the queued event")
+    delivery_name: str = Field(..., description="Name of the delivery the event belongs to")
+    type: EventType = Field(..., description="Type of the event")
+    created_at: datetime = Field(..., description="Timestamp of the event, set on acceptance if not provided")
+    duplicate: bool = Field(False, description="Whether the event was already accepted, and was not queued again")
+
+class EventBatchItemSchema(EventSchema):
+    """Schema for an event of a batch, which names its delivery."""
+    delivery_name: str = Field(
+        ..., min_length=1, max_length=DELIVERY_NAME_MAX_LENGTH, description="Name of the delivery the event belongs to",
+    )
+
+class EventBatchSchema(BaseModel):
+    """Schema for ingesting many events of many deliveries at once. Events are applied in order."""
+    events: List[EventBatchItemSchema] = Field(..., min_length=1, max_length=5000, description="Events to ingest")
+
+class EventBatchItemResultSchema(BaseModel):
+    """Schema for the outcome of a single event of a batch."""
+    index: int = Field(..., ge=0, description="Position of the event in the batch")
+    status: str = Field(..., description="Outcome of the event: created, duplicate, or quarantined as an invalid transition")
+    event: Optional[EventOutputSchema] = Field(None, description="The ingested event, if it was created")
+
+class EventBatchResultSchema(BaseModel):
+    """Schema for the outcome of a batch, one item per event in the batch order."""
+    items: List[EventBatchItemResultSchema] = Field(..., description="Outcome of each event")
+
+class DeliveryTransitionSchema(BaseModel):
+    """Schema for a delivery status transition, as pushed to the live feed."""
+    event_id: int = Field(..., description="ID of the event that caused the transition")
+    delivery_id: int = Field(..., description="ID of the delivery")
+    delivery_name: str = Field(..., description="Name of the delivery")
+    status: EventType = Field(..., description="Status of the delivery after the event")
+    previous_status: Optional[EventType] = Field(None, description="Status of the delivery before the event, none if it is new")
+    created_at: datetime = Field(..., description="Timestamp of the event")
+
+class QueueStatsSchema(BaseModel):
+    """Schema for the ingest queue depth and lag."""
+    depth: int = Field(..., ge=0, description="Number of events waiting to be ingested")
+    partitions: list[int] = Field(..., description="Number of waiting events per partition")
+    lag_seconds: float = Field(..., ge=0, description="Age of the oldest waiting event")
+    dead_letters: int = Field(..., ge=0, description="Number of events that could not be ingested")
+
+
+class AdmissionStatsSchema(BaseModel):
+    """Schema for the admission control of the ingest routes."""
+    limit: int = Field(..., ge=0, description="Number of ingest requests admitted at once")
+    in_flight: int = Field(..., ge=0, description="Number of ingest requests being served")
+    overloaded: Optional[str] = Field(None, description="Why every ingest request is rejected, queue_depth or pool_wait")
+    queue_depth: int = Field(..., ge=0, description="Number of events waiting to be ingested when last measured")
+    pool_wait_seconds: float = Field(..., ge=0, description="Wait of the oldest connection checkout when last measured")
+    rejection_rate: float = Field(..., ge=0, le=1, description="Share of the ingest requests rejected over the last interval")
+
@@ -1,2 +1,22 @@
-from .event_service import ingest_event, get_delivery_events
-from .delivery_service import count_deliveries, get_ongoing_deliveries
+from .event_service import (
+    ingest_event,
+    ingest_events,
+    get_delivery_events,
+    stream_delivery_events,
+    encode_cursor,
+    decode_cursor,
+)
+from .delivery_service import (
+    count_deliveries,
+    get_ongoing_deliveries,
+    get_ongoing_deliveries_snapshot,
+    warm_delivery_cache,
+    ingest_transaction,
+    record_delivery_removal,
+    record_dedupe_keys,
+)
+from .delivery_feed import delivery_feed
+from .status_buffer import status_buffer
+from .dedupe_cache import dedupe_cache, dedupe_key
+from .export_service import export_events, EXPORT_FORMATS
+from .analytics_service import get_analytics
@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..schemas import AnalyticsSchema, TimeInStateSchema, DurationBucketSchema
+from ..models import DeliveryState, DURATION_BUCKETS
+from ..api.crud import read_hourly_rollups, read_transition_rollups
+
+
+def to_hour(value: Optional[datetime]) -> Optional[datetime]:
+    """Round a time down to the hour, the resolution of the rollups, as naive UTC like the stored times."""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def duration_bucket(bucket: int, events: int) -> DurationBucketSchema:
+    """A bucket of DURATION_BUCKETS, with its bounds in seconds."""
+    return DurationBucketSchema(
+        min_seconds=DURATION_BUCKETS[bucket - 1] if bucket > 0 else 0,
+        max_seconds=DURATION_BUCKETS[bucket] if bucket < len(DURATION_BUCKETS) else None,
+        events=events,
+    )
+
+async def get_analytics(db: AsyncSession, start: Optional[datetime] = None, end: Optional[datetime] = None) -> AnalyticsSchema:
+    """
+    Compute the fleet analytics of the hours from start to end from the rollups, so the cost
+    depends on the length of the range, not on the number of events.
+    Crash and success rates are shares of the deliveries that crashed or were delivered in the range,
+    and the mean flight legs the number of take-offs per delivery started in the range.
+    """
+    start, end = to_hour(start), to_hour(end)
+    events = {state: 0 for state in DeliveryState}
+    deliveries = 0
+    for row in await read_hourly_rollups(db, start, end):
+        events[row.status] = row.events
+        deliveries += row.deliveries
+    finished = events[DeliveryState.CRASHED] + events[DeliveryState.PARCEL_DELIVERED]
+
+    pairs: Dict[Tuple[DeliveryState, DeliveryState], List] = {}
+    for row in await read_transition_rollups(db, start, end):
+        pair = pairs.setdefault((row.previous_status, row.status), [0, 0.0, []])
+        pair[0] += row.events
+        pair[1] += row.seconds
+        pair[2].append(duration_bucket(row.bucket, row.events))
+
+    return AnalyticsSchema(
+        start=start,
+        end=end,
+        deliveries=deliveries,
+        events=events,
+        crash_rate=events[DeliveryState.CRASHED] / finished if finished else None,
+        success_rate=events[DeliveryState.PARCEL_DELIVERED] / finished if finished else None,
+        mean_flight_legs=events[DeliveryState.TAKEN_OFF] / deliveries if deliveries else None,
+        time_in_state=[
+            TimeInStateSchema(
+                previous_status=previous_status,
+                status=status,
+                events=count,
+                mean_seconds=seconds / count,
+                buckets=buckets,
+            )
+            for (previous_status, status), (count, seconds, buckets) in pairs.items()
+        ],
+    )
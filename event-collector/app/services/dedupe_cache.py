@@ -0,0 +1,119 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from redis.asyncio import Redis
+
+from ..core import settings
+from ..db import redis_client
+from ..schemas import EventSchema
+
+DEDUPE_KEY_PREFIX = "events:dedupe"
+
+
+def dedupe_key(delivery_name: str, event: EventSchema) -> Optional[str]:
+    """
+    Key shared by the copies of an event: its idempotency key if the client sent one,
+    otherwise its delivery, type and created_at. None if it has neither, as the copies
+    of an event stamped by the server cannot be told apart.
+    """
+    if event.idempotency_key is not None:
+        parts = ("key", delivery_name, event.idempotency_key)
+    elif event.created_at is not None:
+        parts = ("event", delivery_name, event.type.value, event.created_at.isoformat())
+    else:
+        return None
+    return hashlib.blake2b("\0".join(parts).encode(), digest_size=16).hexdigest()
+
+
+class InProcessDedupeCache:
+    """
+    Keys of the recent events kept in the memory of this process, with the id they were
+    acknowledged with. The least recently used keys are evicted beyond size, and keys expire
+    after ttl seconds. Copies sent to another process are only caught by event_keys.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+
+    async def get(self, keys: List[str]) -> Dict[str, str]:
+        """Return the id of each of the keys that is cached."""
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry[1] <= now:
+                del self._entries[key]
+                continue
+            self._entries.move_to_end(key)
+            found[key] = entry[0]
+        return found
+
+    async def add(self, entries: Dict[str, str], ttl: Optional[float] = None) -> None:
+        """Cache the keys with their id for ttl seconds, the ttl of the cache by default."""
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        for key, value in entries.items():
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    async def discard(self, keys: List[str]) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+
+
+class RedisDedupeCache:
+    """
+    Keys of the recent events kept in Redis, shared by all the workers, with the id they
+    were acknowledged with. Keys expire after ttl seconds; configure Redis with an LRU
+    maxmemory-policy to bound their memory.
+    """
+
+    def __init__(self, redis: Redis, ttl: float):
+        self.redis = redis
+        self.ttl = ttl
+
+    async def get(self, keys: List[str]) -> Dict[str, str]:
+        """Return the id of each of the keys that is cached."""
+        if not keys:
+            return {}
+        values = await self.redis.mget([f"{DEDUPE_KEY_PREFIX}:{key}" for key in keys])
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    async def add(self, entries: Dict[str, str], ttl: Optional[float] = None) -> None:
+        """Cache the keys with their id for ttl seconds, the ttl of the cache by default."""
+        ttl = ttl if ttl is not None else self.ttl
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, value in entries.items():
+                pipe.set(f"{DEDUPE_KEY_PREFIX}:{key}", value, px=int(ttl * 1000))
+            await pipe.execute()
+
+    async def discard(self, keys: List[str]) -> None:
+        if keys:
+            await self.redis.delete(*[f"{DEDUPE_KEY_PREFIX}:{key}" for key in keys])
+
+    async def clear(self) -> None:
+        keys = [key async for key in self.redis.scan_iter(f"{DEDUPE_KEY_PREFIX}:*")]
+        if keys:
+            await self.redis.delete(*keys)
+
+
+def create_dedupe_cache(backend: str):
+    """Create the cache of recent event keys for the given backend, "memory" or "redis"."""
+    if backend == "memory":
+        return InProcessDedupeCache(settings.dedupe_cache_size, settings.idempotency_window)
+    if backend == "redis":
+        return RedisDedupeCache(redis_client, settings.idempotency_window)
+    raise ValueError(f"Unknown dedupe cache backend: {backend}")
+
+
+dedupe_cache = create_dedupe_cache(settings.dedupe_cache_backend)
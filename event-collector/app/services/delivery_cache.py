@@ -0,0 +1,273 @@
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import orjson
+
+from redis.asyncio import Redis
+
+from ..core import settings
+from ..db import redis_client
+from ..schemas import DeliverySchema
+from .serialization import dump_delivery
+
+ONGOING_KEY = "deliveries:ongoing"
+VERSION_KEY = "deliveries:ongoing:version"
+WARMING_KEY = "deliveries:ongoing:warming"
+PENDING_KEY = "deliveries:ongoing:pending"
+INVALIDATIONS_CHANNEL = "deliveries:ongoing:invalidations"
+# A warm in progress for longer than this is considered dead, and abandoned.
+WARM_TIMEOUT = 60
+
+logger = logging.getLogger(__name__)
+
+
+class DeliverySnapshot(NamedTuple):
+    """Serialized list of ongoing deliveries, ready to be sent, and its ETag."""
+    etag: str
+    body: bytes
+
+
+def build_snapshot(deliveries: List[bytes]) -> DeliverySnapshot:
+    """Build a snapshot from the serialized deliveries, which must be sorted by id."""
+    body = b"[" + b",".join(deliveries) + b"]"
+    return DeliverySnapshot(f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body)
+
+
+DeliveryLoader = Callable[[], Awaitable[List[DeliverySchema]]]
+
+
+class InProcessDeliveryCache:
+    """
+    Ongoing deliveries kept in the memory of this process, by name, with their id and
+    serialized once, so a snapshot is only a sort and a join.
+    Only consistent when a single process ingests events and serves the reads.
+    """
+
+    def __init__(self):
+        self._deliveries: Optional[Dict[str, Tuple[int, bytes]]] = None
+        self._snapshot: Optional[DeliverySnapshot] = None
+        self._warming = 0
+        self._pending: Dict[str, Optional[Tuple[int, bytes]]] = {}
+        self._generation = 0
+
+    async def warm(self, load: DeliveryLoader) -> None:
+        """
+        Fill the cache with the deliveries returned by load. The changes applied while
+        loading are replayed on top of them, as load may not see them yet.
+        A clear while loading abandons the warm.
+        """
+        generation = self._generation
+        self._warming += 1
+        try:
+            deliveries = {delivery.name: (delivery.id, dump_delivery(delivery)) for delivery in await load()}
+            if generation == self._generation:
+                self._deliveries = deliveries
+                self._update(self._pending)
+        finally:
+            self._warming -= 1
+            if not self._warming:
+                self._pending = {}
+
+    async def apply(self, changes: Dict[str, Optional[DeliverySchema]]) -> None:
+        """Add or replace the deliveries of changes, and remove those mapped to None."""
+        entries = {
+            name: (delivery.id, dump_delivery(delivery)) if delivery is not None else None
+            for name, delivery in changes.items()
+        }
+        if self._warming:
+            self._pending.update(entries)
+        if self._deliveries is not None:
+            self._update(entries)
+
+    def _update(self, entries: Dict[str, Optional[Tuple[int, bytes]]]) -> None:
+        for name, entry in entries.items():
+            if entry is None:
+                self._deliveries.pop(name, None)
+            else:
+                self._deliveries[name] = entry
+        self._snapshot = None
+
+    async def snapshot(self) -> Optional[DeliverySnapshot]:
+        """Return the ongoing deliveries, or None if the cache is cold."""
+        if self._deliveries is None:
+            return None
+        if self._snapshot is None:
+            self._snapshot = build_snapshot([body for _, body in sorted(self._deliveries.values())])
+        return self._snapshot
+
+    async def clear(self) -> None:
+        self._deliveries = None
+        self._snapshot = None
+        self._generation += 1
+
+
+# Changes are only applied to a warm cache, otherwise a partial cache would look warm.
+# While a warm is in progress they are also kept in the pending hash, to be replayed
+# on top of the deliveries it loaded.
+APPLY_SCRIPT = """
+local warm = redis.call('EXISTS', KEYS[2]) == 1
+local warming = redis.call('EXISTS', KEYS[3]) == 1
+for i = 1, #ARGV, 2 do
+    if warm then
+        if ARGV[i + 1] == '' then
+            redis.call('HDEL', KEYS[1], ARGV[i])
+        else
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+    if warming then
+        redis.call('HSET', KEYS[4], ARGV[i], ARGV[i + 1])
+    end
+end
+if warm then
+    return redis.call('INCR', KEYS[2])
+end
+return 0
+"""
+
+# Replace the deliveries with the loaded ones and replay the pending changes, unless
+# the warm was abandoned by a clear or a timeout.
+FILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 1, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local pending = redis.call('HGETALL', KEYS[4])
+for i = 1, #pending, 2 do
+    if pending[i + 1] == '' then
+        redis.call('HDEL', KEYS[1], pending[i])
+    else
+        redis.call('HSET', KEYS[1], pending[i], pending[i + 1])
+    end
+end
+return redis.call('INCR', KEYS[2])
+"""
+
+# The last warm in progress drops the pending changes.
+END_WARM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 and redis.call('DECR', KEYS[1]) <= 0 then
+    redis.call('DEL', KEYS[1], KEYS[2])
+end
+"""
+
+
+class RedisDeliveryCache:
+    """
+    Ongoing deliveries kept in a Redis hash, shared by all the workers.
+    Every change bumps a version, so each worker only rebuilds its
+    serialized snapshot when the deliveries changed.
+    """
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._apply = redis.register_script(APPLY_SCRIPT)
+        self._fill = redis.register_script(FILL_SCRIPT)
+        self._end_warm = redis.register_script(END_WARM_SCRIPT)
+        self._version: Optional[str] = None
+        self._snapshot: Optional[DeliverySnapshot] = None
+
+    async def warm(self, load: DeliveryLoader) -> None:
+        """
+        Fill the cache with the deliveries returned by load. The changes applied by any
+        worker while loading are replayed on top of them, as load may not see them yet.
+        A clear while loading abandons the warm.
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(WARMING_KEY)
+            pipe.expire(WARMING_KEY, WARM_TIMEOUT)
+            await pipe.execute()
+        try:
+            args = []
+            for delivery in await load():
+                args += [delivery.name, dump_delivery(delivery)]
+            await self._fill(keys=[ONGOING_KEY, VERSION_KEY, WARMING_KEY, PENDING_KEY], args=args)
+        finally:
+            await self._end_warm(keys=[WARMING_KEY, PENDING_KEY])
+
+    async def apply(self, changes: Dict[str, Optional[DeliverySchema]]) -> None:
+        """Add or replace the deliveries of changes, and remove those mapped to None."""
+        args = []
+        for name, delivery in changes.items():
+            args += [name, dump_delivery(delivery) if delivery is not None else ""]
+        await self._apply(keys=[ONGOING_KEY, VERSION_KEY, WARMING_KEY, PENDING_KEY], args=args)
+
+    async def snapshot(self) -> Optional[DeliverySnapshot]:
+        """Return the ongoing deliveries, or None if the cache is cold."""
+        version = await self.redis.get(VERSION_KEY)
+        if version is None:
+            return None
+        if version != self._version:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.get(VERSION_KEY)
+                pipe.hvals(ONGOING_KEY)
+                version, values = await pipe.execute()
+            values.sort(key=lambda value: orjson.loads(value)["id"])
+            self._snapshot = build_snapshot([value.encode() for value in values])
+            self._version = version
+        return self._snapshot
+
+    async def clear(self) -> None:
+        await self.redis.delete(ONGOING_KEY, VERSION_KEY, WARMING_KEY, PENDING_KEY)
+        self._version = None
+        self._snapshot = None
+
+
+def create_delivery_cache(backend: str):
+    """Create the cache of ongoing deliveries for the given backend, "memory" or "redis"."""
+    if backend == "memory":
+        return InProcessDeliveryCache()
+    if backend == "redis":
+        return RedisDeliveryCache(redis_client)
+    raise ValueError(f"Unknown delivery cache backend: {backend}")
+
+
+delivery_cache = create_delivery_cache(settings.delivery_cache_backend)
+
+
+async def invalidate_delivery_cache(redis: Redis = redis_client) -> None:
+    """
+    Clear the delivery cache of every collector process, after a command run in its own process,
+    such as an import, changed the deliveries behind their back. The in-process caches of the
+    collectors are cleared by their invalidation listener, see listen_for_invalidations.
+    """
+    await delivery_cache.clear()
+    await redis.publish(INVALIDATIONS_CHANNEL, "clear")
+
+async def listen_for_invalidations(redis: Redis = redis_client) -> None:
+    """
+    Clear the in-process delivery cache on each invalidation, and whenever the subscription
+    is lost, as invalidations may have been published meanwhile.
+    """
+    subscribed = False
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATIONS_CHANNEL)
+                async for message in pubsub.listen():
+                    # Redis pub/sub reconnects by itself, and then confirms the subscription again.
+                    if message["type"] == "message" or (message["type"] == "subscribe" and subscribed):
+                        await delivery_cache.clear()
+                    subscribed = True
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Delivery cache invalidation subscription failed, resubscribing.")
+            await delivery_cache.clear()
+            await asyncio.sleep(1)
+
+def start_invalidation_listener() -> Optional[asyncio.Task]:
+    """Start the invalidation listener, only needed by the in-process delivery cache."""
+    if settings.delivery_cache_backend != "memory":
+        return None
+    return asyncio.create_task(listen_for_invalidations())
+
+async def stop_invalidation_listener(listener: Optional[asyncio.Task]) -> None:
+    if listener is None:
+        return
+    listener.cancel()
+    await asyncio.gather(listener, return_exceptions=True)
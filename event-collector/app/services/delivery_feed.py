@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+from typing import List, Optional, Set
+
+from redis.asyncio import Redis
+
+from ..core import settings
+from ..db import redis_client
+from ..schemas import DeliveryTransitionSchema
+
+TRANSITIONS_CHANNEL = "deliveries:transitions"
+
+logger = logging.getLogger(__name__)
+
+
+async def publish_transitions(transitions: List[DeliveryTransitionSchema], redis: Redis = redis_client) -> None:
+    """Publish committed transitions to every worker through Redis pub/sub."""
+    async with redis.pipeline(transaction=False) as pipe:
+        for transition in transitions:
+            pipe.publish(TRANSITIONS_CHANNEL, transition.model_dump_json())
+        await pipe.execute()
+
+
+class FeedSubscription:
+    """
+    Transitions waiting to be sent to one client, optionally filtered by delivery name and status.
+    The buffer is bounded: a client that does not keep up is dropped, and then gets None.
+    """
+
+    def __init__(self, delivery_name: Optional[str] = None, status: Optional[str] = None, buffer_size: int = 100):
+        self.delivery_name = delivery_name
+        self.status = status
+        self.queue: asyncio.Queue = asyncio.Queue(buffer_size)
+        self.dropped = False
+
+    def matches(self, transition: dict) -> bool:
+        return (
+            (self.delivery_name is None or transition["delivery_name"] == self.delivery_name)
+            and (self.status is None or transition["status"] == self.status)
+        )
+
+    def offer(self, message: str) -> bool:
+        """Buffer a message. Returns False, and drops the subscription, if the buffer is full."""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return False
+
+
+class DeliveryFeed:
+    """
+    Fans out the transitions published on Redis to the subscriptions of this process.
+    A single Redis subscription per process is started with the first client.
+    """
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self.subscriptions: Set[FeedSubscription] = set()
+        self._listener: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+
+    async def subscribe(self, delivery_name: Optional[str] = None, status: Optional[str] = None) -> FeedSubscription:
+        """
+        Add a subscription, once the Redis subscription is ready.
+        Raises asyncio.TimeoutError if it is not ready within feed_subscribe_timeout.
+        """
+        subscription = FeedSubscription(delivery_name, status, settings.feed_buffer_size)
+        self.subscriptions.add(subscription)
+        if self._listener is None or self._listener.done():
+            self._ready = asyncio.Event()
+            self._listener = asyncio.create_task(self._listen())
+        try:
+            await asyncio.wait_for(self._ready.wait(), settings.feed_subscribe_timeout)
+        except BaseException:
+            self.unsubscribe(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription: FeedSubscription) -> None:
+        self.subscriptions.discard(subscription)
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(TRANSITIONS_CHANNEL)
+                    self._ready.set()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Delivery feed subscription failed, resubscribing.")
+                # New clients wait for the resubscription, rather than miss transitions meanwhile.
+                self._ready.clear()
+                await asyncio.sleep(1)
+
+    def _dispatch(self, message: str) -> None:
+        transition = json.loads(message)
+        for subscription in list(self.subscriptions):
+            if subscription.matches(transition) and not subscription.offer(message):
+                logger.warning("Dropping a delivery feed client that does not keep up.")
+                self.unsubscribe(subscription)
+
+
+delivery_feed = DeliveryFeed(redis_client)
@@ -1,51 +1,184 @@
-from typing import List
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..schemas import DeliverySchema, DeliveryCountSchema
-from ..models import Delivery, DeliveryState
+from ..schemas import DeliverySchema, DeliveryCountSchema, DeliveryTransitionSchema
+from ..models import DeliveryState
 from ..api.crud import (
-    count_deliveries_by_state,
-    count_total_deliveries,
-    read_delivery_by_name,
-    update_delivery,
-    handle_new_delivery,
-    get_deliveries_by_state
+    read_delivery_counters,
+    read_ongoing_deliveries,
+    random_shard,
 )
+from .delivery_cache import DeliverySnapshot, build_snapshot, delivery_cache
+from .delivery_feed import publish_transitions
+from .dedupe_cache import dedupe_cache
+from .serialization import dump_delivery
+from .status_buffer import BufferedStatus, status_buffer
+from ..metrics import record_ingested_events
 
+logger = logging.getLogger(__name__)
 
 ONGOING_STATES = (DeliveryState.TAKEN_OFF, DeliveryState.PARCEL_COLLECTED, DeliveryState.LANDED)
+COUNTER_SHARD = "counter_shard"
+DELIVERY_CHANGES = "delivery_changes"
+DELIVERY_TRANSITIONS = "delivery_transitions"
+DEDUPE_KEYS = "dedupe_keys"
+BUFFERED_STATUSES = "buffered_statuses"
+WRITTEN_DELIVERIES = "written_deliveries"
+REMOVED_DELIVERIES = "removed_deliveries"
+TRANSACTION_KEYS = (DELIVERY_CHANGES, DELIVERY_TRANSITIONS, DEDUPE_KEYS, BUFFERED_STATUSES, WRITTEN_DELIVERIES, REMOVED_DELIVERIES)
 
-async def get_delivery_counts(db: AsyncSession) -> DeliveryCountSchema:
+async def count_deliveries(db: AsyncSession) -> DeliveryCountSchema:
     """
     Count ongoing and total deliveries.
-    Returns a DeliveryCountSchema with the counts of ongoing and total deliveries."""
-    """"""
-    ongoing_deliveries = await count_deliveries_by_state(db, ONGOING_STATES)
-    total_deliveries = await count_total_deliveries(db)
+    Returns a DeliveryCountSchema with the counts of ongoing and total deliveries.
+    The counts are read from the delivery counters, which ingestion keeps up to date,
+    so this does not depend on the size of the deliveries table.
+    The status changes not flushed yet by the write-behind mode of this process are counted too.
+    """
+    counters = await read_delivery_counters(db)
     return DeliveryCountSchema(
-        ongoing_deliveries=ongoing_deliveries,
-        total_deliveries=total_deliveries
+        ongoing_deliveries=counters["ongoing"] + status_buffer.ongoing_delta(),
+        total_deliveries=counters["total"]
     )
 
 async def get_ongoing_deliveries(db: AsyncSession) -> List[DeliverySchema]:
     """
     Retrieve all ongoing deliveries.
-    Returns a list of DeliverySchema for ongoing deliveries.
+    Returns a list of DeliverySchema for ongoing deliveries, built from the selected
+    columns without validation, as they come from the database.
+    The statuses buffered by the write-behind mode take precedence over Postgres.
+    """
+    rows = await read_ongoing_deliveries(db)
+    buffered = status_buffer.items()
+    if not buffered:
+        return [DeliverySchema.model_construct(id=row.id, name=row.name, status=row.status) for row in rows]
+    deliveries = {row.name: (row.id, row.status) for row in rows}
+    deliveries.update((name, (entry.id, entry.status)) for name, entry in buffered)
+    return [
+        DeliverySchema.model_construct(id=delivery_id, name=name, status=status)
+        for name, (delivery_id, status) in sorted(deliveries.items(), key=lambda item: item[1][0])
+        if status in ONGOING_STATES
+    ]
+
+
+async def warm_delivery_cache(db: AsyncSession) -> None:
+    """Load the ongoing deliveries from Postgres into the delivery cache."""
+    await delivery_cache.warm(lambda: get_ongoing_deliveries(db))
+
+async def get_ongoing_deliveries_snapshot(db: AsyncSession) -> DeliverySnapshot:
     """
-    deliveries = await get_deliveries_by_state(db, ONGOING_STATES)
-    return [DeliverySchema.from_orm(delivery) for delivery in deliveries]
+    Retrieve all ongoing deliveries from the delivery cache, serialized and with their ETag.
+    A cold cache is warmed from Postgres first. If the cache was cleared meanwhile,
+    the deliveries are served straight from Postgres.
+    """
+    snapshot = await delivery_cache.snapshot()
+    if snapshot is None:
+        await warm_delivery_cache(db)
+        snapshot = await delivery_cache.snapshot()
+    if snapshot is None:
+        snapshot = build_snapshot([dump_delivery(delivery) for delivery in await get_ongoing_deliveries(db)])
+    return snapshot
 
-async def handle_delivery_event(db: AsyncSession, event_type: DeliveryState, delivery_name: str) -> Delivery:
+def transaction_shard(db: AsyncSession) -> int:
     """
-    Handle a delivery event by either creating a new delivery or updating an existing one.
-    If the delivery does not exist, it will be created with the provided name and event type
-    If it exists, its status will be updated to the provided event type.
-    Returns the Delivery object.
+    Shard of the delivery counters and rollups updated by the ingest transaction of db:
+    the one given to ingest_transaction, otherwise a random one. A transaction updates a
+    single shard, so it only ever waits on the counter rows of that shard.
     """
-    delivery = await read_delivery_by_name(db, delivery_name)
-    if not delivery:
-        delivery = await handle_new_delivery(db, delivery_name, event_type)
+    return db.info.setdefault(COUNTER_SHARD, random_shard())
+
+def record_delivery_change(db: AsyncSession, delivery_id: int, delivery_name: str, status: DeliveryState) -> None:
+    """Record the new status of a delivery, to be applied to the delivery cache once committed."""
+    changes = db.info.setdefault(DELIVERY_CHANGES, {})
+    if status in ONGOING_STATES:
+        changes[delivery_name] = DeliverySchema(id=delivery_id, name=delivery_name, status=status)
     else:
-        delivery = await update_delivery(db, delivery_name, event_type)
-    return delivery
+        changes[delivery_name] = None
+
+def record_delivery_removal(db: AsyncSession, delivery_name: str) -> None:
+    """Record the deletion of a delivery, to be applied to the delivery cache and the status buffer once committed."""
+    db.info.setdefault(DELIVERY_CHANGES, {})[delivery_name] = None
+    db.info.setdefault(REMOVED_DELIVERIES, set()).add(delivery_name)
+
+def buffered_status(db: AsyncSession, delivery_name: str) -> Optional[BufferedStatus]:
+    """The status of a delivery in the status buffer, as changed by the ingest transaction of db so far."""
+    statuses = db.info.get(BUFFERED_STATUSES, {})
+    if delivery_name in statuses:
+        return statuses[delivery_name]
+    return status_buffer.get(delivery_name)
+
+def record_buffered_status(db: AsyncSession, delivery_name: str, status: Optional[BufferedStatus], written: bool) -> None:
+    """
+    Record the new status of a delivery, to be applied to the status buffer once committed,
+    None to drop it from the buffer. written tells whether the transaction wrote the deliveries row, rather than leaving it to the next flush.
+    """
+    db.info.setdefault(BUFFERED_STATUSES, {})[delivery_name] = status
+    if written:
+        db.info.setdefault(WRITTEN_DELIVERIES, set()).add(delivery_name)
+
+def record_transition(db: AsyncSession, transition: DeliveryTransitionSchema) -> None:
+    """Record a delivery transition, to be pushed to the live feed once committed."""
+    db.info.setdefault(DELIVERY_TRANSITIONS, []).append(transition)
+
+def record_dedupe_keys(db: AsyncSession, keys: Dict[str, str]) -> None:
+    """Record the dedupe keys of ingested events, with their id, to be added to the dedupe cache once committed."""
+    db.info.setdefault(DEDUPE_KEYS, {}).update(keys)
+
+async def publish_delivery_changes(db: AsyncSession) -> None:
+    """
+    Apply the committed delivery changes to the status buffer and the delivery cache, push the
+    committed transitions to the live feed, and add the committed dedupe keys
+    to the dedupe cache.
+    If the cache update fails, the cache is cleared so that it is warmed again from Postgres.
+    """
+    changes = db.info.pop(DELIVERY_CHANGES, None)
+    transitions = db.info.pop(DELIVERY_TRANSITIONS, None)
+    keys = db.info.pop(DEDUPE_KEYS, None)
+    statuses = db.info.pop(BUFFERED_STATUSES, None)
+    written = db.info.pop(WRITTEN_DELIVERIES, set())
+    removed = db.info.pop(REMOVED_DELIVERIES, None)
+    if statuses:
+        status_buffer.apply(statuses, written)
+    if removed:
+        status_buffer.discard(removed)
+    if changes:
+        try:
+            await delivery_cache.apply(changes)
+        except Exception:
+            logger.exception("Failed to update the delivery cache, clearing it.")
+            await delivery_cache.clear()
+    if transitions:
+        record_ingested_events(transition.status.value for transition in transitions)
+        try:
+            await publish_transitions(transitions)
+        except Exception:
+            logger.exception("Failed to publish %d delivery transitions.", len(transitions))
+    if keys:
+        try:
+            await dedupe_cache.add(keys)
+        except Exception:
+            # Copies of these events are still rejected by the event_keys table.
+            logger.exception("Failed to add %d keys to the dedupe cache.", len(keys))
+
+@asynccontextmanager
+async def ingest_transaction(db: AsyncSession, shard: Optional[int] = None):
+    """
+    Run the ingestion of events in a transaction, then publish the delivery changes,
+    buffered statuses, transitions and dedupe keys it recorded. Those of a rolled back transaction are discarded.
+    The transaction updates the given shard of the counters, see transaction_shard.
+    """
+    if shard is not None:
+        db.info[COUNTER_SHARD] = shard
+    try:
+        async with db.begin():
+            yield db
+    except BaseException:
+        for key in TRANSACTION_KEYS:
+            db.info.pop(key, None)
+        raise
+    finally:
+        db.info.pop(COUNTER_SHARD, None)
+    await publish_delivery_changes(db)
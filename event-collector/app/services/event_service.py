@@ -1,40 +1,269 @@
-from typing import List, Optional
+import base64
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Set, Tuple
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
-from sqlalchemy.orm import joinedload
 
-from ..schemas import EventSchema, EventOutputSchema
-from ..models import Delivery, Event
-from .delivery_service import handle_delivery_event
-from ..api.crud import create_event
+from ..schemas import (
+    EventSchema,
+    EventOutputSchema,
+    EventBatchItemSchema,
+    EventBatchItemResultSchema,
+    DeliveryTransitionSchema,
+)
+from ..models import DeliveryState, is_valid_transition, walk_transitions
+from ..api.crud import (
+    ingest_delivery_event, create_events, insert_deliveries, lock_deliveries, flush_delivery_statuses, delivery_events_query,
+    delivery_exists, claim_event_keys, quarantine_events, add_to_rollups, append_delivery_event,
+)
+from ..core import settings
+from ..metrics import record_duplicate_events, record_quarantined_events
+from .delivery_service import (
+    record_delivery_change, record_transition, record_dedupe_keys, transaction_shard, buffered_status, record_buffered_status,
+)
+from .status_buffer import BufferedStatus
+from .dedupe_cache import dedupe_cache, dedupe_key
+from .serialization import dump_events, dump_events_ndjson
 
 
-async def ingest_event(db: AsyncSession, delivery_name: str, event: EventSchema) -> EventOutputSchema:
+class EventPage(NamedTuple):
+    """A page of events serialized as a JSON list, with their number and the (created_at, id) key of the last one."""
+    body: bytes
+    count: int
+    last: Optional[Tuple[datetime, int]]
+
+
+
+async def ingest_event(
+    db: AsyncSession,
+    delivery_name: str,
+    event: EventSchema,
+    dedupe_key: Optional[str] = None,
+) -> Optional[EventOutputSchema]:
     """
-    Ingest an event for a delivery. If the delivery does not exist, create it.
-    If the delivery exists, update its status and create a new event.
-    Returns the created or updated event as EventOutputSchema.
-    If the delivery does not exist, it will be created with the initial event type.
-    If the delivery exists, it will be updated with the new event type.
+    Ingest an event for a delivery, creating the delivery if needed, in a single statement, see ingest_delivery_event.
+    Returns the created event, or None if it was quarantined as an invalid transition,
+    or skipped as a copy of an event already ingested with the same dedupe_key.
+    In the write-behind mode, a buffered status is used instead, see append_delivery_event.
     """
-    delivery = await handle_delivery_event(db, event.type, delivery_name)
-    new_event = await create_event(db, delivery.name, event.type)
-    return EventOutputSchema.from_orm(new_event)
+    if dedupe_key is not None and not await claim_event_keys(db, [dedupe_key]):
+        record_duplicate_events("table")
+        return None
+    state = DeliveryState(event.type.value)
+    buffered = buffered_status(db, delivery_name) if settings.status_write_behind else None
+    new_event = None
+    if buffered is not None and not is_valid_transition(buffered.status, state) and buffered.dirty:
+        await quarantine_events(db, [{
+            "delivery_name": delivery_name,
+            "type": state,
+            "previous_status": buffered.status,
+            "created_at": event.created_at or datetime.now(timezone.utc).replace(tzinfo=None),
+        }])
+        record_quarantined_events()
+        return None
+    if buffered is not None and is_valid_transition(buffered.status, state):
+        new_event = await append_delivery_event(
+            db, buffered.id, buffered.flushed, state, buffered.status, buffered.updated_at,
+            event.created_at, transaction_shard(db),
+        )
+        previous_status = buffered.status
+    written = new_event is None
+    if written:
+        # Postgres decides for a delivery that is not buffered or changed behind the buffer,
+        # and confirms an invalid transition from a flushed status.
+        new_event = await ingest_delivery_event(db, delivery_name, state, event.created_at, transaction_shard(db))
+        if new_event is None:
+            if buffered is not None:
+                record_buffered_status(db, delivery_name, None, True)
+            record_quarantined_events()
+            return None
+        previous_status = new_event.previous_status
+    if settings.status_write_behind:
+        record_buffered_status(db, delivery_name, BufferedStatus(
+            new_event.delivery_id, new_event.type, new_event.created_at, new_event.type if written else buffered.flushed,
+        ), written)
+    record_delivery_change(db, new_event.delivery_id, new_event.name, new_event.type)
+    record_transition(db, DeliveryTransitionSchema(
+        event_id=new_event.id,
+        delivery_id=new_event.delivery_id,
+        delivery_name=new_event.name,
+        status=new_event.type.value,
+        previous_status=previous_status.value if previous_status else None,
+        created_at=new_event.created_at,
+    ))
+    return EventOutputSchema.model_validate(new_event)
 
-async def get_delivery_events(db: AsyncSession, delivery_name: str) -> Optional[List[EventOutputSchema]]:
+async def find_duplicate_events(db: AsyncSession, keys: List[Optional[str]]) -> Set[int]:
     """
-    Get all events for a specific delivery by its name.
-    Returns a list of EventOutputSchema or None if the delivery does not exist.
-    If the delivery exists but has no events, returns an empty list.
+    Return the indexes of the events whose dedupe key is in the dedupe cache, repeats an earlier
+    key of the list, or was already claimed in the event_keys table. The other keys are claimed.
+    Only the keys missing from the cache are looked up in Postgres.
     """
-    delivery_query = (
-        select(Delivery)
-        .options(joinedload(Delivery.events))
-        .filter(Delivery.name == delivery_name)
-    )
-    result = await db.execute(delivery_query)
-    delivery = result.scalars().first()
-    if not delivery:
+    cached = await dedupe_cache.get([key for key in keys if key is not None])
+    duplicates = set()
+    new_keys = set()
+    for index, key in enumerate(keys):
+        if key is None:
+            continue
+        if key in cached:
+            record_duplicate_events("cache")
+            duplicates.add(index)
+        elif key in new_keys:
+            record_duplicate_events("batch")
+            duplicates.add(index)
+        else:
+            new_keys.add(key)
+    if new_keys:
+        claimed = await claim_event_keys(db, list(new_keys))
+        for index, key in enumerate(keys):
+            if key in new_keys and key not in claimed and index not in duplicates:
+                record_duplicate_events("table")
+                duplicates.add(index)
+    return duplicates
+
+async def ingest_events(db: AsyncSession, events: List[EventBatchItemSchema]) -> List[EventBatchItemResultSchema]:
+    """
+    Ingest a batch of events of many deliveries with a few set-based statements, checking
+    the events against the statuses of their deliveries, locked, and quarantining invalid transitions.
+    Copies of already ingested events are skipped, see find_duplicate_events.
+    Returns the outcome of each event, in the batch order.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    keys = [dedupe_key(event.delivery_name, event) for event in events]
+    duplicates = await find_duplicate_events(db, keys)
+    results = [EventBatchItemResultSchema(index=index, status="duplicate") for index in range(len(events))]
+    indexes = [index for index in range(len(events)) if index not in duplicates]
+    if not indexes:
+        return results
+    created_at = [event.created_at or now for event in events]
+    histories: Dict[str, List[int]] = {}
+    for index in indexes:
+        histories.setdefault(events[index].delivery_name, []).append(index)
+    new_deliveries = {}
+    for name, history in histories.items():
+        final, valid = walk_transitions(None, [DeliveryState(events[index].type.value) for index in history])
+        new_deliveries[name] = (final, created_at[[index for index, is_valid in zip(history, valid) if is_valid][-1]])
+    inserted = await insert_deliveries(db, new_deliveries, transaction_shard(db))
+    # The events are checked against the locked statuses, which no concurrent ingest can change before commit.
+    deliveries = await lock_deliveries(db, list(histories))
+
+    current = {
+        name: (None, None) if name in inserted else (delivery.status, delivery.updated_at)
+        for name, delivery in deliveries.items()
+    }
+    accepted, previous_statuses, rollups, quarantined = [], [], [], []
+    for index in indexes:
+        event = events[index]
+        state = DeliveryState(event.type.value)
+        previous_status, previous_at = current[event.delivery_name]
+        if is_valid_transition(previous_status, state):
+            accepted.append(index)
+            previous_statuses.append(previous_status)
+            rollups.append({
+                "created_at": created_at[index], "previous_status": previous_status,
+                "status": state, "previous_at": previous_at,
+            })
+            current[event.delivery_name] = (state, created_at[index])
+        else:
+            results[index] = EventBatchItemResultSchema(index=index, status="quarantined")
+            quarantined.append({
+                "delivery_name": event.delivery_name,
+                "type": state,
+                "previous_status": previous_status,
+                "created_at": created_at[index],
+            })
+    changed = {events[index].delivery_name for index in accepted} - inserted
+    updated = [
+        {"delivery_id": delivery.id, "status": current[name][0], "updated_at": current[name][1], "expected": delivery.status}
+        for name, delivery in deliveries.items() if name in changed
+    ]
+    if updated:
+        await flush_delivery_statuses(db, updated, transaction_shard(db))
+    for name, delivery in deliveries.items():
+        record_delivery_change(db, delivery.id, name, current[name][0])
+    if quarantined:
+        await quarantine_events(db, quarantined)
+        record_quarantined_events(len(quarantined))
+    if not accepted:
+        return results
+
+    new_events = await create_events(db, [
+        {
+            "delivery_id": deliveries[events[index].delivery_name].id,
+            "type": DeliveryState(events[index].type.value),
+            "created_at": created_at[index],
+        }
+        for index in accepted
+    ])
+    await add_to_rollups(db, rollups, transaction_shard(db))
+    for index, new_event, previous_status in zip(accepted, new_events, previous_statuses):
+        record_transition(db, DeliveryTransitionSchema(
+            event_id=new_event.id,
+            delivery_id=new_event.delivery_id,
+            delivery_name=events[index].delivery_name,
+            status=new_event.type.value,
+            previous_status=previous_status.value if previous_status else None,
+            created_at=new_event.created_at,
+        ))
+        results[index] = EventBatchItemResultSchema(
+            index=index, status="created", event=EventOutputSchema.model_validate(new_event),
+        )
+    record_dedupe_keys(db, {
+        keys[index]: str(new_event.id) for index, new_event in zip(accepted, new_events) if keys[index] is not None
+    })
+    return results
+
+def encode_cursor(key: Tuple[datetime, int]) -> str:
+    """Encode the (created_at, id) key of an event into an opaque pagination cursor."""
+    created_at, event_id = key
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()},{event_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decode a pagination cursor into a (created_at, id) key. Raises ValueError if it is invalid."""
+    try:
+        created_at, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+        return datetime.fromisoformat(created_at), int(event_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+async def get_delivery_events(
+    db: AsyncSession,
+    delivery_name: str,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+) -> Optional[EventPage]:
+    """
+    Get the events for a specific delivery by its name, ordered by creation.
+    At most limit events are returned, starting after the (created_at, id) key after.
+    Returns the page of events, serialized as EventOutputSchema straight from the rows,
+    or None if the delivery does not exist.
+    If the delivery exists but has no more events, the page is an empty list.
+    """
+    result = await db.execute(delivery_events_query(delivery_name, after).limit(limit))
+    events = result.all()
+    if not events and not await delivery_exists(db, delivery_name):
+        return None
+    last = (events[-1].created_at, events[-1].id) if events else None
+    return EventPage(dump_events(events), len(events), last)
+
+async def stream_delivery_events(
+    db: AsyncSession,
+    delivery_name: str,
+    after: Optional[Tuple[datetime, int]] = None,
+    chunk_size: int = 1000,
+) -> Optional[AsyncIterator[bytes]]:
+    """
+    Stream the events for a specific delivery by its name as NDJSON, ordered by creation.
+    Events are fetched chunk_size at a time from a server-side cursor, so memory
+    does not grow with the length of the history.
+    Returns None if the delivery does not exist.
+    """
+    if not await delivery_exists(db, delivery_name):
         return None
-    return [EventOutputSchema.from_orm(event) for event in delivery.events]
+
+    async def lines():
+        result = await db.stream(delivery_events_query(delivery_name, after).execution_options(yield_per=chunk_size))
+        async for events in result.partitions():
+            yield dump_events_ndjson(events)
+
+    return lines()
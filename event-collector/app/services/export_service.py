@@ -0,0 +1,148 @@
+import asyncio
+import io
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..api.crud import copy_query_csv, export_events_query
+from ..models import DeliveryState, STATE_CODES
+
+EXPORT_FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+
+# Every chunk shares the same dictionary of states, so each state is stored as a single byte.
+STATES = pa.array([state.value for state in DeliveryState])
+# Postgres sends the STATE_CODES of the states, in the same order.
+CODES = pa.array([STATE_CODES[state] for state in DeliveryState], pa.int16())
+
+CSV_TYPES = {
+    "event_id": pa.int64(),
+    "delivery_id": pa.int64(),
+    "delivery_name": pa.string(),
+    "type": pa.int16(),
+    "created_at": pa.timestamp("us"),
+}
+EXPORT_SCHEMA = pa.schema([
+    ("event_id", pa.int64()),
+    ("delivery_id", pa.int64()),
+    ("delivery_name", pa.string()),
+    ("type", pa.dictionary(pa.int8(), pa.string())),
+    ("created_at", pa.timestamp("us", tz="UTC")),
+])
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file collecting what the Arrow writers write, until it is taken."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Timestamps are stored without time zone, as UTC."""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def rows_end(buffer: bytearray) -> int:
+    """Return the end of the last complete CSV row of the buffer, 0 if there is none.
+    A newline only ends a row outside of quotes, i.e. after an even number of quotes."""
+    end = buffer.rfind(b"\n")
+    while end >= 0 and buffer.count(b'"', 0, end) % 2:
+        end = buffer.rfind(b"\n", 0, end)
+    return end + 1
+
+def to_table(rows: bytes) -> pa.Table:
+    """Parse CSV rows of the export query into a table of the export schema, column by column."""
+    table = pa_csv.read_csv(
+        pa.py_buffer(rows),
+        read_options=pa_csv.ReadOptions(column_names=list(CSV_TYPES)),
+        convert_options=pa_csv.ConvertOptions(column_types=CSV_TYPES),
+    )
+    states = pc.index_in(table["type"], value_set=CODES).cast(pa.int8())
+    return pa.table(
+        [
+            table["event_id"],
+            table["delivery_id"],
+            table["delivery_name"],
+            pa.chunked_array([pa.DictionaryArray.from_arrays(chunk, STATES) for chunk in states.chunks], EXPORT_SCHEMA.field("type").type),
+            table["created_at"].cast(pa.timestamp("us", tz="UTC")),
+        ],
+        schema=EXPORT_SCHEMA,
+    )
+
+def open_writer(sink: ChunkSink, format: str):
+    if format == "parquet":
+        return pq.ParquetWriter(sink, EXPORT_SCHEMA, compression="zstd")
+    return pa.ipc.new_file(sink, EXPORT_SCHEMA)
+
+async def export_events(
+    db: AsyncSession,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    format: str = "parquet",
+    chunk_bytes: int = 16 * 1024 * 1024,
+) -> AsyncIterator[bytes]:
+    """
+    Stream the events created from start to end, with the name of their delivery,
+    as a Parquet or Arrow IPC file.
+    Postgres sends the events as CSV with COPY, which skips building a Python object per
+    event. About chunk_bytes of CSV at a time are parsed by Arrow and written as a row group
+    or record batches, so memory does not grow with the number of exported events.
+    """
+    query = export_events_query(to_naive_utc(start), to_naive_utc(end))
+    # COPY waits while the queue is full, so it does not outpace the client.
+    received: asyncio.Queue = asyncio.Queue(maxsize=4)
+
+    async def copy():
+        try:
+            await copy_query_csv(db, query, received.put)
+        finally:
+            await received.put(None)
+
+    copying = asyncio.create_task(copy())
+    sink = ChunkSink()
+    writer = open_writer(sink, format)
+    buffer = bytearray()
+    try:
+        while (data := await received.get()) is not None:
+            buffer += data
+            if len(buffer) >= chunk_bytes:
+                rows = rows_end(buffer)
+                if rows:
+                    writer.write_table(to_table(bytes(buffer[:rows])))
+                    del buffer[:rows]
+                    yield sink.take()
+        await copying
+        if buffer:
+            writer.write_table(to_table(bytes(buffer)))
+        writer.close()
+        yield sink.take()
+    finally:
+        if not copying.done():
+            copying.cancel()
+            await asyncio.gather(copying, return_exceptions=True)
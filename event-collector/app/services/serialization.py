@@ -0,0 +1,26 @@
+from typing import Iterable
+
+import orjson
+from sqlalchemy import Row
+
+from ..schemas import DeliverySchema
+
+# The list endpoints encode rows straight to JSON bytes with orjson, in the same format
+# as model_dump_json of their schema, rather than validating a model per row.
+
+
+def dump_delivery(delivery: DeliverySchema) -> bytes:
+    """Serialize a delivery like DeliverySchema.model_dump_json."""
+    return orjson.dumps({"id": delivery.id, "name": delivery.name, "status": delivery.status})
+
+def event_dict(row: Row) -> dict:
+    """Fields of an event row, in the order of EventOutputSchema."""
+    return {"id": row.id, "type": row.type, "delivery_id": row.delivery_id, "created_at": row.created_at}
+
+def dump_events(rows: Iterable[Row]) -> bytes:
+    """Serialize event rows as a JSON list of EventOutputSchema."""
+    return orjson.dumps([event_dict(row) for row in rows])
+
+def dump_events_ndjson(rows: Iterable[Row]) -> bytes:
+    """Serialize event rows as EventOutputSchema NDJSON lines."""
+    return b"".join(orjson.dumps(event_dict(row), option=orjson.OPT_APPEND_NEWLINE) for row in rows)
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from ..core import settings
+from ..models import DeliveryState
+
+
+class BufferedStatus(NamedTuple):
+    """Current status of a delivery, since when, and the status Postgres holds for it."""
+    id: int
+    status: DeliveryState
+    updated_at: Optional[datetime]
+    flushed: DeliveryState
+
+    @property
+    def dirty(self) -> bool:
+        return self.status != self.flushed
+
+
+class StatusBuffer:
+    """
+    Current status of the deliveries ingested by this process, by name, for the write-behind
+    mode: events are inserted right away, while the status changes of a delivery are collected
+    here and written to Postgres by the next flush, one row version for all of them.
+    Clean entries, already flushed, are kept so that the next events of their delivery skip the
+    deliveries row too; the least recently used are evicted beyond size, and terminal ones at once,
+    as their status cannot change anymore.
+    Postgres still decides for a delivery that is not buffered, or whose row was changed behind
+    the buffer, e.g. by a batch or an import, and for an invalid transition from a flushed status.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: OrderedDict[str, BufferedStatus] = OrderedDict()
+
+    def get(self, name: str) -> Optional[BufferedStatus]:
+        return self._entries.get(name)
+
+    def apply(self, entries: Dict[str, Optional[BufferedStatus]], written: Set[str]) -> None:
+        """
+        Set the committed statuses of entries, and drop those mapped to None. The deliveries of written had their row written by
+        the transaction, so Postgres holds their status; the others keep what the buffer knows
+        Postgres holds, which a flush may have changed since the transaction read it.
+        """
+        for name, entry in entries.items():
+            if entry is None:
+                self._entries.pop(name, None)
+                continue
+            current = self._entries.get(name)
+            if name not in written and current is not None and current.id == entry.id:
+                entry = entry._replace(flushed=current.flushed)
+            if not entry.dirty and entry.status.is_terminal:
+                self._entries.pop(name, None)
+                continue
+            self._entries[name] = entry
+            self._entries.move_to_end(name)
+        for name in [name for name, entry in self._entries.items() if not entry.dirty][:max(len(self._entries) - self.size, 0)]:
+            del self._entries[name]
+
+    def discard(self, names: Iterable[str]) -> None:
+        for name in names:
+            self._entries.pop(name, None)
+
+    def pending(self) -> Dict[str, BufferedStatus]:
+        """Entries whose status is not flushed yet."""
+        return {name: entry for name, entry in self._entries.items() if entry.dirty}
+
+    def mark_flushed(self, flushed: Dict[str, BufferedStatus], applied: Set[int]) -> None:
+        """
+        Record that the statuses of flushed were written, for the delivery ids in applied.
+        The others changed or were deleted behind the buffer: they are dropped, and the
+        next event of their delivery reads Postgres again.
+        """
+        for name, entry in flushed.items():
+            current = self._entries.get(name)
+            if current is None or current.id != entry.id:
+                continue
+            if entry.id not in applied:
+                del self._entries[name]
+                continue
+            current = current._replace(flushed=entry.status)
+            if current.dirty or not current.status.is_terminal:
+                self._entries[name] = current
+            else:
+                del self._entries[name]
+
+    def ongoing_delta(self) -> int:
+        """Change of the number of ongoing deliveries not flushed yet."""
+        ongoing_states = DeliveryState.ongoing_states()
+        return sum(
+            (entry.status in ongoing_states) - (entry.flushed in ongoing_states)
+            for entry in self._entries.values() if entry.dirty
+        )
+
+    def items(self) -> List[Tuple[str, BufferedStatus]]:
+        return list(self._entries.items())
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+status_buffer = StatusBuffer(settings.status_buffer_size)
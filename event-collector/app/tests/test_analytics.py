@@ -0,0 +1,63 @@
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.api.crud import rebuild_rollups
+from app.importer import import_events
+from app.schemas import EventSchema
+from app.services import ingest_event, ingest_transaction
+
+START = datetime(2025, 6, 24, 12)
+
+def at(seconds: int) -> str:
+    return (START + timedelta(seconds=seconds)).isoformat()
+
+@pytest.mark.asyncio
+async def test_analytics(client, db_session, session_factory):
+    async with ingest_transaction(db_session):
+        for event_type, seconds in [("PARCEL_COLLECTED", 0), ("TAKEN_OFF", 10), ("LANDED", 100), ("PARCEL_DELIVERED", 130), ("TAKEN_OFF", 140)]:
+            await ingest_event(db_session, "a", EventSchema(type=event_type, created_at=at(seconds)))
+    events = [
+        {"delivery_name": "b", "type": "PARCEL_COLLECTED", "created_at": at(0)},
+        {"delivery_name": "b", "type": "TAKEN_OFF", "created_at": at(20)},
+        {"delivery_name": "b", "type": "CRASHED", "created_at": at(7200)},
+        {"delivery_name": "b", "type": "LANDED", "created_at": at(7210)},
+    ]
+    await client.post("/events/batch", json={"events": events})
+    lines = [
+        json.dumps({"delivery_name": "c", "type": "PARCEL_COLLECTED", "created_at": at(0)}),
+        json.dumps({"delivery_name": "c", "type": "TAKEN_OFF", "created_at": at(30)}),
+    ]
+    await import_events(io.StringIO("\n".join(lines)), session_factory=session_factory)
+
+    response = await client.get("/analytics")
+    assert response.status_code == 200
+    analytics = response.json()
+    assert analytics["deliveries"] == 3
+    assert analytics["events"] == {"PARCEL_COLLECTED": 3, "TAKEN_OFF": 3, "LANDED": 1, "CRASHED": 1, "PARCEL_DELIVERED": 1}
+    assert (analytics["crash_rate"], analytics["success_rate"], analytics["mean_flight_legs"]) == (0.5, 0.5, 1.0)
+    time_in_state = {(pair["previous_status"], pair["status"]): pair for pair in analytics["time_in_state"]}
+    assert set(time_in_state) == {
+        ("PARCEL_COLLECTED", "TAKEN_OFF"), ("TAKEN_OFF", "LANDED"), ("LANDED", "PARCEL_DELIVERED"), ("TAKEN_OFF", "CRASHED"),
+    }
+    taken_off = time_in_state[("PARCEL_COLLECTED", "TAKEN_OFF")]
+    assert (taken_off["events"], taken_off["mean_seconds"]) == (3, 20.0)
+    assert taken_off["buckets"] == [
+        {"min_seconds": 8.0, "max_seconds": 16.0, "events": 1},
+        {"min_seconds": 16.0, "max_seconds": 32.0, "events": 2},
+    ]
+    assert time_in_state[("TAKEN_OFF", "CRASHED")]["mean_seconds"] == 7180.0
+
+    response = await client.get("/analytics", params={"start": at(3600)})
+    assert response.json()["events"]["CRASHED"] == 1
+    assert response.json()["deliveries"] == 0
+    assert response.json()["crash_rate"] == 1.0
+
+    async with db_session.begin():
+        assert await rebuild_rollups(db_session) == 9
+    assert (await client.get("/analytics")).json() == analytics
+    async with db_session.begin():
+        assert await rebuild_rollups(db_session, START + timedelta(hours=1)) == 1
+    assert (await client.get("/analytics")).json() == analytics
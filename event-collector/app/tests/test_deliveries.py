@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+from redis.asyncio import Redis
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.api import endpoints
+from app.api.crud import rebuild_delivery_counters
+from app.core import settings
+from app.db import database
+from app.db.database import Base, get_read_db
+from app.main import app
+from app.models import DeliveryCounter
+from app.schemas import DeliverySchema, EventSchema
+from app.services import ingest_event, ingest_transaction, delivery_service
+from app.services import delivery_cache as delivery_cache_module
+from app.services.delivery_cache import INVALIDATIONS_CHANNEL, create_delivery_cache, listen_for_invalidations
+from app.services.delivery_feed import DeliveryFeed, delivery_feed
+
+@pytest.mark.asyncio
+async def test_count_deliveries(client, db_session):
+    async with db_session.begin():
+        for delivery_id, event_type in [("a", "PARCEL_COLLECTED"), ("a", "TAKEN_OFF"), ("b", "PARCEL_COLLECTED"), ("a", "LANDED"), ("a", "PARCEL_DELIVERED")]:
+            await ingest_event(db_session, delivery_id, EventSchema(type=event_type))
+    events = [
+        {"delivery_name": "c", "type": "PARCEL_COLLECTED"},
+        {"delivery_name": "c", "type": "CRASHED"},
+        {"delivery_name": "d", "type": "TAKEN_OFF"},
+        {"delivery_name": "b", "type": "TAKEN_OFF"},
+    ]
+    await client.post("/events/batch", json={"events": events})
+    response = await client.get("/deliveries/counts")
+    assert response.status_code == 200
+    assert response.json() == {"ongoing_deliveries": 2, "total_deliveries": 4}
+
+@pytest.mark.asyncio
+async def test_ingest_transaction_updates_one_counter_shard(client, db_session):
+    async with db_session.begin():
+        for delivery_id in ["a", "b", "c", "d", "e", "f"]:
+            await ingest_event(db_session, delivery_id, EventSchema(type="PARCEL_COLLECTED"))
+    shards = (await db_session.execute(select(DeliveryCounter.shard).where(DeliveryCounter.value != 0).distinct())).scalars().all()
+    assert len(shards) == 1
+
+@pytest.mark.asyncio
+async def test_rebuild_delivery_counters(client, db_session):
+    async with db_session.begin():
+        for delivery_id, event_type in [("a", "PARCEL_COLLECTED"), ("b", "CRASHED")]:
+            await ingest_event(db_session, delivery_id, EventSchema(type=event_type))
+        await db_session.execute(update(DeliveryCounter).values(value=42))
+    async with db_session.begin():
+        assert await rebuild_delivery_counters(db_session) == {"ongoing": 1, "total": 2}
+    response = await client.get("/deliveries/counts")
+    assert response.json() == {"ongoing_deliveries": 1, "total_deliveries": 2}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+async def test_ongoing_deliveries_cache(client, db_session, monkeypatch, backend):
+    cache = create_delivery_cache(backend)
+    await cache.clear()
+    monkeypatch.setattr(delivery_service, "delivery_cache", cache)
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "a", EventSchema(type="PARCEL_COLLECTED"))
+        await ingest_event(db_session, "b", EventSchema(type="TAKEN_OFF"))
+
+    response = await client.get("/deliveries")
+    assert response.status_code == 200
+    assert [delivery["name"] for delivery in response.json()] == ["a", "b"]
+    etag = response.headers["etag"]
+    response = await client.get("/deliveries", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "a", EventSchema(type="CRASHED"))
+    await client.post("/events/batch", json={"events": [{"delivery_name": "c", "type": "PARCEL_COLLECTED"}, {"delivery_name": "b", "type": "LANDED"}]})
+    response = await client.get("/deliveries", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert [(delivery["name"], delivery["status"]) for delivery in response.json()] == [("b", "LANDED"), ("c", "PARCEL_COLLECTED")]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+async def test_changes_applied_while_warming_are_kept(backend):
+    cache = create_delivery_cache(backend)
+    await cache.clear()
+
+    async def load():
+        # Changes committed after the deliveries were read from Postgres.
+        await cache.apply({"a": None, "c": DeliverySchema(id=3, name="c", status="TAKEN_OFF")})
+        return [DeliverySchema(id=1, name="a", status="TAKEN_OFF"), DeliverySchema(id=2, name="b", status="LANDED")]
+
+    await cache.warm(load)
+    snapshot = await cache.snapshot()
+    assert [delivery["name"] for delivery in json.loads(snapshot.body)] == ["b", "c"]
+
+    async def cleared():
+        await cache.clear()
+        return []
+
+    await cache.warm(cleared)
+    assert await cache.snapshot() is None
+
+@pytest.mark.asyncio
+async def test_delivery_cache_invalidations(monkeypatch):
+    cache = create_delivery_cache("memory")
+    monkeypatch.setattr(delivery_cache_module, "delivery_cache", cache)
+
+    async def load():
+        return [DeliverySchema(id=1, name="a", status="TAKEN_OFF")]
+
+    await cache.warm(load)
+    listener = asyncio.create_task(listen_for_invalidations(delivery_feed.redis))
+    try:
+        for _ in range(100):
+            if (await delivery_feed.redis.pubsub_numsub(INVALIDATIONS_CHANNEL))[0][1]:
+                break
+            await asyncio.sleep(0.01)
+        assert await cache.snapshot() is not None
+        # As published by an import, from another process.
+        await delivery_feed.redis.publish(INVALIDATIONS_CHANNEL, "clear")
+        for _ in range(100):
+            if await cache.snapshot() is None:
+                break
+            await asyncio.sleep(0.01)
+        assert await cache.snapshot() is None
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+
+@pytest.mark.asyncio
+async def test_deliveries_feed(client, db_session, monkeypatch):
+    feed = DeliveryFeed(delivery_feed.redis)
+    everything = await feed.subscribe()
+    landed = await feed.subscribe(status="LANDED")
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "a", EventSchema(type="TAKEN_OFF"))
+        await ingest_event(db_session, "a", EventSchema(type="LANDED"))
+    await client.post("/events/batch", json={"events": [{"delivery_name": "b", "type": "LANDED"}]})
+    received = [json.loads(await asyncio.wait_for(everything.queue.get(), 5)) for _ in range(3)]
+    assert [(t["delivery_name"], t["previous_status"], t["status"]) for t in received] == [
+        ("a", None, "TAKEN_OFF"), ("a", "TAKEN_OFF", "LANDED"), ("b", None, "LANDED"),
+    ]
+    received = [json.loads(await asyncio.wait_for(landed.queue.get(), 5)) for _ in range(2)]
+    assert [t["delivery_name"] for t in received] == ["a", "b"]
+
+    monkeypatch.setattr(settings, "feed_buffer_size", 1)
+    slow = await feed.subscribe()
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "c", EventSchema(type="TAKEN_OFF"))
+        await ingest_event(db_session, "c", EventSchema(type="LANDED"))
+    assert await asyncio.wait_for(slow.queue.get(), 5) is None
+    assert slow.dropped and slow not in feed.subscriptions
+    await feed.stop()
+
+@pytest.mark.asyncio
+async def test_deliveries_feed_unavailable(client, monkeypatch):
+    feed = DeliveryFeed(Redis(host=settings.redis_host, port=1))
+    monkeypatch.setattr(endpoints, "delivery_feed", feed)
+    monkeypatch.setattr(settings, "feed_subscribe_timeout", 0.2)
+    response = await client.get("/deliveries/feed")
+    assert response.status_code == 503
+    assert not feed.subscriptions
+    await feed.stop()
+
+    # Nor while the feed resubscribes after losing its Redis subscription.
+    class FlakyRedis:
+        def __init__(self):
+            self.lost = asyncio.Event()
+            self.subscriptions = 0
+
+        @asynccontextmanager
+        async def pubsub(self):
+            self.subscriptions += 1
+            if self.subscriptions > 1:
+                await asyncio.sleep(60)
+            yield self
+
+        async def subscribe(self, channel):
+            pass
+
+        async def listen(self):
+            await self.lost.wait()
+            raise ConnectionError("Connection lost")
+            yield
+
+    feed = DeliveryFeed(FlakyRedis())
+    monkeypatch.setattr(endpoints, "delivery_feed", feed)
+    feed.unsubscribe(await feed.subscribe())
+    feed.redis.lost.set()
+    await asyncio.sleep(0.1)
+    response = await client.get("/deliveries/feed")
+    assert response.status_code == 503
+    await feed.stop()
+
+@pytest.mark.asyncio
+async def test_replication_lag(test_engine, monkeypatch):
+    monkeypatch.setattr(database, "read_engine", test_engine)
+    assert await database.replication_lag.get() == 0.0
+
+    class Unreachable:
+        @asynccontextmanager
+        async def connect(self):
+            await asyncio.sleep(60)
+            yield
+
+    monkeypatch.setattr(database, "read_engine", Unreachable())
+    monkeypatch.setattr(settings, "read_lag_timeout", 0.1)
+    database.replication_lag.reset()
+    assert await asyncio.wait_for(database.replication_lag.get(), 5) is None
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not os.environ.get("TEST_READ_DATABASE_URL"), reason="TEST_READ_DATABASE_URL is not set")
+async def test_read_routes_use_read_database(client, session_factory, monkeypatch):
+    read_engine = create_async_engine(os.environ["TEST_READ_DATABASE_URL"])
+    read_session_factory = sessionmaker(bind=read_engine, class_=AsyncSession, expire_on_commit=False)
+    monkeypatch.setattr(database, "read_engine", read_engine)
+    monkeypatch.setattr(database, "ReadSessionLocal", read_session_factory)
+    monkeypatch.setattr(database, "AsyncSessionLocal", session_factory)
+    monkeypatch.delitem(app.dependency_overrides, get_read_db)
+    try:
+        async with read_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+        async with read_session_factory() as read_session:
+            async with ingest_transaction(read_session):
+                await ingest_event(read_session, "a", EventSchema(type="PARCEL_COLLECTED"))
+
+        response = await client.get("/deliveries/counts")
+        assert response.json() == {"ongoing_deliveries": 1, "total_deliveries": 1}
+
+        # Too far behind, or unreachable: the primary serves the reads.
+        monkeypatch.setattr(settings, "read_max_staleness", 5.0)
+        for lag in (10.0, None):
+            database.replication_lag.seconds, database.replication_lag.measured_at = lag, time.monotonic()
+            response = await client.get("/deliveries/counts")
+            assert response.json() == {"ongoing_deliveries": 0, "total_deliveries": 0}
+        database.replication_lag.reset()
+        response = await client.get("/deliveries/counts")
+        assert response.json() == {"ongoing_deliveries": 1, "total_deliveries": 1}
+    finally:
+        database.replication_lag.reset()
+        await read_engine.dispose()
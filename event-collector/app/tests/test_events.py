@@ -1,4 +1,33 @@
+import asyncio
+import io
+import json
+from unittest.mock import ANY
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
+from sqlalchemy import event, select, text
+
+from app.admission import admission
+from app.compaction import compact
+from app.core import settings
+from app.db.redis import redis_client
+from app import event_queue
+from app.event_queue import (
+    LeaseLost, acquire_lease, balance_partitions, drain, flush_statuses, lease_key, partition_for, renew_lease,
+    repair_statuses, requeue_processing,
+)
+from app.importer import import_events
+from app.models import CODE_STATES, DeliveryState, Event, QuarantinedEvent, STATE_CODES
+from app.api import endpoints
+from app.api.crud import delivery_events_query
+from app.schemas import DeliverySchema, EventBatchItemSchema, EventOutputSchema, EventSchema
+from app.retention import prune
+from app.revalidation import revalidate_events
+from app.services import (
+    dedupe_cache, export_events, get_ongoing_deliveries, ingest_event, ingest_events, ingest_transaction, status_buffer,
+)
+from app.services.serialization import dump_delivery, dump_events
 
 @pytest.mark.asyncio
 async def test_create_event(client):
@@ -8,12 +37,532 @@ async def test_create_event(client):
         "timestamp": "2025-06-24T12:00:00Z"
     }
     response = await client.post(f"/deliveries/{delivery_id}/events", json=payload)
-    assert response.status_code == 200
+    assert response.status_code == 202
+    assert response.json()["event_id"]
+    assert response.json()["delivery_name"] == delivery_id
 
 @pytest.mark.asyncio
-async def test_get_delivery_events(client):
+async def test_get_delivery_events(client, db_session):
     delivery_id = "some-id"
+    async with db_session.begin():
+        await ingest_event(db_session, delivery_id, EventSchema(type="PARCEL_COLLECTED"))
     response = await client.get(f"/deliveries/{delivery_id}/events")
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
+@pytest.mark.asyncio
+async def test_queued_events_are_ingested_in_order(client, session_factory):
+    delivery_id = "queued-id"
+    types = ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED", "PARCEL_DELIVERED"]
+    for event_type in types:
+        response = await client.post(f"/deliveries/{delivery_id}/events", json={"type": event_type})
+        assert response.status_code == 202
+    stats = (await client.get("/queue/stats")).json()
+    assert stats["depth"] == len(types)
+
+    assert await drain(partition_for(delivery_id), session_factory, timeout=1) == len(types)
+
+    stats = (await client.get("/queue/stats")).json()
+    assert stats["depth"] == 0
+    assert stats["dead_letters"] == 0
+    response = await client.get(f"/deliveries/{delivery_id}/events")
+    events = sorted(response.json(), key=lambda event: event["id"])
+    assert [event["type"] for event in events] == types
+
+@pytest.mark.asyncio
+async def test_events_of_a_stopped_consumer_are_requeued(client, session_factory, monkeypatch):
+    delivery_id = "requeued-id"
+    partition = partition_for(delivery_id)
+    types = ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED", "PARCEL_DELIVERED"]
+    for event_type in types:
+        await client.post(f"/deliveries/{delivery_id}/events", json={"type": event_type})
+
+    async def stopped(*args, **kwargs):
+        raise asyncio.CancelledError()
+    monkeypatch.setattr("app.event_queue.ingest_batch", stopped)
+    with pytest.raises(asyncio.CancelledError):
+        await drain(partition, session_factory, timeout=1)
+    monkeypatch.undo()
+    assert (await client.get("/queue/stats")).json()["depth"] == len(types)
+
+    assert await requeue_processing(partition) == len(types)
+    assert await drain(partition, session_factory, timeout=1) == len(types)
+    assert (await client.get("/queue/stats")).json()["depth"] == 0
+    response = await client.get(f"/deliveries/{delivery_id}/events")
+    assert [event["type"] for event in sorted(response.json(), key=lambda event: event["id"])] == types
+
+@pytest.mark.asyncio
+async def test_batches_are_only_committed_under_the_lease(client, session_factory, monkeypatch):
+    delivery_id = "fenced-id"
+    partition = partition_for(delivery_id)
+    types = ["PARCEL_COLLECTED", "TAKEN_OFF"]
+    for event_type in types:
+        await client.post(f"/deliveries/{delivery_id}/events", json={"type": event_type})
+    assert await acquire_lease(partition, "w1")
+
+    ingest_queued_event = event_queue.ingest_queued_event
+    async def lease_taken_over(db, event):
+        await redis_client.set(lease_key(partition), "w2")
+        await ingest_queued_event(db, event)
+    monkeypatch.setattr(event_queue, "ingest_queued_event", lease_taken_over)
+    with pytest.raises(LeaseLost):
+        await drain(partition, session_factory, timeout=1, owner="w1")
+    monkeypatch.undo()
+    assert (await client.get(f"/deliveries/{delivery_id}/events")).status_code == 404
+    assert (await client.get("/queue/stats")).json()["dead_letters"] == 0
+
+    # The new owner ingests the events left in process, and the old one takes no more events.
+    assert await requeue_processing(partition) == len(types)
+    with pytest.raises(LeaseLost):
+        await drain(partition, session_factory, timeout=1, owner="w1")
+    assert await drain(partition, session_factory, timeout=1, owner="w2") == len(types)
+    response = await client.get(f"/deliveries/{delivery_id}/events")
+    assert [event["type"] for event in sorted(response.json(), key=lambda event: event["id"])] == types
+
+@pytest.mark.asyncio
+async def test_ingest_admission(client, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "ingest_max_queue_depth", 2)
+    monkeypatch.setattr(settings, "admission_interval", 0)
+    for delivery_id in ("a", "b", "c"):
+        response = await client.post(f"/deliveries/{delivery_id}/events", json={"type": "PARCEL_COLLECTED"})
+        assert response.status_code == 202
+    response = await client.post("/deliveries/d/events", json={"type": "PARCEL_COLLECTED"})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == str(settings.ingest_retry_after)
+    response = await client.post("/events/batch", json={"events": [{"delivery_name": "d", "type": "PARCEL_COLLECTED"}]})
+    assert response.status_code == 429
+    stats = (await client.get("/ingest/admission")).json()
+    assert stats["overloaded"] == "queue_depth"
+    assert stats["queue_depth"] == 3
+    assert stats["limit"] == settings.ingest_max_concurrency // 4
+    assert stats["rejection_rate"] == 1.0
+
+    # Once the queue is drained, events are admitted again while the limit grows back.
+    for delivery_id in ("a", "b", "c"):
+        await drain(partition_for(delivery_id), session_factory, timeout=1)
+    response = await client.post("/deliveries/d/events", json={"type": "PARCEL_COLLECTED"})
+    assert response.status_code == 202
+    stats = (await client.get("/ingest/admission")).json()
+    assert stats["overloaded"] is None
+    assert settings.ingest_max_concurrency // 4 < stats["limit"] < settings.ingest_max_concurrency
+
+    monkeypatch.setattr(admission, "in_flight", settings.ingest_max_concurrency)
+    response = await client.post("/deliveries/e/events", json={"type": "PARCEL_COLLECTED"})
+    assert response.status_code == 429
+
+@pytest.mark.asyncio
+async def test_partitioned_consumers(client, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "ingest_queue_partitions", 4)
+    monkeypatch.setattr(settings, "ingest_lease_ttl", 0.3)
+    monkeypatch.setattr(settings, "ingest_mode", "partitioned")
+    with pytest.raises(ValueError):
+        event_queue.start_consumers()
+    monkeypatch.setattr(settings, "ingest_poll_timeout", 0.05)
+    types = ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED", "TAKEN_OFF", "LANDED", "PARCEL_DELIVERED"]
+    names = [f"leased-{index}" for index in range(8)]
+    for event_type in types:
+        for name in names:
+            await client.post(f"/deliveries/{name}/events", json={"type": event_type})
+
+    workers = [asyncio.create_task(balance_partitions(owner, session_factory)) for owner in ("w1", "w2")]
+    try:
+        for _ in range(100):
+            owners = [await redis_client.get(lease_key(partition)) for partition in range(4)]
+            if sorted(owners, key=str) == ["w1", "w1", "w2", "w2"] and (await client.get("/queue/stats")).json()["depth"] == 0:
+                break
+            await asyncio.sleep(0.05)
+        assert sorted(owners, key=str) == ["w1", "w1", "w2", "w2"]
+        assert not await acquire_lease(0, "w3")
+        assert not await renew_lease(0, "w3")
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    assert [await redis_client.get(lease_key(partition)) for partition in range(4)] == [None] * 4
+
+    for name in names:
+        response = await client.get(f"/deliveries/{name}/events")
+        assert [event["type"] for event in sorted(response.json(), key=lambda event: event["id"])] == types
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 0, "total_deliveries": len(names)}
+
+@pytest.mark.asyncio
+async def test_create_events_batch(client):
+    events = [
+        {"delivery_name": "batch-a", "type": "PARCEL_COLLECTED"},
+        {"delivery_name": "batch-b", "type": "PARCEL_COLLECTED"},
+        {"delivery_name": "batch-a", "type": "TAKEN_OFF"},
+        {"delivery_name": "batch-b", "type": "CRASHED", "created_at": "2025-06-24T12:00:00Z"},
+        {"delivery_name": "batch-a", "type": "LANDED"},
+    ]
+    response = await client.post("/events/batch", json={"events": events})
+    assert response.status_code == 200
+    items = response.json()["items"]
+    assert [item["index"] for item in items] == list(range(len(events)))
+    assert all(item["status"] == "created" for item in items)
+    assert [item["event"]["type"] for item in items] == [event["type"] for event in events]
+    assert items[3]["event"]["created_at"] == "2025-06-24T12:00:00"
+
+    response = await client.get("/deliveries/batch-a/events")
+    assert [event["type"] for event in sorted(response.json(), key=lambda event: event["id"])] == ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED"]
+    response = await client.post("/events/batch", json={"events": [{"delivery_name": "batch-a", "type": "PARCEL_DELIVERED"}]})
+    assert response.json()["items"][0]["event"]["delivery_id"] == items[0]["event"]["delivery_id"]
+
+@pytest.mark.asyncio
+async def test_duplicate_events_are_ingested_once(client, session_factory, test_engine):
+    headers = {"Idempotency-Key": "retry-1"}
+    first = (await client.post("/deliveries/dup-id/events", json={"type": "PARCEL_COLLECTED"}, headers=headers)).json()
+    second = (await client.post("/deliveries/dup-id/events", json={"type": "PARCEL_COLLECTED"}, headers=headers)).json()
+    assert (first["duplicate"], second["duplicate"]) == (False, True)
+    assert second["event_id"] == first["event_id"]
+    assert (await client.get("/queue/stats")).json()["depth"] == 1
+    await drain(partition_for("dup-id"), session_factory, timeout=1)
+
+    events = [
+        {"delivery_name": "dup-id", "type": "TAKEN_OFF", "created_at": "2025-06-24T12:00:00Z"},
+        {"delivery_name": "dup-id", "type": "TAKEN_OFF", "created_at": "2025-06-24T12:00:00Z"},
+        {"delivery_name": "dup-id", "type": "LANDED", "idempotency_key": "retry-2"},
+    ]
+    items = (await client.post("/events/batch", json={"events": events})).json()["items"]
+    assert [item["status"] for item in items] == ["created", "duplicate", "created"]
+
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(test_engine.sync_engine, "before_cursor_execute", count_statement)
+    try:
+        items = (await client.post("/events/batch", json={"events": events})).json()["items"]
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", count_statement)
+    assert [item["status"] for item in items] == ["duplicate"] * 3
+    assert statements == []
+
+    # Copies that the dedupe cache no longer has are rejected by the event_keys table.
+    await dedupe_cache.clear()
+    items = (await client.post("/events/batch", json={"events": events})).json()["items"]
+    assert [item["status"] for item in items] == ["duplicate"] * 3
+    await client.post("/deliveries/dup-id/events", json={"type": "PARCEL_COLLECTED"}, headers=headers)
+    await drain(partition_for("dup-id"), session_factory, timeout=1)
+    response = await client.get("/deliveries/dup-id/events")
+    assert [event["type"] for event in response.json()] == ["TAKEN_OFF", "PARCEL_COLLECTED", "LANDED"]
+
+@pytest.mark.asyncio
+async def test_copies_of_dead_lettered_events_are_queued(client, session_factory, monkeypatch):
+    async def fail(*args):
+        raise RuntimeError("ingestion failed")
+
+    headers = {"Idempotency-Key": "retry-dead"}
+    await client.post("/deliveries/dead-id/events", json={"type": "PARCEL_COLLECTED"}, headers=headers)
+    copy = (await client.post("/deliveries/dead-id/events", json={"type": "PARCEL_COLLECTED"}, headers=headers)).json()
+    assert copy["duplicate"]
+    monkeypatch.setattr("app.event_queue.ingest_event", fail)
+    await drain(partition_for("dead-id"), session_factory, timeout=1)
+    assert (await client.get("/queue/stats")).json()["dead_letters"] == 1
+
+    monkeypatch.undo()
+    retry = (await client.post("/deliveries/dead-id/events", json={"type": "PARCEL_COLLECTED"}, headers=headers)).json()
+    assert not retry["duplicate"]
+    await drain(partition_for("dead-id"), session_factory, timeout=1)
+    response = await client.get("/deliveries/dead-id/events")
+    assert [event["type"] for event in response.json()] == ["PARCEL_COLLECTED"]
+
+@pytest.mark.asyncio
+async def test_invalid_transitions_are_quarantined(client, db_session, session_factory):
+    async with ingest_transaction(db_session):
+        assert await ingest_event(db_session, "q-a", EventSchema(type="CRASHED"))
+        assert await ingest_event(db_session, "q-a", EventSchema(type="TAKEN_OFF")) is None
+    events = [
+        {"delivery_name": "q-b", "type": "PARCEL_COLLECTED"},
+        {"delivery_name": "q-b", "type": "LANDED"},
+        {"delivery_name": "q-b", "type": "TAKEN_OFF"},
+        {"delivery_name": "q-a", "type": "LANDED"},
+        {"delivery_name": "q-b", "type": "LANDED"},
+    ]
+    items = (await client.post("/events/batch", json={"events": events})).json()["items"]
+    assert [item["status"] for item in items] == ["created", "quarantined", "created", "quarantined", "created"]
+    assert [delivery["status"] for delivery in (await client.get("/deliveries")).json()] == ["LANDED"]
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 2}
+    quarantined = (await db_session.execute(
+        select(QuarantinedEvent.delivery_name, QuarantinedEvent.type, QuarantinedEvent.previous_status).order_by(QuarantinedEvent.id)
+    )).all()
+    await db_session.rollback()
+    assert [(name, state.value, previous.value) for name, state, previous in quarantined] == [
+        ("q-a", "TAKEN_OFF", "CRASHED"), ("q-b", "LANDED", "PARCEL_COLLECTED"), ("q-a", "LANDED", "CRASHED"),
+    ]
+
+    # History ingested before validation, e.g. out of created_at order.
+    async with db_session.begin():
+        await db_session.execute(text(
+            "UPDATE events SET created_at = created_at - interval '1 hour' "
+            "WHERE type = :landed AND delivery_id = (SELECT id FROM deliveries WHERE name = 'q-b')"
+        ), {"landed": STATE_CODES[DeliveryState.LANDED]})
+    assert await revalidate_events(session_factory, dry_run=True) == (4, 1, 1, ANY)
+    assert await revalidate_events(session_factory) == (4, 1, 1, ANY)
+    assert await revalidate_events(session_factory) == (3, 0, 0, ANY)
+    response = await client.get("/deliveries/q-b/events")
+    assert [event["type"] for event in response.json()] == ["LANDED", "TAKEN_OFF"]
+    assert [delivery["status"] for delivery in (await client.get("/deliveries")).json()] == ["TAKEN_OFF"]
+
+@pytest.mark.asyncio
+async def test_batches_validate_against_concurrent_ingests(client, session_factory):
+    async with session_factory() as db, ingest_transaction(db):
+        await ingest_event(db, "race-id", EventSchema(type="PARCEL_COLLECTED"))
+
+    async def ingest_batch():
+        async with session_factory() as db, ingest_transaction(db):
+            return await ingest_events(db, [EventBatchItemSchema(delivery_name="race-id", type="LANDED")])
+
+    # The batch waits for the pending take off, then checks the landing against it.
+    async with session_factory() as db, ingest_transaction(db):
+        await ingest_event(db, "race-id", EventSchema(type="TAKEN_OFF"))
+        batch = asyncio.create_task(ingest_batch())
+        await asyncio.sleep(0.5)
+    assert [item.status for item in await batch] == ["created"]
+    response = await client.get("/deliveries/race-id/events")
+    assert [event["type"] for event in response.json()] == ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED"]
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 1}
+
+@pytest.mark.asyncio
+async def test_events_of_a_delivery_created_concurrently(client, session_factory):
+    async def take_off():
+        async with session_factory() as db, ingest_transaction(db):
+            return await ingest_event(db, "race-new-id", EventSchema(type="TAKEN_OFF"))
+
+    # The take off waits for the delivery to be created, then counts it once.
+    async with session_factory() as db, ingest_transaction(db):
+        await ingest_event(db, "race-new-id", EventSchema(type="PARCEL_COLLECTED"))
+        taken_off = asyncio.create_task(take_off())
+        await asyncio.sleep(0.5)
+    assert (await taken_off).type == "TAKEN_OFF"
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 1}
+    analytics = (await client.get("/analytics")).json()
+    assert analytics["deliveries"] == 1
+    assert [(pair["previous_status"], pair["status"]) for pair in analytics["time_in_state"]] == [("PARCEL_COLLECTED", "TAKEN_OFF")]
+
+@pytest.mark.asyncio
+async def test_ingest_event_is_a_single_statement(prepare_test_db, db_session, test_engine):
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(test_engine.sync_engine, "before_cursor_execute", count_statement)
+    try:
+        async with db_session.begin():
+            for event_type in ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED"]:
+                await ingest_event(db_session, "single-id", EventSchema(type=event_type))
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", count_statement)
+    assert len(statements) == 3
+
+@pytest.mark.asyncio
+async def test_write_behind_statuses(client, db_session, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "status_write_behind", True)
+
+    async def stored():
+        status, version = (await db_session.execute(text("SELECT status, xmin::text FROM deliveries WHERE name = 'wb'"))).one()
+        await db_session.rollback()
+        return CODE_STATES[status].value, version
+
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "wb", EventSchema(type="PARCEL_COLLECTED"))
+    status, version = await stored()
+    for event_type in ["TAKEN_OFF", "LANDED", "TAKEN_OFF"]:
+        async with ingest_transaction(db_session):
+            assert await ingest_event(db_session, "wb", EventSchema(type=event_type))
+    async with ingest_transaction(db_session):
+        assert await ingest_event(db_session, "wb", EventSchema(type="PARCEL_COLLECTED")) is None
+    assert await stored() == (status, version) == ("PARCEL_COLLECTED", version)
+    assert len((await client.get("/deliveries/wb/events")).json()) == 4
+    assert (await client.get("/deliveries")).json() == [{"id": ANY, "name": "wb", "status": "TAKEN_OFF"}]
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 1}
+
+    assert await flush_statuses(session_factory) == 1
+    assert (await stored())[0] == "TAKEN_OFF"
+    assert await flush_statuses(session_factory) == 0
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 1}
+
+    # A batch writes the row behind the buffer, Postgres decides the next event.
+    await client.post("/events/batch", json={"events": [{"delivery_name": "wb", "type": "LANDED"}]})
+    async with ingest_transaction(db_session):
+        assert await ingest_event(db_session, "wb", EventSchema(type="PARCEL_DELIVERED"))
+    assert (await stored())[0] == "PARCEL_DELIVERED"
+    assert status_buffer.items() == []
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 0, "total_deliveries": 1}
+
+@pytest.mark.asyncio
+async def test_lost_write_behind_statuses_are_repaired(client, db_session, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "status_write_behind", True)
+    for name, types in [("lost", ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED"]), ("kept", ["PARCEL_COLLECTED", "TAKEN_OFF"])]:
+        for event_type in types:
+            async with ingest_transaction(db_session):
+                assert await ingest_event(db_session, name, EventSchema(type=event_type))
+        if name == "kept":
+            assert await flush_statuses(session_factory) == 2
+    async with ingest_transaction(db_session):
+        assert await ingest_event(db_session, "lost", EventSchema(type="PARCEL_DELIVERED"))
+    # The process dies before the next flush.
+    status_buffer.clear()
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 2, "total_deliveries": 2}
+
+    assert await repair_statuses(session_factory) == 1
+    statuses = (await db_session.execute(text("SELECT name, status FROM deliveries ORDER BY name"))).all()
+    await db_session.rollback()
+    assert [(name, CODE_STATES[status].value) for name, status in statuses] == [("kept", "TAKEN_OFF"), ("lost", "PARCEL_DELIVERED")]
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 2}
+    assert await repair_statuses(session_factory) == 0
+
+@pytest.mark.asyncio
+async def test_get_delivery_events_pages(client):
+    types = ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED", "TAKEN_OFF", "LANDED"]
+    events = [{"delivery_name": "paged-id", "type": event_type} for event_type in types]
+    await client.post("/events/batch", json={"events": events})
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"after": cursor} if cursor else {})}
+        response = await client.get("/deliveries/paged-id/events", params=params)
+        assert response.status_code == 200
+        pages.append([event["type"] for event in response.json()])
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            break
+    assert pages == [types[0:2], types[2:4], types[4:]]
+
+    response = await client.get("/deliveries/paged-id/events", headers={"Accept": "application/x-ndjson"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["type"] for line in response.text.splitlines()] == types
+    assert (await client.get("/deliveries/paged-id/events", params={"after": "nope"})).status_code == 400
+    assert (await client.get("/deliveries/unknown-id/events", headers={"Accept": "application/x-ndjson"})).status_code == 404
+
+@pytest.mark.asyncio
+async def test_compacted_histories(client, db_session, session_factory, monkeypatch):
+    events = [
+        {"delivery_name": "done", "type": "PARCEL_COLLECTED", "created_at": "2025-06-24T12:00:00.123456Z"},
+        {"delivery_name": "done", "type": "TAKEN_OFF", "created_at": "2025-06-24T12:01:00Z"},
+        {"delivery_name": "done", "type": "LANDED", "created_at": "2025-06-24T12:01:00Z"},
+        {"delivery_name": "done", "type": "PARCEL_DELIVERED", "created_at": "2025-06-24T14:00:00.5Z"},
+    ]
+    await client.post("/events/batch", json={"events": events})
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "busy", EventSchema(type="PARCEL_COLLECTED", created_at="2025-06-24T12:00:30Z"))
+    history = (await client.get("/deliveries/done/events")).json()
+
+    report = await compact(session_factory, delay=0)
+    assert (report.deliveries, report.events) == (1, 4)
+    busy = (await client.get("/deliveries/busy/events")).json()
+    assert (await db_session.execute(select(Event.delivery_id).distinct())).scalars().all() == [busy[0]["delivery_id"]]
+    await db_session.rollback()
+    assert (await client.get("/deliveries/done/events")).json() == history
+    pages, cursor = [], None
+    while cursor is not None or not pages:
+        response = await client.get("/deliveries/done/events", params={"limit": 3, **({"after": cursor} if cursor else {})})
+        pages += response.json()
+        cursor = response.headers.get("x-next-cursor")
+    assert pages == history
+    response = await client.get("/deliveries/done/events", headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line) for line in response.text.splitlines()] == history
+    assert (await compact(session_factory, delay=0)).deliveries == 0
+
+    response = await client.get("/events/export", params={"format": "arrow"})
+    table = pa.ipc.open_file(pa.py_buffer(response.content)).read_all()
+    assert table.column("delivery_name").to_pylist() == ["done", "busy", "done", "done", "done"]
+    assert (await revalidate_events(session_factory)).quarantined == 0
+
+    monkeypatch.setattr(settings, "delivery_history_limit", 1)
+    report = await prune(session_factory)
+    assert (report.deliveries, report.events) == (1, 4)
+
+@pytest.mark.asyncio
+async def test_lean_serialization_matches_schemas(client, db_session):
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "lean-id", EventSchema(type="PARCEL_COLLECTED", created_at="2025-06-24T12:00:00.123456Z"))
+        await ingest_event(db_session, "lean-id", EventSchema(type="TAKEN_OFF"))
+    rows = (await db_session.execute(delivery_events_query("lean-id"))).all()
+    deliveries = await get_ongoing_deliveries(db_session)
+    await db_session.rollback()
+    schemas = [EventOutputSchema.model_validate(row).model_dump_json().encode() for row in rows]
+    assert dump_events(rows) == b"[" + b",".join(schemas) + b"]"
+    assert [dump_delivery(delivery) for delivery in deliveries] == [
+        DeliverySchema(id=delivery.id, name=delivery.name, status=delivery.status).model_dump_json().encode()
+        for delivery in deliveries
+    ]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format", ["ndjson", "csv"])
+async def test_import_events(client, session_factory, format):
+    events = [
+        {"delivery_name": "a", "type": "PARCEL_COLLECTED", "created_at": "2025-06-24T12:00:00Z"},
+        {"delivery_name": "b", "type": "PARCEL_COLLECTED"},
+        {"delivery_name": "a", "type": "TAKEN_OFF", "created_at": "2025-06-24T12:01:00Z"},
+        {"delivery_name": "a", "type": "EXPLODED"},
+        {"delivery_name": "a", "type": "LANDED", "created_at": "2025-06-24T12:02:00Z"},
+        {"delivery_name": "b", "type": "CRASHED"},
+        {"delivery_name": "b", "type": "TAKEN_OFF"},
+    ]
+    if format == "ndjson":
+        lines = [json.dumps(event) for event in events]
+    else:
+        lines = ["delivery_name,type,created_at"] + [f"{e['delivery_name']},{e['type']},{e.get('created_at', '')}" for e in events]
+    report = await import_events(io.StringIO("\n".join(lines) + "\n"), format, chunk_size=2, session_factory=session_factory)
+    assert (report.events, report.rejected, report.quarantined) == (5, 1, 1)
+
+    response = await client.get("/deliveries/a/events")
+    assert [event["type"] for event in response.json()] == ["PARCEL_COLLECTED", "TAKEN_OFF", "LANDED"]
+    assert [delivery["name"] for delivery in (await client.get("/deliveries")).json()] == ["a"]
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 2}
+
+@pytest.mark.asyncio
+async def test_import_events_skips_copies(client, session_factory):
+    events = [
+        {"delivery_name": "a", "type": "PARCEL_COLLECTED", "created_at": "2025-06-24T12:00:00Z"},
+        {"delivery_name": "a", "type": "PARCEL_COLLECTED", "created_at": "2025-06-24T12:00:00Z"},
+        {"delivery_name": "a", "type": "TAKEN_OFF", "created_at": "2025-06-24T12:01:00Z"},
+    ]
+    await client.post("/events/batch", json={"events": events[:1]})
+    lines = "\n".join(json.dumps(event) for event in events) + "\n"
+    report = await import_events(io.StringIO(lines), session_factory=session_factory)
+    assert (report.events, report.quarantined, report.duplicates) == (1, 0, 2)
+    report = await import_events(io.StringIO(lines), session_factory=session_factory)
+    assert (report.events, report.quarantined, report.duplicates) == (0, 0, 3)
+    response = await client.get("/deliveries/a/events")
+    assert [event["type"] for event in response.json()] == ["PARCEL_COLLECTED", "TAKEN_OFF"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+async def test_export_events(client, db_session, format):
+    events = [
+        {"delivery_name": "a", "type": "PARCEL_COLLECTED", "created_at": "2025-06-24T12:00:00Z"},
+        {"delivery_name": 'b,"\nc', "type": "TAKEN_OFF", "created_at": "2025-06-24T13:00:00Z"},
+        {"delivery_name": "a", "type": "TAKEN_OFF", "created_at": "2025-06-24T14:00:00Z"},
+    ]
+    await client.post("/events/batch", json={"events": events})
+    response = await client.get("/events/export", params={"start": "2025-06-24T12:30:00Z", "format": format})
+    assert response.status_code == 200
+    if format == "parquet":
+        table = pq.read_table(pa.py_buffer(response.content))
+    else:
+        table = pa.ipc.open_file(pa.py_buffer(response.content)).read_all()
+    assert table.column("delivery_name").to_pylist() == ['b,"\nc', "a"]
+    assert table.column("type").to_pylist() == ["TAKEN_OFF", "TAKEN_OFF"]
+    assert table.schema.field("type").type == pa.dictionary(pa.int8(), pa.string())
+
+    chunks = [chunk async for chunk in export_events(db_session, format="arrow", chunk_bytes=1)]
+    await db_session.rollback()
+    table = pa.ipc.open_file(pa.py_buffer(b"".join(chunks))).read_all()
+    assert table.column("delivery_name").to_pylist() == ["a", 'b,"\nc', "a"]
+    assert len(chunks) > 1
+
+@pytest.mark.asyncio
+async def test_export_errors(client, monkeypatch):
+    async def failing(chunks):
+        for chunk in chunks:
+            yield chunk
+        raise RuntimeError("COPY failed")
+
+    monkeypatch.setattr(endpoints, "export_events", lambda *args: failing([]))
+    response = await client.get("/events/export")
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Error exporting events: COPY failed"
+
+    # Once the file has started, the response is aborted rather than ending as if it were complete.
+    monkeypatch.setattr(endpoints, "export_events", lambda *args: failing([b"PAR1"]))
+    with pytest.raises(RuntimeError):
+        await client.get("/events/export")
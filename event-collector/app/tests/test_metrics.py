@@ -0,0 +1,31 @@
+import logging
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.core import settings
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+@pytest.mark.asyncio
+async def test_metrics(client, caplog, monkeypatch):
+    requests = sample("http_request_duration_seconds_count", method="GET", route="/deliveries/{id}/events", status="200")
+    statements = sample("http_request_sql_statements_sum", method="GET", route="/deliveries/{id}/events")
+    ingested = sample("ingested_events_total", state="TAKEN_OFF")
+    monkeypatch.setattr(settings, "slow_query_seconds", 0)
+    await client.post("/events/batch", json={"events": [
+        {"delivery_name": "a", "type": "PARCEL_COLLECTED"},
+        {"delivery_name": "a", "type": "TAKEN_OFF"},
+    ]})
+    with caplog.at_level(logging.WARNING, logger="app.metrics"):
+        await client.get("/deliveries/a/events")
+    assert any("in /deliveries/{id}/events: SELECT" in message for message in caplog.messages)
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert "db_pool_connections" in response.text
+    assert sample("http_request_duration_seconds_count", method="GET", route="/deliveries/{id}/events", status="200") == requests + 1
+    assert sample("http_request_sql_statements_sum", method="GET", route="/deliveries/{id}/events") > statements
+    assert sample("ingested_events_total", state="TAKEN_OFF") == ingested + 1
@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy import event, text
+
+from app.core import settings
+from app.retention import prune
+from app.schemas import EventSchema
+from app.services import ingest_event, ingest_transaction
+
+@pytest.mark.asyncio
+async def test_queries_use_indexes(client, db_session, session_factory, test_engine, monkeypatch):
+    """With sequential scans disabled, a query only scans deliveries or events sequentially if no index fits."""
+    monkeypatch.setattr(settings, "delivery_history_limit", 1)
+    monkeypatch.setattr(settings, "delivery_retention_days", 1)
+    statements = []
+    def capture_statement(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and ("deliveries" in statement or "events" in statement):
+            statements.append((statement, parameters))
+    event.listen(test_engine.sync_engine, "before_cursor_execute", capture_statement)
+    try:
+        async with ingest_transaction(db_session):
+            await ingest_event(db_session, "a", EventSchema(type="PARCEL_COLLECTED"))
+        await client.post("/events/batch", json={"events": [{"delivery_name": "b", "type": "PARCEL_COLLECTED"}]})
+        await client.get("/deliveries")
+        await client.get("/deliveries/b/events")
+        await prune(session_factory)
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", capture_statement)
+
+    assert len(statements) >= 6
+    async with test_engine.connect() as conn:
+        await conn.execute(text("SET enable_seqscan = off"))
+        for statement, parameters in statements:
+            result = await conn.exec_driver_sql(f"EXPLAIN {statement}", parameters)
+            plan = "\n".join(row[0] for row in result)
+            assert "Seq Scan on deliveries" not in plan, plan
+            assert "Seq Scan on events" not in plan, plan
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import text
+
+from app.core import settings
+from app.partitions import ensure_event_partitions, partition_name
+from app.retention import prune
+from app.schemas import EventSchema
+from app.services import ingest_event, ingest_transaction
+
+@pytest.mark.asyncio
+async def test_prune_history_limit(client, db_session, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "delivery_history_limit", 2)
+    monkeypatch.setattr(settings, "retention_batch_size", 1)
+    async with ingest_transaction(db_session):
+        for delivery_id, event_type in [("a", "PARCEL_COLLECTED"), ("a", "TAKEN_OFF"), ("b", "CRASHED"), ("c", "TAKEN_OFF"), ("d", "LANDED")]:
+            await ingest_event(db_session, delivery_id, EventSchema(type=event_type))
+    assert [delivery["name"] for delivery in (await client.get("/deliveries")).json()] == ["a", "c", "d"]
+
+    report = await prune(session_factory)
+    assert (report.deliveries, report.events) == (2, 3)
+    assert (await client.get("/deliveries/a/events")).status_code == 404
+    assert (await client.get("/deliveries/b/events")).status_code == 404
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 2, "total_deliveries": 2}
+    assert [delivery["name"] for delivery in (await client.get("/deliveries")).json()] == ["c", "d"]
+    assert (await client.get("/retention/stats")).json()["deliveries"] == 2
+
+    report = await prune(session_factory)
+    assert (report.deliveries, report.events) == (0, 0)
+
+@pytest.mark.asyncio
+async def test_prune_retention_days(client, db_session, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "delivery_retention_days", 1)
+    async with ingest_transaction(db_session):
+        for delivery_id in ["old", "new"]:
+            await ingest_event(db_session, delivery_id, EventSchema(type="PARCEL_COLLECTED"))
+        await db_session.execute(text("UPDATE deliveries SET created_at = now() - interval '2 days' WHERE name = 'old'"))
+
+    report = await prune(session_factory)
+    assert (report.deliveries, report.events) == (1, 1)
+    assert (await client.get("/deliveries/old/events")).status_code == 404
+    assert (await client.get("/deliveries/counts")).json() == {"ongoing_deliveries": 1, "total_deliveries": 1}
+
+@pytest.mark.asyncio
+async def test_event_partitions(client, db_session, session_factory, monkeypatch):
+    monkeypatch.setattr(settings, "delivery_retention_days", 1)
+    monkeypatch.setattr(settings, "event_partitions_ahead", 2)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    async with ingest_transaction(db_session):
+        await ingest_event(db_session, "a", EventSchema(type="PARCEL_COLLECTED", created_at=now - timedelta(days=3)))
+        await ingest_event(db_session, "a", EventSchema(type="TAKEN_OFF", created_at=now - timedelta(days=2)))
+        await ingest_event(db_session, "a", EventSchema(type="LANDED", created_at=now))
+
+    days = [partition_name(now + timedelta(days=days)) for days in range(-3, 3)]
+    assert await ensure_event_partitions(session_factory, now - timedelta(days=3)) == days[:3]
+    assert await ensure_event_partitions(session_factory, now - timedelta(days=3)) == []
+    assert await ensure_event_partitions(session_factory, now) == days[3:]
+    partitions = (await db_session.execute(text("SELECT tableoid::regclass::text FROM events ORDER BY created_at"))).scalars().all()
+    await db_session.rollback()
+    assert partitions == [partition_name(now - timedelta(days=days)) for days in (3, 2, 0)]
+
+    report = await prune(session_factory)
+    assert (report.deliveries, report.events, report.partitions) == (0, 0, 2)
+    events = (await client.get("/deliveries/a/events")).json()
+    assert [event["type"] for event in events] == ["LANDED"]
@@ -0,0 +1,43 @@
+"""Compare the results of two benchmark runs, e.g. of two commits, see benchmarks.run."""
+import json
+
+import typer
+
+
+def compare(baseline: str, candidate: str):
+    """Compare the results of two runs, e.g. of two commits."""
+    with open(baseline) as file:
+        before = json.load(file)
+    with open(candidate) as file:
+        after = json.load(file)
+    typer.echo(f"{before['commit']} -> {after['commit']}")
+    metrics = [
+        ("requests_per_second", lambda result: result["requests_per_second"]),
+        ("events_per_second", lambda result: result["events_per_second"]),
+        ("p50_ms", lambda result: result["latency_ms"]["p50"]),
+        ("p95_ms", lambda result: result["latency_ms"]["p95"]),
+        ("p99_ms", lambda result: result["latency_ms"]["p99"]),
+        ("sql_statements_per_request", lambda result: result["sql_statements_per_request"]),
+        ("shed_requests", lambda result: result.get("shed_requests")),
+        *(
+            (f"{size}_kb", lambda result, size=size: result["storage"][f"{size}_bytes"] // 1024 if f"{size}_bytes" in result.get("storage", {}) else None)
+            for size in (
+                "deliveries_table", "deliveries_index", "events_table", "events_index",
+                "compacted_histories_table", "compacted_histories_index",
+            )
+        ),
+    ]
+    for name in after["workloads"]:
+        if name not in before["workloads"]:
+            continue
+        typer.echo(f"{name}:")
+        for metric, value in metrics:
+            old, new = value(before["workloads"][name]), value(after["workloads"][name])
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            typer.echo(f"  {metric:<28} {old:>10} -> {new:>10} ({change})")
+
+
+if __name__ == "__main__":
+    typer.run(compare)
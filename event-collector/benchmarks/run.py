@@ -0,0 +1,390 @@
+"""
+End-to-end benchmarks of the event collector.
+
+The app runs in-process, with its lifespan (queue consumers, pruner, compactor), against the
+Postgres of DATABASE_URL and the Redis of REDIS_HOST. Each workload starts from an
+empty database: use a dedicated database, its tables are dropped.
+Requests are scripted from a seed, so two runs send the same requests.
+Compare the results of two runs with benchmarks.compare.
+"""
+import asyncio
+import json
+import random
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import typer
+from httpx import AsyncClient, ASGITransport
+from sqlalchemy import event, func, select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.main import app
+from app import compaction, retention
+from app.core import settings
+from app.db import engine, read_engine, redis_client
+from app.db.database import Base
+from app.event_queue import QUEUE_KEY_PREFIX, PROCESSING_KEY_PREFIX, DEAD_LETTER_KEY, get_queue_stats
+from app.models import CompactedHistory, Delivery, DeliveryState, Event, QuarantinedEvent, TRANSITIONS
+from app.services.delivery_cache import delivery_cache
+
+# (method, url, json body, number of events)
+Request = Tuple[str, str, Optional[dict], int]
+
+BATCH_SIZE = 50
+HISTORY_LENGTH = 1000
+
+class StatementCounter:
+    """Counts the SQL statements sent by the app engines."""
+
+    def __init__(self):
+        self.count = 0
+        for app_engine in (engine, read_engine):
+            event.listen(app_engine.sync_engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args) -> None:
+        self.count += 1
+
+
+def percentile(sorted_values: List[float], q: int) -> float:
+    """Nearest-rank percentile of sorted values."""
+    rank = max(1, -(-q * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+class Fleet:
+    """
+    Deliveries moving through valid transitions, see TRANSITIONS, so that the scripted
+    events are not quarantined. A delivery reaching a terminal state is replaced by a new one.
+    """
+
+    def __init__(self, prefix: str, count: int):
+        self.prefix = prefix
+        self.ongoing = [f"{prefix}-{index}" for index in range(count)]
+        self.names = list(self.ongoing)
+        self.states: Dict[str, Optional[DeliveryState]] = {name: None for name in self.ongoing}
+        # Deliveries with events once seeded, see seed_requests.
+        self.seeded: List[str] = []
+
+    def step(self, rng: random.Random, slot: int) -> dict:
+        """Move the delivery of an ongoing slot to a next state, and return the event."""
+        name = self.ongoing[slot]
+        state = self.states[name]
+        state = rng.choice(TRANSITIONS[state]) if state else DeliveryState.PARCEL_COLLECTED
+        self.states[name] = state
+        if state.is_terminal:
+            self.ongoing[slot] = f"{self.prefix}-{len(self.names)}"
+            self.names.append(self.ongoing[slot])
+            self.states[self.ongoing[slot]] = None
+        return {"delivery_name": name, "type": state.value}
+
+    def next_event(self, rng: random.Random) -> dict:
+        return self.step(rng, rng.randrange(len(self.ongoing)))
+
+
+def event_request(rng: random.Random, fleet: Fleet) -> Request:
+    event = fleet.next_event(rng)
+    return "POST", f"/deliveries/{event['delivery_name']}/events", {"type": event["type"]}, 1
+
+def batch_request(rng: random.Random, fleet: Fleet) -> Request:
+    events = [fleet.next_event(rng) for _ in range(BATCH_SIZE)]
+    return "POST", "/events/batch", {"events": events}, BATCH_SIZE
+
+def read_request(rng: random.Random, fleet: Fleet) -> Request:
+    roll = rng.random()
+    if roll < 0.5:
+        return "GET", "/deliveries", None, 0
+    if roll < 0.75:
+        return "GET", "/deliveries/counts", None, 0
+    return "GET", f"/deliveries/{rng.choice(fleet.seeded)}/events?limit=100", None, 0
+
+def seed_requests(rng: random.Random, fleet: Fleet, events_per_delivery: int) -> List[Request]:
+    """Batches of events_per_delivery events for each ongoing delivery of the fleet."""
+    events = [
+        fleet.step(rng, slot)
+        for _ in range(events_per_delivery) for slot in range(len(fleet.ongoing))
+    ]
+    fleet.seeded = [name for name in fleet.names if fleet.states[name] is not None]
+    return [
+        ("POST", "/events/batch", {"events": events[start:start + 1000]}, len(events[start:start + 1000]))
+        for start in range(0, len(events), 1000)
+    ]
+
+
+def ingest_workload(rng: random.Random, requests: int, deliveries: int) -> Tuple[List[Request], List[Request]]:
+    """Single events and, one time out of ten, batches of events, to new and existing deliveries."""
+    fleet = Fleet("ingest", deliveries)
+    script = [
+        batch_request(rng, fleet) if rng.random() < 0.1 else event_request(rng, fleet)
+        for _ in range(requests)
+    ]
+    return [], script
+
+def read_workload(rng: random.Random, requests: int, deliveries: int) -> Tuple[List[Request], List[Request]]:
+    """Ongoing deliveries, counts and event histories of seeded deliveries."""
+    fleet = Fleet("read", deliveries)
+    return seed_requests(rng, fleet, 5), [read_request(rng, fleet) for _ in range(requests)]
+
+def mixed_workload(rng: random.Random, requests: int, deliveries: int) -> Tuple[List[Request], List[Request]]:
+    """As many single events as reads, on seeded deliveries."""
+    fleet = Fleet("mixed", deliveries)
+    seed = seed_requests(rng, fleet, 5)
+    script = [
+        event_request(rng, fleet) if rng.random() < 0.5 else read_request(rng, fleet)
+        for _ in range(requests)
+    ]
+    return seed, script
+
+def history_workload(rng: random.Random, requests: int, deliveries: int) -> Tuple[List[Request], List[Request]]:
+    """Large result sets: pages of 1000 events of long delivery histories, and the ongoing deliveries."""
+    fleet = Fleet("history", deliveries)
+    names = [f"history-long-{index}" for index in range(10)]
+    legs = [DeliveryState.TAKEN_OFF.value, DeliveryState.LANDED.value] * (HISTORY_LENGTH // 2)
+    events = [
+        {"delivery_name": name, "type": event_type}
+        for name in names for event_type in [DeliveryState.PARCEL_COLLECTED.value, *legs[:HISTORY_LENGTH - 1]]
+    ]
+    seed = seed_requests(rng, fleet, 1) + [
+        ("POST", "/events/batch", {"events": events[start:start + 1000]}, len(events[start:start + 1000]))
+        for start in range(0, len(events), 1000)
+    ]
+    script = [
+        ("GET", f"/deliveries/{rng.choice(names)}/events?limit={HISTORY_LENGTH}", None, 0) if rng.random() < 0.75
+        else ("GET", "/deliveries", None, 0)
+        for _ in range(requests)
+    ]
+    return seed, script
+
+def scan_workload(rng: random.Random, requests: int, deliveries: int) -> Tuple[List[Request], List[Request]]:
+    """Exports of the whole event history, which scan every event."""
+    fleet = Fleet("scan", deliveries)
+    return seed_requests(rng, fleet, 20), [("GET", "/events/export?format=arrow", None, 0) for _ in range(requests)]
+
+def archive_workload(rng: random.Random, requests: int, deliveries: int) -> Tuple[List[Request], List[Request]]:
+    """Event histories of finished deliveries, compacted after seeding unless HISTORY_COMPACTION=false."""
+    fleet = Fleet("archive", deliveries)
+    seed = seed_requests(rng, fleet, 20)
+    finished = [name for name in fleet.names if fleet.states[name] is not None and fleet.states[name].is_terminal]
+    return seed, [("GET", f"/deliveries/{rng.choice(finished)}/events?limit=100", None, 0) for _ in range(requests)]
+
+def retention_workload(rng: random.Random, requests: int, deliveries: int) -> Tuple[List[Request], List[Request]]:
+    """Single events of new deliveries once the delivery history limit is reached,
+    so that every new delivery makes the pruner delete an old one."""
+    fleet = Fleet("retention", deliveries)
+    script = [
+        ("POST", f"/deliveries/new-{index}/events", {"type": "PARCEL_COLLECTED"}, 1)
+        for index in range(requests)
+    ]
+    return seed_requests(rng, fleet, 5), script
+
+
+WORKLOADS: Dict[str, Callable[[random.Random, int, int], Tuple[List[Request], List[Request]]]] = {
+    "ingest": ingest_workload,
+    "read": read_workload,
+    "mixed": mixed_workload,
+    "history": history_workload,
+    "scan": scan_workload,
+    "archive": archive_workload,
+    "retention": retention_workload,
+}
+
+
+async def reset(admin_engine) -> None:
+    async with admin_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    keys = await redis_client.keys(f"{QUEUE_KEY_PREFIX}:*") + await redis_client.keys(f"{PROCESSING_KEY_PREFIX}:*")
+    await redis_client.delete(DEAD_LETTER_KEY, *keys)
+    await delivery_cache.clear()
+    # The connections of the app cached the types of the dropped tables.
+    await engine.dispose()
+    await read_engine.dispose()
+
+async def count_quarantined_events(admin_engine) -> int:
+    async with admin_engine.connect() as conn:
+        return await conn.scalar(select(func.count()).select_from(QuarantinedEvent))
+
+async def count_events(admin_engine) -> int:
+    """Count the ingested events, quarantined, compacted or not."""
+    async with admin_engine.connect() as conn:
+        events = await conn.scalar(select(func.count()).select_from(Event))
+        events += await conn.scalar(select(func.coalesce(func.sum(func.cardinality(CompactedHistory.event_ids)), 0)))
+        return events + await conn.scalar(select(func.count()).select_from(QuarantinedEvent))
+
+async def storage_sizes(admin_engine) -> Dict[str, int]:
+    """
+    Size of the deliveries, events and compacted histories tables and of their indexes,
+    with all the partitions of events, in bytes.
+    """
+    sizes = {}
+    async with admin_engine.connect() as conn:
+        for table in (Delivery.__tablename__, Event.__tablename__, CompactedHistory.__tablename__):
+            table_bytes, index_bytes = (await conn.execute(
+                text(
+                    "SELECT sum(pg_table_size(relid)), sum(pg_indexes_size(relid)) FROM "
+                    "(SELECT relid FROM pg_partition_tree(CAST(:table AS regclass)) UNION SELECT CAST(:table AS regclass)) AS tables"
+                ),
+                {"table": table},
+            )).one()
+            sizes[f"{table}_table_bytes"] = int(table_bytes)
+            sizes[f"{table}_index_bytes"] = int(index_bytes)
+    return sizes
+
+async def vacuum(admin_engine) -> None:
+    """Vacuum the tables as autovacuum would, e.g. after the compaction deleted events."""
+    async with admin_engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("VACUUM ANALYZE"))
+
+async def wait_for_events(admin_engine, expected: int, timeout: float = 300) -> None:
+    """Wait until the queued events are ingested, quarantined or dead-lettered."""
+    deadline = time.perf_counter() + timeout
+    while await count_events(admin_engine) + (await get_queue_stats()).dead_letters < expected:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"Only {await count_events(admin_engine)} of {expected} events were ingested.")
+        await asyncio.sleep(0.05)
+
+async def wait_for_queue(timeout: float = 300) -> None:
+    """Wait until the queue is empty, and the last batch taken from it is ingested."""
+    deadline = time.perf_counter() + timeout
+    while (await get_queue_stats()).depth:
+        if time.perf_counter() > deadline:
+            raise TimeoutError("The queue was not emptied.")
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(settings.ingest_poll_timeout)
+
+async def send(client: AsyncClient, script: List[Request], concurrency: int) -> Tuple[List[float], int, int, int]:
+    """Send the requests with concurrency workers, each waiting for its previous response.
+    Requests shed by the ingest admission are retried after their Retry-After, like clients do,
+    and their latency includes the wait.
+    Returns the latency of each request, the number of failed requests, of accepted events and of shed requests."""
+    latencies: List[float] = []
+    errors = accepted = shed = 0
+    pending = iter(script)
+
+    async def worker():
+        nonlocal errors, accepted, shed
+        for method, url, body, events in pending:
+            started = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            while response.status_code == 429:
+                shed += 1
+                await asyncio.sleep(float(response.headers.get("retry-after", 1)))
+                response = await client.request(method, url, json=body)
+            latencies.append(time.perf_counter() - started)
+            if response.is_error:
+                errors += 1
+            else:
+                accepted += events
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, accepted, shed
+
+async def run_workload(name: str, admin_engine, counter: StatementCounter, seed: int, requests: int, deliveries: int, concurrency: int) -> dict:
+    rng = random.Random(seed)
+    seed_script, script = WORKLOADS[name](rng, requests, deliveries)
+    await reset(admin_engine)
+    # Deliveries reaching a terminal state are replaced by new ones, and pruning them
+    # would lose the events being counted, so only the retention workload prunes.
+    settings.delivery_history_limit = deliveries if name == "retention" else 2 ** 31
+    if name == "retention":
+        settings.retention_interval = min(settings.retention_interval, 1.0)
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://bench") as client:
+            _, seed_errors, seeded, _ = await send(client, seed_script, concurrency)
+            await wait_for_events(admin_engine, seeded)
+            if name == "archive" and settings.history_compaction:
+                await compaction.compact(delay=0)
+                await vacuum(admin_engine)
+            counter.count = 0
+            started = time.perf_counter()
+            latencies, errors, events, shed = await send(client, script, concurrency)
+            sent = time.perf_counter() - started
+            if name == "retention":
+                # Pruned events are not counted, wait for the queue to be empty instead.
+                await wait_for_queue()
+            else:
+                await wait_for_events(admin_engine, seeded + events)
+            elapsed = time.perf_counter() - started
+            statements = counter.count
+            dead_letters = (await get_queue_stats()).dead_letters
+            # Concurrent clients can send the events of a delivery out of order.
+            quarantined = await count_quarantined_events(admin_engine)
+            storage = await storage_sizes(admin_engine)
+            report = await retention.prune() if name == "retention" else None
+    if seed_errors or errors or dead_letters:
+        # The scripts only send valid requests: failures are bugs, such as deadlocks, not load.
+        raise RuntimeError(
+            f"The {name} workload had {seed_errors + errors} failed requests and {dead_letters} dead-lettered events."
+        )
+    latencies.sort()
+    return {
+        "requests": len(script),
+        "errors": errors,
+        "shed_requests": shed,
+        "events": events,
+        "quarantined_events": quarantined,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(script) / sent, 1),
+        "events_per_second": round(events / elapsed, 1) if events else None,
+        "latency_ms": {f"p{q}": round(percentile(latencies, q) * 1000, 2) for q in (50, 95, 99)},
+        "sql_statements": statements,
+        "sql_statements_per_request": round(statements / len(script), 2),
+        "storage": storage,
+        **({"pruned_total": report.model_dump()} if report else {}),
+    }
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    output: str = typer.Option("benchmark.json", help="File to write the results to"),
+    workload: List[str] = typer.Option(list(WORKLOADS), help="Workloads to run"),
+    requests: int = typer.Option(2000, help="Measured requests per workload"),
+    deliveries: int = typer.Option(500, help="Deliveries of each workload, and delivery history limit of the retention workload"),
+    concurrency: int = typer.Option(16, help="Concurrent clients"),
+    seed: int = typer.Option(42, help="Seed of the scripted requests"),
+    yes: bool = typer.Option(False, "--yes", help="Do not ask before dropping the tables"),
+):
+    """Run the workloads and write their throughput, latency, SQL statements per request and table sizes as JSON."""
+    unknown = set(workload) - set(WORKLOADS)
+    if unknown:
+        raise typer.BadParameter(f"Unknown workloads: {', '.join(sorted(unknown))}")
+    if not yes:
+        typer.confirm(f"The tables of {engine.url.render_as_string()} will be dropped, continue?", abort=True)
+
+    async def main():
+        admin_engine = create_async_engine(settings.database_url)
+        counter = StatementCounter()
+        overridden = {"delivery_history_limit": settings.delivery_history_limit, "retention_interval": settings.retention_interval}
+        results = {}
+        try:
+            for name in workload:
+                results[name] = await run_workload(name, admin_engine, counter, seed, requests, deliveries, concurrency)
+                for setting, value in overridden.items():
+                    setattr(settings, setting, value)
+                typer.echo(f"{name}: {json.dumps(results[name])}")
+        finally:
+            await admin_engine.dispose()
+            await engine.dispose()
+            await read_engine.dispose()
+        return results
+
+    report = {
+        "commit": current_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "parameters": {"requests": requests, "deliveries": deliveries, "concurrency": concurrency, "seed": seed},
+        "workloads": asyncio.run(main()),
+    }
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    typer.echo(f"Results written to {output}.")
+
+
+if __name__ == "__main__":
+    typer.run(run)